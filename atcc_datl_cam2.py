@@ -7,7 +7,7 @@ import numpy as np
 
 from utils import init_lane_detector
 from camera_metadata import CAMERA_METADATA
-from detectors.trt_detector import TrtYoloDetector
+from detectors import load_detector
 
 
 WRITE_VIDEO = False
@@ -29,7 +29,8 @@ initial_frame1 = cv2.resize(initial_frame1, dsize=(width1//2, height1//2))
 
 camera_meta = CAMERA_METADATA["datlcam2"]
 
-detector = TrtYoloDetector(
+detector = load_detector(
+    "trt",
     initial_frame1,
     init_lane_detector(camera_meta),
     detection_thresh=0.5,
@@ -4,10 +4,24 @@ import time
 import datetime
 import subprocess
 import numpy as np
-from multiprocessing import Process, Queue, Value
+from multiprocessing import Process, Event
 
 from camera_metadata import CAMERA_METADATA
+from detectors import load_detector, CameraStream, DetectorService
 from utils import init_lane_detector, draw_text_with_backgroud
+from utils import SharedFrameRing, StageQueue
+from utils import StageWorker, StopStage, put_while_alive
+
+
+# both cameras are matched frame by frame in postprocessing, so frames must not
+# be dropped here, a full queue makes the capture loop wait instead
+QUEUE_SIZE = 32
+QUEUE_POLICY = "block"
+
+# the detector service batches up to this many frames of both cameras, waiting at
+# most this long (seconds) for the other camera's frame after the first one
+DETECTOR_MAX_BATCH = 2
+DETECTOR_MAX_WAIT = 0.005
 
 
 vidcap1 = cv2.VideoCapture("inputs/datlcam1_clip1.mp4")
@@ -29,6 +43,11 @@ _, initial_frame2 = vidcap2.read()
 initial_frame1 = cv2.resize(initial_frame1, dsize=(width1//2, height1//2))
 initial_frame2 = cv2.resize(initial_frame2, dsize=(width2//2, height2//2))
 
+# frames are written once by the main process and read in place by the detector
+# and postprocess processes, queues only carry slot indices
+frame_ring1 = SharedFrameRing(2 * QUEUE_SIZE + 4, initial_frame1.shape)
+frame_ring2 = SharedFrameRing(2 * QUEUE_SIZE + 4, initial_frame2.shape)
+
 camera_meta1 = CAMERA_METADATA["datlcam1"]
 camera_meta2 = CAMERA_METADATA["datlcam2"]
 
@@ -278,218 +297,214 @@ def twoD_2_threeD_secondarycam(det):
     return btm_pt, [pt1, pt2, pt3, pt4, pt5, pt6, pt7]
 
 
-def postprocess_detections(preprocessedframe1_queue, preprocessedframe2_queue, tilldetection1_queue, tilldetection2_queue, vidcap_status):
-    global videowriter
+def postprocess_detections(request_queue, tilldetection1_queue, tilldetection2_queue, stop_event):
+    global videowriter, frame_ring1, frame_ring2
 
     tik1 = time.time()
-    while True:
-        if tilldetection1_queue.qsize() > 0 and tilldetection2_queue.qsize() > 0:
-            tik2 = time.time()
-
-            detection_list1, frame1, frame_count1, fps_list1 = tilldetection1_queue.get()
-            detection_list2, frame2, frame_count2, fps_list2 = tilldetection2_queue.get()     
-
-            if frame_count1 != frame_count2:
-                print("frames out of sync !")
-                vidcap_status.value = 0
-
-            # for l in ["leftlane", "middlelane", "rightlane"]:
-            #     cv2.polylines(frame1, [camera_meta1[f"{l}_coords"]], isClosed=True, color=(0, 0, 0), thickness=2)
-
-            # for l in ["leftlane", "middlelane", "rightlane"]:
-            #     cv2.polylines(frame2, [camera_meta2[f"{l}_coords"]], isClosed=True, color=(0, 0, 0), thickness=2)
-
-            for det in detection_list1:
-                rect = det["rect"]
-
-                # obj_centroid = (rect[0] + rect[2]) // 2, (rect[1] + rect[3]) // 2
-                # x,y = obj_centroid[0] - 10, obj_centroid[1]
-                # draw_text_with_backgroud(frame1,det["obj_class"][0],x,y,font_scale=0.4,thickness=1,background=(0, 0, 0),
-                #                         foreground=(255,255,255), box_coords_1=(-8, 8), box_coords_2=(6, -6),)
-
-                # if det["obj_class"][0] not in ["car", "ml", "auto", "tw"]:
-                #     cv2.rectangle(frame1, rect[:2], rect[2:], (255,0,0), 1)
-
-                btm, pts  = twoD_2_threeD_primarycam(det)
-                draw_3dbox(frame1, pts)
-                cv2.circle(frame1, btm, 3, (0,0,255), -1)
-
-                if det['lane'] == "1":
-                    btmx_tf = int((0.65523379 * btm[0]) + (-3.67679969 * btm[1]) + 1349.9740589597031)
-                    btmy_tf = int((0.41925539 * btm[0]) + (-0.04235352 * btm[1]) + 99.19415894167156)
-                elif det['lane'] == "2":
-                    btmx_tf = int((0.55305366 * btm[0]) + (-3.3535726 * btm[1]) + 1301.5774568947409)
-                    btmy_tf = int((0.37036275  * btm[0]) + (-0.02834603 * btm[1]) + 113.54696288217643)
-                else:
-                    btmx_tf = int((0.39657267 * btm[0]) + (-2.85288489 * btm[1]) + 1195.282143258536)
-                    btmy_tf = int((0.30479565 * btm[0]) + (0.04620164 * btm[1]) + 108.36117943778677)
-
-                cv2.circle(frame2, (int(btmx_tf), int(btmy_tf)), 3, (0,0,255), -1)
-
-                for ax in det["axles"]:
-                    cv2.rectangle(frame1, ax[:2], ax[2:], (255,0,255), 3)
-
-            for det in detection_list2:
-                rect = det["rect"]
-
-                # obj_centroid = (rect[0] + rect[2]) // 2, (rect[1] + rect[3]) // 2
-                # x,y = obj_centroid[0] - 10, obj_centroid[1]
-                # draw_text_with_backgroud(frame2,det["obj_class"][0],x,y,font_scale=0.4,thickness=1,background=(0, 0, 0),
-                #                         foreground=(255,255,255), box_coords_1=(-8, 8), box_coords_2=(6, -6),)
-
-                # if det["obj_class"][0] not in ["car", "ml", "auto", "tw"]:
-                #     cv2.rectangle(frame2, rect[:2], rect[2:], (255,0,0), 1)
-
-                btm, pts  = twoD_2_threeD_secondarycam(det)
-                draw_3dbox(frame2, pts)
-                cv2.circle(frame2, btm, 3, (255,0,0), -1)
-
-                for ax in det["axles"]:
-                    cv2.rectangle(frame2, ax[:2], ax[2:], (255,0,255), 3)
-
-            final_frame = np.hstack((frame1, frame2))
-            videowriter.write(final_frame)
-
-            cv2.imshow("video", final_frame)
-
-            key = cv2.waitKey(1)
-            if key == ord("q"):
-                vidcap_status.value = 0
-
-            if (
-                not vidcap_status.value
-                and preprocessedframe1_queue.qsize() == 0 and tilldetection1_queue.qsize() == 0
-                and preprocessedframe2_queue.qsize() == 0 and tilldetection2_queue.qsize() == 0
-            ):
-                break
-
-            fps_list1.append(fps_list2[-1])
-
-            tok = time.time()
-            avg_fps = round(frame_count1 / (tok - tik1), 2)
-            inst_fps = round(1.0 / (tok - tik2), 1)
-            fps_list1.append((inst_fps, avg_fps))
-
-            print(frame_count1, frame_count2, end=" ; ")
-            for n, v in zip(["inp", "det1", "det2", "pp"], fps_list1):
-                print(f"{n}-fps: {v[0]}, {v[1]}", end=" ; ")
-            print(
-                f"qsize: {preprocessedframe1_queue.qsize()}, {preprocessedframe2_queue.qsize()}, {tilldetection1_queue.qsize()}, {tilldetection2_queue.qsize()}"
-            )
-
-        if (
-            not vidcap_status.value
-            and preprocessedframe1_queue.qsize() == 0 and tilldetection1_queue.qsize() == 0
-            and preprocessedframe2_queue.qsize() == 0 and tilldetection2_queue.qsize() == 0
-        ):
-            break
-    
-    compress_video()
+    secondary_stopped = False
 
+    def postprocess_frame(item):
+        nonlocal secondary_stopped
+        tik2 = time.time()
 
-def detection_primarycam(preprocessedframes1_queue, tilldetection1_queue):
-    from detectors.trt_detector import TrtYoloDetector
+        # both cameras get the same number of frames, so the secondary queue always
+        # has the frame matching the one taken from the primary queue, unless its
+        # stop sentinel came first
+        detection_list1, slot1, frame_count1, fps_list1 = item
+        item2 = None if secondary_stopped else tilldetection2_queue.get()
 
-    global initial_frame1, camera_meta1
+        if item2 is None or isinstance(item2, StopStage):
+            secondary_stopped = True
+            frame_ring1.release(slot1)
+            stop_event.set()
+            return
 
-    detector = TrtYoloDetector(
-        initial_frame1,
-        init_lane_detector(camera_meta1),
-        detection_thresh=0.5,
-        bottom_type="bottom-right"
-    )
+        detection_list2, slot2, frame_count2, fps_list2 = item2
 
-    tik1 = time.time()
-    while True:
-        if preprocessedframes1_queue.qsize() > 0:
-            tik2 = time.time()
+        frame1 = frame_ring1[slot1]
+        frame2 = frame_ring2[slot2]
+
+        if frame_count1 != frame_count2:
+            print("frames out of sync !")
+            stop_event.set()
+
+        # for l in ["leftlane", "middlelane", "rightlane"]:
+        #     cv2.polylines(frame1, [camera_meta1[f"{l}_coords"]], isClosed=True, color=(0, 0, 0), thickness=2)
+
+        # for l in ["leftlane", "middlelane", "rightlane"]:
+        #     cv2.polylines(frame2, [camera_meta2[f"{l}_coords"]], isClosed=True, color=(0, 0, 0), thickness=2)
+
+        for det in detection_list1:
+            rect = det["rect"]
+
+            # obj_centroid = (rect[0] + rect[2]) // 2, (rect[1] + rect[3]) // 2
+            # x,y = obj_centroid[0] - 10, obj_centroid[1]
+            # draw_text_with_backgroud(frame1,det["obj_class"][0],x,y,font_scale=0.4,thickness=1,background=(0, 0, 0),
+            #                         foreground=(255,255,255), box_coords_1=(-8, 8), box_coords_2=(6, -6),)
+
+            # if det["obj_class"][0] not in ["car", "ml", "auto", "tw"]:
+            #     cv2.rectangle(frame1, rect[:2], rect[2:], (255,0,0), 1)
+
+            btm, pts  = twoD_2_threeD_primarycam(det)
+            draw_3dbox(frame1, pts)
+            cv2.circle(frame1, btm, 3, (0,0,255), -1)
+
+            if det['lane'] == "1":
+                btmx_tf = int((0.65523379 * btm[0]) + (-3.67679969 * btm[1]) + 1349.9740589597031)
+                btmy_tf = int((0.41925539 * btm[0]) + (-0.04235352 * btm[1]) + 99.19415894167156)
+            elif det['lane'] == "2":
+                btmx_tf = int((0.55305366 * btm[0]) + (-3.3535726 * btm[1]) + 1301.5774568947409)
+                btmy_tf = int((0.37036275  * btm[0]) + (-0.02834603 * btm[1]) + 113.54696288217643)
+            else:
+                btmx_tf = int((0.39657267 * btm[0]) + (-2.85288489 * btm[1]) + 1195.282143258536)
+                btmy_tf = int((0.30479565 * btm[0]) + (0.04620164 * btm[1]) + 108.36117943778677)
+
+            cv2.circle(frame2, (int(btmx_tf), int(btmy_tf)), 3, (0,0,255), -1)
+
+            for ax in det["axles"]:
+                cv2.rectangle(frame1, ax[:2], ax[2:], (255,0,255), 3)
+
+        for det in detection_list2:
+            rect = det["rect"]
+
+            # obj_centroid = (rect[0] + rect[2]) // 2, (rect[1] + rect[3]) // 2
+            # x,y = obj_centroid[0] - 10, obj_centroid[1]
+            # draw_text_with_backgroud(frame2,det["obj_class"][0],x,y,font_scale=0.4,thickness=1,background=(0, 0, 0),
+            #                         foreground=(255,255,255), box_coords_1=(-8, 8), box_coords_2=(6, -6),)
+
+            # if det["obj_class"][0] not in ["car", "ml", "auto", "tw"]:
+            #     cv2.rectangle(frame2, rect[:2], rect[2:], (255,0,0), 1)
+
+            btm, pts  = twoD_2_threeD_secondarycam(det)
+            draw_3dbox(frame2, pts)
+            cv2.circle(frame2, btm, 3, (255,0,0), -1)
+
+            for ax in det["axles"]:
+                cv2.rectangle(frame2, ax[:2], ax[2:], (255,0,255), 3)
+
+        final_frame = np.hstack((frame1, frame2))
+        videowriter.write(final_frame)
+
+        frame_ring1.release(slot1)
+        frame_ring2.release(slot2)
+
+        cv2.imshow("video", final_frame)
 
-            frame1, frame_count, fps_list = preprocessedframes1_queue.get()
-            detection_list = detector.detect(frame1)
+        key = cv2.waitKey(1)
+        if key == ord("q"):
+            stop_event.set()
 
-            tok = time.time()
-            avg_fps = round(frame_count / (tok - tik1), 2)
-            inst_fps = round(1.0 / (tok - tik2), 1)
-            fps_list.append((inst_fps, avg_fps))
+        fps_list1.append(fps_list2[-1])
 
-            tilldetection1_queue.put((detection_list, frame1, frame_count, fps_list))
+        tok = time.time()
+        avg_fps = round(frame_count1 / (tok - tik1), 2)
+        inst_fps = round(1.0 / (tok - tik2), 1)
+        fps_list1.append((inst_fps, avg_fps))
 
+        print(frame_count1, frame_count2, end=" ; ")
+        for n, v in zip(["inp", "det1", "det2", "pp"], fps_list1):
+            print(f"{n}-fps: {v[0]}, {v[1]}", end=" ; ")
+        print(
+            f"qsize: {request_queue.qsize()}, {tilldetection1_queue.qsize()}, {tilldetection2_queue.qsize()}"
+        )
+
+    StageWorker(tilldetection1_queue, postprocess_frame).run()
+
+    compress_video()
 
-def detection_secondarycam(preprocessedframes2_queue, tilldetection2_queue):
-    from detectors.trt_detector import TrtYoloDetector
 
-    global initial_frame2, camera_meta2
+def detection_service(request_queue, tilldetection1_queue, tilldetection2_queue):
+    global initial_frame1, camera_meta1, frame_ring1, frame_ring2
 
-    detector = TrtYoloDetector(
-        initial_frame2,
-        init_lane_detector(camera_meta2),
+    # one model serves both cameras, frames of both are batched together
+    detector = load_detector(
+        "trt",
+        initial_frame1,
+        init_lane_detector(camera_meta1),
         detection_thresh=0.5,
-        bottom_type="bottom-left"
+        bottom_type="bottom-right"
     )
 
-    tik1 = time.time()
-    while True:
-        if preprocessedframes2_queue.qsize() > 0:
-            tik2 = time.time()
-
-            frame2, frame_count, fps_list = preprocessedframes2_queue.get()
-            detection_list = detector.detect(frame2)
+    cameras = [
+        CameraStream(frame_ring1, init_lane_detector(camera_meta1), "bottom-right", tilldetection1_queue),
+        CameraStream(frame_ring2, init_lane_detector(camera_meta2), "bottom-left", tilldetection2_queue),
+    ]
 
-            tok = time.time()
-            avg_fps = round(frame_count / (tok - tik1), 2)
-            inst_fps = round(1.0 / (tok - tik2), 1)
-            fps_list.append((inst_fps, avg_fps))
+    tik1 = time.time()
+    tik2 = [time.time(), time.time()]
+
+    def on_result(camera_idx, detection_list, request):
+        _, slot, frame_count, fps_list = request
+
+        tok = time.time()
+        avg_fps = round(frame_count / (tok - tik1), 2)
+        inst_fps = round(1.0 / max(tok - tik2[camera_idx], 1e-6), 1)
+        tik2[camera_idx] = tok
+        fps_list.append((inst_fps, avg_fps))
+
+        return (detection_list, slot, frame_count, fps_list)
+
+    service = DetectorService(
+        detector,
+        request_queue,
+        cameras,
+        max_batch=DETECTOR_MAX_BATCH,
+        max_wait=DETECTOR_MAX_WAIT,
+        on_result=on_result,
+    )
+    service.run()
 
-            tilldetection2_queue.put((detection_list, frame2, frame_count, fps_list))
+    print(f"detector service: {service.num_frames} frames, avg batch {round(service.avg_batch, 2)}")
 
 
-preprocessedframe1_queue = Queue()
-preprocessedframe2_queue = Queue()
-tilldetection1_queue = Queue()
-tilldetection2_queue = Queue()
+# frames of both cameras go to the one detector service, tagged with their camera
+request_queue = StageQueue(2 * QUEUE_SIZE, QUEUE_POLICY)
+tilldetection1_queue = StageQueue(QUEUE_SIZE, QUEUE_POLICY)
+tilldetection2_queue = StageQueue(QUEUE_SIZE, QUEUE_POLICY)
 
-vidcap_status = Value("i", 1)
+# set by the postprocess process when `q` is pressed or the cameras go out of sync
+stop_event = Event()
 
-process1 = Process(target=detection_primarycam, args=(preprocessedframe1_queue, tilldetection1_queue))
+process1 = Process(target=detection_service, args=(request_queue, tilldetection1_queue, tilldetection2_queue))
 process1.start()
 
-process2 = Process(target=detection_secondarycam, args=(preprocessedframe2_queue, tilldetection2_queue))
-process2.start()
-
-process3 = Process(target=postprocess_detections, args=(preprocessedframe1_queue, preprocessedframe2_queue, tilldetection1_queue, tilldetection2_queue, vidcap_status))
+process3 = Process(target=postprocess_detections, args=(request_queue, tilldetection1_queue, tilldetection2_queue, stop_event))
 process3.start()
 
 with open(f"pid_datl.txt", "w") as f:
     f.write(
-        f"main-{os.getpid()} ; process1-{process1.pid} ; process2-{process2.pid} ; process3-{process3.pid}"
+        f"main-{os.getpid()} ; process1-{process1.pid} ; process3-{process3.pid}"
     )
 
 frame_count1 = 0
 frame_count2 = 0
 tik1 = time.time()
 
-while vidcap1.isOpened() and vidcap2.isOpened():
+while vidcap1.isOpened() and vidcap2.isOpened() and not stop_event.is_set():
     tik2 = time.time()
 
-    vidcap_status.value, frame1 = vidcap1.read()
-    vidcap_status.value, frame2 = vidcap2.read()
-
-    if not vidcap_status.value:
-        if not process3.is_alive():
-            process1.terminate()
-            process2.terminate()
+    status1, frame1 = vidcap1.read()
+    status2, frame2 = vidcap2.read()
 
-        if not process1.is_alive() and not process2.is_alive():
-            vidcap1.release()
-            vidcap2.release()
-            cv2.destroyAllWindows()
-            sys.exit()
+    if not status1 or not status2:
+        break
 
     frame_count1 += 1
     frame_count2 += 1
 
-    frame1 = cv2.resize(frame1, dsize=(width1//2, height1//2))
-    frame2 = cv2.resize(frame2, dsize=(width2//2, height2//2))
+    # slots are freed by the postprocess process, stop waiting once it is gone
+    slot1 = slot2 = None
+    while (slot1 is None or slot2 is None) and process3.is_alive():
+        if slot1 is None:
+            slot1 = frame_ring1.acquire(timeout=1)
+        if slot2 is None and slot1 is not None:
+            slot2 = frame_ring2.acquire(timeout=1)
+
+    if slot1 is None or slot2 is None:
+        break
+
+    cv2.resize(frame1, dsize=(width1//2, height1//2), dst=frame_ring1[slot1])
+    cv2.resize(frame2, dsize=(width2//2, height2//2), dst=frame_ring2[slot2])
 
     key = cv2.waitKey(35)
 
@@ -497,45 +512,29 @@ while vidcap1.isOpened() and vidcap2.isOpened():
     avg_fps = round(frame_count1 / (tok - tik1), 2)
     inst_fps = round(1.0 / (tok - tik2), 1)
 
-    preprocessedframe1_queue.put((frame1, frame_count1, [(inst_fps, avg_fps)]))
-    preprocessedframe2_queue.put((frame2, frame_count2, [(inst_fps, avg_fps)]))
-
-    if (
-        preprocessedframe1_queue.qsize() > 500
-        or preprocessedframe2_queue.qsize() > 500
-        or tilldetection1_queue.qsize() > 500
-        or tilldetection2_queue.qsize() > 500
+    if not put_while_alive(
+        request_queue, (0, slot1, frame_count1, [(inst_fps, avg_fps)]), process1
+    ) or not put_while_alive(
+        request_queue, (1, slot2, frame_count2, [(inst_fps, avg_fps)]), process1
     ):
-        print(
-            f"queue overflow ! , qsize: {preprocessedframe1_queue.qsize()}, {tilldetection1_queue.qsize()}"
-        )
-        print(
-            f"queue overflow ! , qsize: {preprocessedframe2_queue.qsize()}, {tilldetection2_queue.qsize()}"
-        )
-
-        process1.terminate()
-        process2.terminate()
-        process3.terminate()
-
-        vidcap1.release()
-        vidcap2.release()
-
-        cv2.destroyAllWindows()
-        print("Now press Ctrl+C to exit...")
-
-    if not vidcap_status.value and process3.is_alive():
-        while process3.is_alive():
-            continue
-
-        process1.terminate()
-        print("Terminated Process-1")
+        break
 
-        process2.terminate()
-        print("Terminated Process-2")
+# one stop sentinel per camera goes behind the last frames, the detector service
+# drains its queue and passes them on to the postprocess process. A dead service
+# never does, then they go straight to postprocessing, the secondary one first
+# so a frame waiting for its match is let go.
+if not put_while_alive(request_queue, StopStage(), process1) or not put_while_alive(
+    request_queue, StopStage(), process1
+):
+    print("Detector service died, stopping postprocessing !")
+    put_while_alive(tilldetection2_queue, StopStage(), process3)
+    put_while_alive(tilldetection1_queue, StopStage(), process3)
 
-    if not process1.is_alive() and not process2.is_alive():
-        break
+process1.join()
+process3.join()
 
 vidcap1.release()
 vidcap2.release()
+frame_ring1.close(unlink=True)
+frame_ring2.close(unlink=True)
 cv2.destroyAllWindows()
@@ -10,14 +10,18 @@ import subprocess
 import numpy as np
 from collections import deque
 from scipy.spatial import distance
-from multiprocessing import Process, Queue, Value
+from multiprocessing import Process, Event
 
 from camera_metadata import CAMERA_METADATA
-from detectors import VanillaYoloDetector
+from detectors import load_detector
 from trackers import CentroidTracker, KalmanTracker
 from utils import init_lane_detector, init_direction_detector
-from utils import init_within_interval, intersection_over_rect
+from utils import init_within_interval, intersection_over_rect_matrix
+from utils import detection_cache_path
 from utils import draw_text_with_backgroud, draw_tracked_objects, draw_axles
+from utils import SharedFrameRing, StageQueue, QUEUE_POLICIES
+from utils import StageWorker, StopStage, put_while_alive
+from utils import Detections, MotionGate
 
 
 Abbrevation_Mapper = {
@@ -52,6 +56,19 @@ class VehicleTracking(object):
         max_track_pts,
         max_absent,
         mode,
+        queue_size,
+        queue_policy,
+        batch_size,
+        num_threads,
+        fp16,
+        record,
+        lane_roi,
+        farfield,
+        synthetic_vehicles,
+        synthetic_dropout,
+        motion_gate,
+        association,
+        candidates,
     ):
 
         if input_path.startswith("inputs"):
@@ -67,6 +84,17 @@ class VehicleTracking(object):
             raise ValueError("Invalid input !")
 
         self.inference_type = inference_type
+        self.batch_size = batch_size
+        self.num_threads = num_threads
+        self.fp16 = fp16
+        self.record = record
+        self.lane_roi = lane_roi
+        self.farfield = farfield
+        self.use_motion_gate = motion_gate
+        self.association = association
+        self.candidates = candidates
+        self.synthetic_vehicles = synthetic_vehicles
+        self.synthetic_dropout = synthetic_dropout
 
         self.write_db = write_db
         if self.write_db:
@@ -90,6 +118,11 @@ class VehicleTracking(object):
 
         self.camera_meta = CAMERA_METADATA[self.camera_id]
 
+        if self.farfield and "farfield_roi" not in self.camera_meta:
+            raise ValueError(
+                f"No farfield_roi for camera `{self.camera_id}` in camera_metadata.py, run without -ff !"
+            )
+
         self.resize = resize
         self.detection_thresh = detection_thresh
         self.tracker_type = tracker_type
@@ -136,10 +169,17 @@ class VehicleTracking(object):
 
         self.countintervals = self.camera_meta["adaptive_countintervals"]
 
+        # set by the postprocess process when `q` is pressed
+        self.stop_event = Event()
+
         self.vidcap = cv2.VideoCapture(self.input_path)
 
-        self.preprocessedframes_queue = Queue()
-        self.tilldetection_queue = Queue()
+        self.preprocessedframes_queue = StageQueue(
+            queue_size, queue_policy, on_drop=self._release_dropped_frame
+        )
+        self.tilldetection_queue = StageQueue(
+            queue_size, queue_policy, on_drop=self._release_dropped_frame
+        )
 
         _, initial_frame = self.vidcap.read()
 
@@ -162,6 +202,18 @@ class VehicleTracking(object):
             interpolation=cv2.INTER_LINEAR,
         )
 
+        # frames are written once here and read in place by the other processes,
+        # queues only carry the slot index. Enough slots for both full queues plus
+        # the frames held by each of the three stages (a whole batch for detection).
+        self.frame_ring = SharedFrameRing(
+            self.preprocessedframes_queue.maxsize
+            + self.tilldetection_queue.maxsize
+            + self.batch_size
+            + 3,
+            (self.frame_h, self.frame_w, 3),
+            dtype=np.uint8,
+        )
+
         self.img_for_text = cv2.imread("right_image.jpg")
 
         self.img_for_log = np.zeros(
@@ -187,6 +239,10 @@ class VehicleTracking(object):
                 lane_angles,
                 velocity_regression,
                 self.max_absent,
+                association=self.association,
+                lane_detector=self.lane_detector,
+                candidates=self.candidates,
+                max_track_pts=self.max_track_pts,
             )
         else:
             self.tracker = KalmanTracker(
@@ -196,8 +252,16 @@ class VehicleTracking(object):
                 lane_angles,
                 velocity_regression,
                 self.max_absent,
+                association=self.association,
+                lane_detector=self.lane_detector,
+                candidates=self.candidates,
+                max_track_pts=self.max_track_pts,
             )
 
+    def _release_dropped_frame(self, item):
+        # every queued item starts with the frame slot it refers to
+        self.frame_ring.release(item[0])
+
     def _count_vehicles(self, tracked_objs):
         for obj in tracked_objs.values():
             obj_bottom = (
@@ -261,39 +325,41 @@ class VehicleTracking(object):
 
         return axleconfig
 
-    def _axle_assignments(self, tracked_objs, axles):
-        _axles = axles.copy()
-
-        for obj in tracked_objs.values():
-            if obj.obj_class[0] in ["2t", "3t", "4t", "5t", "6t", "bus", "lgv"]:
-                obj_ax = []
-
-                temp = []
-                for ax in _axles:
-                    if intersection_over_rect(obj.rect, ax) > 0.9:
-                        obj_ax.append(ax)
-                    else:
-                        temp.append(ax)
-
-                if len(obj_ax) > 0:
-                    obj.axle_track.append(
-                        sorted(obj_ax, key=lambda x: x[0])[-1][2:]
-                    )  # adding last axle
+    def _axle_assignments(self, tracked_objs, detections):
+        objs = [
+            obj
+            for obj in tracked_objs.values()
+            if obj.obj_class[0] in ["2t", "3t", "4t", "5t", "6t", "bus", "lgv"]
+        ]
+
+        if len(objs) == 0 or len(detections.axles) == 0:
+            return
+
+        # every axle goes to the first object which contains it
+        obj_rects = [obj.rect for obj in objs]
+        contains = intersection_over_rect_matrix(obj_rects, detections.axles) > 0.9
+        owners = np.where(contains.any(axis=0), contains.argmax(axis=0), -1)
+        axles = detections.axle_list()
+
+        for row, obj in enumerate(objs):
+            obj_ax = sorted(
+                [axles[idx] for idx in np.flatnonzero(owners == row)],
+                key=lambda x: x[0],
+            )
 
-                if obj.obj_class[0] in ["3t", "4t", "5t", "6t"]:
+            if len(obj_ax) > 0:
+                obj.axle_track.append(obj_ax[-1][2:])  # adding last axle
 
-                    if len(obj_ax) > len(obj.axles):
-                        obj.axles = sorted(obj_ax, key=lambda x: x[0])
+            if obj.obj_class[0] in ["3t", "4t", "5t", "6t"]:
 
-                    if (
-                        len(obj.axles) == int(obj.obj_class[0][0])
-                        and obj.axle_config is None
-                    ):
-                        obj.axle_config = self._get_axleconfig(obj.axles)
+                if len(obj_ax) > len(obj.axles):
+                    obj.axles = obj_ax
 
-                _axles = temp
-                if len(_axles) == 0:
-                    break
+                if (
+                    len(obj.axles) == int(obj.obj_class[0][0])
+                    and obj.axle_config is None
+                ):
+                    obj.axle_config = self._get_axleconfig(obj.axles)
 
     def _log(self, tracked_objs):
         for obj in tracked_objs.values():
@@ -518,49 +584,47 @@ class VehicleTracking(object):
         self.dev_cvutil_filewriter.close()
         self.error_filewriter.close()
 
-    def _postprocess_detections(self, vidcap_status):
+    def _init_outputs(self):
         date = datetime.datetime.now()
-        videodeletion_day = date
+        self._videodeletion_day = date
 
-        videodeletion_initialization_day = videodeletion_day + datetime.timedelta(
-            days=4
+        videodeletion_initialization_day = date + datetime.timedelta(days=4)
+        self._videodeletion_initialization_day = (
+            videodeletion_initialization_day.strftime("%d_%m_%Y")
         )
-        videodeletion_initialization_day = videodeletion_initialization_day.strftime(
-            "%d_%m_%Y"
-        )
-        flag_videodeletion = False
+        self._flag_videodeletion = False
 
         date = date.strftime("%d_%m_%Y_%H:%M:%S")
 
-        currentday_dir = f"outputs/{self.camera_id}/{date[:10]}/"
-        if not os.path.exists(currentday_dir):
-            os.mkdir(currentday_dir)
+        self.currentday_dir = f"outputs/{self.camera_id}/{date[:10]}/"
+        if not os.path.exists(self.currentday_dir):
+            os.mkdir(self.currentday_dir)
 
-        error_filename = currentday_dir + date[:10] + f"_log.txt"
+        error_filename = self.currentday_dir + date[:10] + f"_log.txt"
         self.error_filewriter = open(error_filename, "w")
 
-        currenthour_dir = currentday_dir + date[11:13] + "/"
-        if not os.path.exists(currenthour_dir):
-            os.mkdir(currenthour_dir)
+        self.currenthour_dir = self.currentday_dir + date[11:13] + "/"
+        if not os.path.exists(self.currenthour_dir):
+            os.mkdir(self.currenthour_dir)
 
-        currenthour_devdir = currenthour_dir + "dev/"
+        currenthour_devdir = self.currenthour_dir + "dev/"
         if not os.path.exists(currenthour_devdir):
             os.mkdir(currenthour_devdir)
 
         dev_cvutil_filename = currenthour_devdir + "cv.txt"
         self.dev_cvutil_filewriter = open(dev_cvutil_filename, "w")
 
-        log_filename = currenthour_dir + date[11:13] + ".txt"
+        log_filename = self.currenthour_dir + date[11:13] + ".txt"
         self.log_filewriter = open(log_filename, "w")
 
-        trackpath_filename = currenthour_dir + date[11:13] + f"_trkpath.txt"
+        trackpath_filename = self.currenthour_dir + date[11:13] + f"_trkpath.txt"
         self.tracker.trackpath_filewriter = open(trackpath_filename, "w")
 
-        cc_filename = currenthour_dir + date[11:13] + "_finalcounts.txt"
+        cc_filename = self.currenthour_dir + date[11:13] + "_finalcounts.txt"
         self.cc_filewriter = open(cc_filename, "w")
 
         if self.output:
-            self.video_filename = currenthour_dir + date[11:13] + ".avi"
+            self.video_filename = self.currenthour_dir + date[11:13] + ".avi"
             self.videowriter = cv2.VideoWriter(
                 self.video_filename,
                 cv2.VideoWriter_fourcc("M", "J", "P", "G"),
@@ -568,391 +632,466 @@ class VehicleTracking(object):
                 (1784, 540),
             )
 
-        flag1 = True
-        flag2 = True
+        self._dayfiles_flag = True
+        self._hourfiles_flag = True
 
-        tik1 = time.time()
-        while True:
-            tik2 = time.time()
+        self._postprocess_tik = time.time()
 
-            date = datetime.datetime.now()
-            date = date.strftime("%d_%m_%Y_%H:%M:%S")
+    def _rotate_outputs(self):
+        date = datetime.datetime.now()
+        date = date.strftime("%d_%m_%Y_%H:%M:%S")
 
-            if videodeletion_initialization_day == date[:10]:
-                flag_videodeletion = True
+        if self._videodeletion_initialization_day == date[:10]:
+            self._flag_videodeletion = True
 
-            if date[11:16] == "00:00":
-                if flag1:
-                    self._cc_writer()
+        if date[11:16] == "00:00":
+            if self._dayfiles_flag:
+                self._cc_writer()
 
-                    t1 = threading.Thread(
-                        target=self._daily_filewriter_plotter,
-                        kwargs={"output_path": currentday_dir},
-                    )
-                    t1.start()
+                t1 = threading.Thread(
+                    target=self._daily_filewriter_plotter,
+                    kwargs={"output_path": self.currentday_dir},
+                )
+                t1.start()
 
-                    if self.output and flag_videodeletion:
-                        self.videowriter.release()
+                if self.output and self._flag_videodeletion:
+                    self.videowriter.release()
 
-                        output_path = f"outputs/{self.camera_id}/{videodeletion_day.strftime('%d_%m_%Y')}/"
-                        t2 = threading.Thread(
-                            target=self._delete_oneday_videos,
-                            kwargs={"output_path": output_path},
-                        )
-                        t2.start()
+                    output_path = f"outputs/{self.camera_id}/{self._videodeletion_day.strftime('%d_%m_%Y')}/"
+                    t2 = threading.Thread(
+                        target=self._delete_oneday_videos,
+                        kwargs={"output_path": output_path},
+                    )
+                    t2.start()
 
-                        videodeletion_day += datetime.timedelta(days=1)
+                    self._videodeletion_day += datetime.timedelta(days=1)
 
-                    currentday_dir = f"outputs/{self.camera_id}/{date[:10]}/"
-                    if not os.path.exists(currentday_dir):
-                        os.mkdir(currentday_dir)
+                self.currentday_dir = f"outputs/{self.camera_id}/{date[:10]}/"
+                if not os.path.exists(self.currentday_dir):
+                    os.mkdir(self.currentday_dir)
 
-                    self.error_filewriter.close()
-                    error_filename = currentday_dir + date[:10] + f"_log.txt"
-                    self.error_filewriter = open(error_filename, "w")
+                self.error_filewriter.close()
+                error_filename = self.currentday_dir + date[:10] + f"_log.txt"
+                self.error_filewriter = open(error_filename, "w")
 
-                    self.tracker.next_objid = 0
-                    self.logged_ids = []
+                self.tracker.next_objid = 0
+                self.logged_ids = []
 
-                    flag1 = False
+                self._dayfiles_flag = False
 
-            else:
-                flag1 = True
+        else:
+            self._dayfiles_flag = True
 
-            if date[14:16] == "00":
-                if flag2:
-                    if flag1:
-                        self._cc_writer()
+        if date[14:16] == "00":
+            if self._hourfiles_flag:
+                if self._dayfiles_flag:
+                    self._cc_writer()
 
-                    t3 = threading.Thread(
-                        target=self._hourly_plotter,
-                        kwargs={"output_path": currenthour_dir},
-                    )
-                    t3.start()
+                t3 = threading.Thread(
+                    target=self._hourly_plotter,
+                    kwargs={"output_path": self.currenthour_dir},
+                )
+                t3.start()
 
-                    self.wrongdir_count = 0
-                    self.img_for_text = cv2.imread("right_image.jpg")
+                self.wrongdir_count = 0
+                self.img_for_text = cv2.imread("right_image.jpg")
 
-                    currenthour_dir = currentday_dir + date[11:13] + "/"
-                    if not os.path.exists(currenthour_dir):
-                        os.mkdir(currenthour_dir)
+                self.currenthour_dir = self.currentday_dir + date[11:13] + "/"
+                if not os.path.exists(self.currenthour_dir):
+                    os.mkdir(self.currenthour_dir)
 
-                    currenthour_devdir = currenthour_dir + "dev/"
-                    if not os.path.exists(currenthour_devdir):
-                        os.mkdir(currenthour_devdir)
+                currenthour_devdir = self.currenthour_dir + "dev/"
+                if not os.path.exists(currenthour_devdir):
+                    os.mkdir(currenthour_devdir)
 
-                    self.dev_cvutil_filewriter.close()
-                    dev_cvutil_filename = currenthour_devdir + "cv.txt"
-                    self.dev_cvutil_filewriter = open(dev_cvutil_filename, "w")
+                self.dev_cvutil_filewriter.close()
+                dev_cvutil_filename = currenthour_devdir + "cv.txt"
+                self.dev_cvutil_filewriter = open(dev_cvutil_filename, "w")
 
-                    log_filename = currenthour_dir + date[11:13] + ".txt"
-                    self.log_filewriter = open(log_filename, "w")
+                log_filename = self.currenthour_dir + date[11:13] + ".txt"
+                self.log_filewriter = open(log_filename, "w")
 
-                    trackpath_filename = currenthour_dir + date[11:13] + f"_trkpath.txt"
-                    self.tracker.trackpath_filewriter = open(trackpath_filename, "w")
+                trackpath_filename = self.currenthour_dir + date[11:13] + f"_trkpath.txt"
+                self.tracker.trackpath_filewriter = open(trackpath_filename, "w")
 
-                    cc_filename = currenthour_dir + date[11:13] + "_finalcounts.txt"
-                    self.cc_filewriter = open(cc_filename, "w")
+                cc_filename = self.currenthour_dir + date[11:13] + "_finalcounts.txt"
+                self.cc_filewriter = open(cc_filename, "w")
 
-                    if self.output:
-                        compressed_file_name = (
-                            self.video_filename.split(".")[0] + "_comp.avi"
-                        )
-                        t4 = threading.Thread(
-                            target=self._compress_video,
-                            args=(self.video_filename, compressed_file_name, True),
-                        )
-                        t4.start()
-
-                        self.video_filename = currenthour_dir + date[11:13] + ".avi"
-                        self.videowriter = cv2.VideoWriter(
-                            self.video_filename,
-                            cv2.VideoWriter_fourcc("M", "J", "P", "G"),
-                            self.output_fps,
-                            (1784, 540),
-                        )
+                if self.output:
+                    compressed_file_name = (
+                        self.video_filename.split(".")[0] + "_comp.avi"
+                    )
+                    t4 = threading.Thread(
+                        target=self._compress_video,
+                        args=(self.video_filename, compressed_file_name, True),
+                    )
+                    t4.start()
+
+                    self.video_filename = self.currenthour_dir + date[11:13] + ".avi"
+                    self.videowriter = cv2.VideoWriter(
+                        self.video_filename,
+                        cv2.VideoWriter_fourcc("M", "J", "P", "G"),
+                        self.output_fps,
+                        (1784, 540),
+                    )
 
-                    msg = f"\n-------initialized new files for the hour-------{date}\n"
-                    self.error_filewriter.write(msg)
-                    print(msg)
+                msg = f"\n-------initialized new files for the hour-------{date}\n"
+                self.error_filewriter.write(msg)
+                print(msg)
 
-                    flag2 = False
-            else:
-                flag2 = True
+                self._hourfiles_flag = False
+        else:
+            self._hourfiles_flag = True
 
-            if self.tilldetection_queue.qsize() > 0:
-                (
-                    detection_list,
-                    axles,
-                    frame,
-                    frame_count,
-                    fps_list,
-                ) = self.tilldetection_queue.get()
+    def _postprocess_frame(self, item):
+        tik2 = time.time()
+        self._rotate_outputs()
 
-                tracked_objects = self.tracker.update(detection_list)
+        slot, detections, frame_count, fps_list = item
+        frame = self.frame_ring[slot]
 
-                self._count_vehicles(tracked_objects)
-                self._axle_assignments(tracked_objects, axles)
+        if detections is None:
+            # the motion gate skipped detection on this frame
+            tracked_objects = self.tracker.predict()
+            detections = Detections.empty([])
+        else:
+            tracked_objects = self.tracker.update(detections)
 
-                self._log(tracked_objects)
+        self._count_vehicles(tracked_objects)
+        self._axle_assignments(tracked_objects, detections)
 
-                draw_tracked_objects(self, frame, tracked_objects)
+        self._log(tracked_objects)
 
-                if self.mode == "debug":
-                    for l in ["leftlane", "rightlane"]:
-                        cv2.polylines(
-                            frame,
-                            [self.camera_meta[f"{l}_coords"]],
-                            isClosed=True,
-                            color=(0, 0, 0),
-                            thickness=2,
-                        )
-                        cv2.circle(
-                            frame,
-                            self.camera_meta[f"{l}_ref"],
-                            radius=4,
-                            color=(0, 0, 255),
-                            thickness=-1,
-                        )
+        draw_tracked_objects(self, frame, tracked_objects)
 
-                    pt = self.camera_meta["mid_ref"]
-                    cv2.line(frame, (pt, frame.shape[0]), (pt, 0), (0, 0, 255), 2)
+        if self.mode == "debug":
+            for l in ["leftlane", "rightlane"]:
+                cv2.polylines(
+                    frame,
+                    [self.camera_meta[f"{l}_coords"]],
+                    isClosed=True,
+                    color=(0, 0, 0),
+                    thickness=2,
+                )
+                cv2.circle(
+                    frame,
+                    self.camera_meta[f"{l}_ref"],
+                    radius=4,
+                    color=(0, 0, 255),
+                    thickness=-1,
+                )
 
-                    pt = self.camera_meta["adaptive_countintervals"][
-                        "3t,4t,5t,6t,lgv,tractr,2t,bus,mb"
-                    ]
-                    cv2.line(
-                        frame, (pt[0], frame.shape[0]), (pt[0], 0), (255, 255, 255), 2
-                    )
-                    cv2.line(
-                        frame, (pt[1], frame.shape[0]), (pt[1], 0), (255, 255, 255), 2
-                    )
+            pt = self.camera_meta["mid_ref"]
+            cv2.line(frame, (pt, frame.shape[0]), (pt, 0), (0, 0, 255), 2)
 
-                    pt = self.camera_meta["adaptive_countintervals"]["ml,car,auto"]
-                    cv2.line(frame, (pt[0], frame.shape[0]), (pt[0], 0), (0, 255, 0), 2)
-                    cv2.line(frame, (pt[1], frame.shape[0]), (pt[1], 0), (0, 255, 0), 2)
+            pt = self.camera_meta["adaptive_countintervals"][
+                "3t,4t,5t,6t,lgv,tractr,2t,bus,mb"
+            ]
+            cv2.line(
+                frame, (pt[0], frame.shape[0]), (pt[0], 0), (255, 255, 255), 2
+            )
+            cv2.line(
+                frame, (pt[1], frame.shape[0]), (pt[1], 0), (255, 255, 255), 2
+            )
 
-                    pt = self.camera_meta["adaptive_countintervals"]["tw"]
-                    cv2.line(frame, (pt[0], frame.shape[0]), (pt[0], 0), (255, 0, 0), 2)
-                    cv2.line(frame, (pt[1], frame.shape[0]), (pt[1], 0), (255, 0, 0), 2)
+            pt = self.camera_meta["adaptive_countintervals"]["ml,car,auto"]
+            cv2.line(frame, (pt[0], frame.shape[0]), (pt[0], 0), (0, 255, 0), 2)
+            cv2.line(frame, (pt[1], frame.shape[0]), (pt[1], 0), (0, 255, 0), 2)
 
-                    draw_axles(frame, axles)
+            pt = self.camera_meta["adaptive_countintervals"]["tw"]
+            cv2.line(frame, (pt[0], frame.shape[0]), (pt[0], 0), (255, 0, 0), 2)
+            cv2.line(frame, (pt[1], frame.shape[0]), (pt[1], 0), (255, 0, 0), 2)
 
-                for name, xcoord in zip(
-                    ["Class", "Lane-1", "Lane-2", "Total"], [15, 150, 250, 350]
-                ):
-                    draw_text_with_backgroud(
-                        self.img_for_text,
-                        name,
-                        x=xcoord,
-                        y=150,
-                        font_scale=0.6,
-                        thickness=2,
-                    )
+            draw_axles(frame, detections.axle_list())
 
-                y = 180
-                vehicles_lane1 = 0
-                vehicles_lane2 = 0
-                for (k1, v1), (_, v2) in zip(
-                    self.class_counts["1"].items(), self.class_counts["2"].items()
-                ):
-                    vehicles_lane1 += v1
-                    vehicles_lane2 += v2
-
-                    for name, xcoord, bg in zip(
-                        [Abbrevation_Mapper[k1], str(v1), str(v2), str(v1 + v2)],
-                        [15, 175, 275, 375],
-                        (None, (246, 231, 215), (242, 226, 209), (241, 222, 201)),
-                    ):
-
-                        draw_text_with_backgroud(
-                            self.img_for_text,
-                            name,
-                            x=xcoord,
-                            y=y,
-                            font_scale=0.5,
-                            thickness=1,
-                            background=bg,
-                        )
+        for name, xcoord in zip(
+            ["Class", "Lane-1", "Lane-2", "Total"], [15, 150, 250, 350]
+        ):
+            draw_text_with_backgroud(
+                self.img_for_text,
+                name,
+                x=xcoord,
+                y=150,
+                font_scale=0.6,
+                thickness=2,
+            )
 
-                    y += 20
-
-                y += 20
-                for name, xcoord, bg in zip(
-                    [
-                        "Total",
-                        str(vehicles_lane1),
-                        str(vehicles_lane2),
-                        str(vehicles_lane1 + vehicles_lane2),
-                    ],
-                    [15, 175, 275, 375],
-                    (None, (246, 231, 215), (242, 226, 209), (241, 222, 201)),
-                ):
+        y = 180
+        vehicles_lane1 = 0
+        vehicles_lane2 = 0
+        for (k1, v1), (_, v2) in zip(
+            self.class_counts["1"].items(), self.class_counts["2"].items()
+        ):
+            vehicles_lane1 += v1
+            vehicles_lane2 += v2
 
-                    draw_text_with_backgroud(
-                        self.img_for_text,
-                        name,
-                        x=xcoord,
-                        y=y,
-                        font_scale=0.55,
-                        thickness=2,
-                        background=bg,
-                    )
+            for name, xcoord, bg in zip(
+                [Abbrevation_Mapper[k1], str(v1), str(v2), str(v1 + v2)],
+                [15, 175, 275, 375],
+                (None, (246, 231, 215), (242, 226, 209), (241, 222, 201)),
+            ):
 
                 draw_text_with_backgroud(
                     self.img_for_text,
-                    f"WD : {self.wrongdir_count}",
-                    x=15,
-                    y=500,
-                    font_scale=0.6,
-                    thickness=2,
-                    background=(242, 226, 209),
-                )
-
-                if self.mode != "debug":
-                    for name in ["Lane 1", "Lane 2"]:
-                        k = name + " annotation_data"
-                        txt = name + " : "
-
-                        if name == "Lane 1":
-                            txt += str(vehicles_lane1)
-                        else:
-                            txt += str(vehicles_lane2)
-
-                        cv2.line(
-                            frame,
-                            self.camera_meta[k][0],
-                            self.camera_meta[k][1],
-                            (128, 0, 128),
-                            2,
-                        )
-                        cv2.line(
-                            frame,
-                            self.camera_meta[k][1],
-                            self.camera_meta[k][2],
-                            (128, 0, 128),
-                            2,
-                        )
-                        draw_text_with_backgroud(
-                            frame,
-                            txt,
-                            x=self.camera_meta[k][3],
-                            y=self.camera_meta[k][4],
-                            font_scale=0.7,
-                            thickness=1,
-                            background=(128, 0, 128),
-                            foreground=(255, 255, 255),
-                            box_coords_1=(-7, 7),
-                            box_coords_2=(10, -10),
-                        )
-
-                draw_text_with_backgroud(
-                    self.img_for_log,
-                    f"Frame count: {frame_count}",
-                    x=15,
-                    y=460,
+                    name,
+                    x=xcoord,
+                    y=y,
                     font_scale=0.5,
                     thickness=1,
+                    background=bg,
                 )
 
-                draw_text_with_backgroud(
-                    self.img_for_log,
-                    f"Curr FPS: {fps_list[0][0]}",
-                    x=15,
-                    y=480,
-                    font_scale=0.5,
-                    thickness=1,
-                )
+            y += 20
+
+        y += 20
+        for name, xcoord, bg in zip(
+            [
+                "Total",
+                str(vehicles_lane1),
+                str(vehicles_lane2),
+                str(vehicles_lane1 + vehicles_lane2),
+            ],
+            [15, 175, 275, 375],
+            (None, (246, 231, 215), (242, 226, 209), (241, 222, 201)),
+        ):
+
+            draw_text_with_backgroud(
+                self.img_for_text,
+                name,
+                x=xcoord,
+                y=y,
+                font_scale=0.55,
+                thickness=2,
+                background=bg,
+            )
+
+        draw_text_with_backgroud(
+            self.img_for_text,
+            f"WD : {self.wrongdir_count}",
+            x=15,
+            y=500,
+            font_scale=0.6,
+            thickness=2,
+            background=(242, 226, 209),
+        )
+
+        if self.mode != "debug":
+            for name in ["Lane 1", "Lane 2"]:
+                k = name + " annotation_data"
+                txt = name + " : "
+
+                if name == "Lane 1":
+                    txt += str(vehicles_lane1)
+                else:
+                    txt += str(vehicles_lane2)
 
+                cv2.line(
+                    frame,
+                    self.camera_meta[k][0],
+                    self.camera_meta[k][1],
+                    (128, 0, 128),
+                    2,
+                )
+                cv2.line(
+                    frame,
+                    self.camera_meta[k][1],
+                    self.camera_meta[k][2],
+                    (128, 0, 128),
+                    2,
+                )
                 draw_text_with_backgroud(
-                    self.img_for_log,
-                    f"Avg FPS: {fps_list[0][1]}",
-                    x=15,
-                    y=500,
-                    font_scale=0.5,
+                    frame,
+                    txt,
+                    x=self.camera_meta[k][3],
+                    y=self.camera_meta[k][4],
+                    font_scale=0.7,
                     thickness=1,
+                    background=(128, 0, 128),
+                    foreground=(255, 255, 255),
+                    box_coords_1=(-7, 7),
+                    box_coords_2=(10, -10),
                 )
 
-                out_frame = np.hstack((self.img_for_log, frame, self.img_for_text))
-                cv2.imshow(f"ATCC-APEL, Towards {self.camera_id}", out_frame)
+        draw_text_with_backgroud(
+            self.img_for_log,
+            f"Frame count: {frame_count}",
+            x=15,
+            y=460,
+            font_scale=0.5,
+            thickness=1,
+        )
 
-                if self.output:
-                    self.videowriter.write(out_frame)
+        draw_text_with_backgroud(
+            self.img_for_log,
+            f"Curr FPS: {fps_list[0][0]}",
+            x=15,
+            y=480,
+            font_scale=0.5,
+            thickness=1,
+        )
 
-                key = cv2.waitKey(1)
-                if key == ord("q"):
-                    vidcap_status.value = 0
+        draw_text_with_backgroud(
+            self.img_for_log,
+            f"Avg FPS: {fps_list[0][1]}",
+            x=15,
+            y=500,
+            font_scale=0.5,
+            thickness=1,
+        )
 
-                if (
-                    not vidcap_status.value
-                    and self.tilldetection_queue.qsize() == 0
-                    and self.preprocessedframes_queue.qsize() == 0
-                ):
-                    break
+        out_frame = np.hstack((self.img_for_log, frame, self.img_for_text))
+        cv2.imshow(f"ATCC-APEL, Towards {self.camera_id}", out_frame)
 
-                tok = time.time()
-                avg_fps = round(frame_count / (tok - tik1), 2)
-                inst_fps = round(1.0 / (tok - tik2), 1)
-                fps_list.append((inst_fps, avg_fps))
+        if self.output:
+            self.videowriter.write(out_frame)
 
-                print(frame_count, end=" ; ")
-                for n, v in zip(["inp", "det", "pp"], fps_list):
-                    print(f"{n}-fps: {v[0]}, {v[1]}", end=" ; ")
-                print(
-                    f"qsize: {self.tilldetection_queue.qsize()}, {self.preprocessedframes_queue.qsize()}"
-                )
+        self.frame_ring.release(slot)
 
-            if (
-                not vidcap_status.value
-                and self.input_path.startswith("inputs")
-                and self.tilldetection_queue.qsize() == 0
-                and self.preprocessedframes_queue.qsize() == 0
-            ):
-                break
+        key = cv2.waitKey(1)
+        if key == ord("q"):
+            self.stop_event.set()
+
+        tok = time.time()
+        avg_fps = round(frame_count / (tok - self._postprocess_tik), 2)
+        inst_fps = round(1.0 / (tok - tik2), 1)
+        fps_list.append((inst_fps, avg_fps))
+
+        print(frame_count, end=" ; ")
+        for n, v in zip(["inp", "det", "pp"], fps_list):
+            print(f"{n}-fps: {v[0]}, {v[1]}", end=" ; ")
+        print(
+            f"qsize: {self.tilldetection_queue.qsize()}, {self.preprocessedframes_queue.qsize()}",
+            end=" ; ",
+        )
+        print(
+            f"dropped: {self.preprocessedframes_queue.dropped}, {self.tilldetection_queue.dropped}"
+        )
+
+    def _postprocess_detections(self):
+        StageWorker(
+            self.tilldetection_queue,
+            self._postprocess_frame,
+            setup=self._init_outputs,
+            on_idle=self._rotate_outputs,
+            teardown=lambda: self._clean_exit(
+                self.currenthour_dir, self.currentday_dir
+            ),
+        ).run()
 
-        self._clean_exit(currenthour_dir, currentday_dir)
         print("Exiting Process-2 !")
 
-    def _do_detection(self):
-        if self.inference_type == "trt":
-            from detectors.trt_detector import TrtYoloDetector
+    def _init_detector(self):
+        if self.inference_type == "replay":
+            backend_kwargs = {
+                "cache_path": detection_cache_path(self.camera_id, self.input_path),
+                "source": self.input_path,
+            }
+        elif self.inference_type == "synthetic":
+            backend_kwargs = {
+                "camera_meta": self.camera_meta,
+                "num_vehicles": self.synthetic_vehicles,
+                "dropout": self.synthetic_dropout,
+                "jitter": 1.5,
+            }
+        else:
+            backend_kwargs = {"lane_roi": self.lane_roi}
+            if self.farfield:
+                backend_kwargs["farfield_roi"] = self.camera_meta["farfield_roi"]
+            if self.inference_type == "opencv":
+                backend_kwargs.update(num_threads=self.num_threads, fp16=self.fp16)
+
+        self.detector = load_detector(
+            self.inference_type,
+            self.initial_frame,
+            self.lane_detector,
+            self.detection_thresh,
+            batch_size=self.batch_size,
+            **backend_kwargs,
+        )
+
+        if self.farfield and "farfield_roi" in backend_kwargs:
+            print("Per tile cost (ms) :", self.detector.profile_tiles(self.initial_frame))
 
-            self.detector = TrtYoloDetector(
-                self.initial_frame,
-                self.lane_detector,
-                self.detection_thresh,
+        if self.record and self.inference_type != "replay":
+            self.detector.start_recording(
+                detection_cache_path(self.camera_id, self.input_path), self.input_path
             )
+
+        self.motion_gate = None
+        if self.use_motion_gate:
+            self.motion_gate = MotionGate(self.lane_detector, self.initial_frame.shape)
+
+        self._detection_tik = time.time()
+
+    def _detect_frame(self, item):
+        return self._detect_frames([item])[0]
+
+    def _detect_frames(self, items):
+        # frames let through by the motion gate go through the network in one
+        # forward pass, the others are sent on without detections
+        tik2 = time.time()
+        frames = [self.frame_ring[slot] for slot, _, _ in items]
+
+        if self.motion_gate is None:
+            moving, forced = [True] * len(items), [False] * len(items)
         else:
-            self.detector = VanillaYoloDetector(
-                self.initial_frame,
-                self.lane_detector,
-                self.detection_thresh,
+            moving, forced = [], []
+            for frame in frames:
+                moving.append(self.motion_gate(frame))
+                forced.append(self.motion_gate.forced)
+
+        batch_detections = iter(
+            self.detector.detect_batch(
+                [frame for frame, m in zip(frames, moving) if m],
+                frame_ids=[item[1] for item, m in zip(items, moving) if m],
             )
+            if any(moving)
+            else []
+        )
 
-        tik1 = time.time()
-        while True:
-            if self.preprocessedframes_queue.qsize() > 0:
-                tik2 = time.time()
-                frame, frame_count, fps_list = self.preprocessedframes_queue.get()
-                detection_list, axles = self.detector.detect(frame)
-
-                tok = time.time()
-                avg_fps = round(frame_count / (tok - tik1), 2)
-                inst_fps = round(1.0 / (tok - tik2), 1)
-                fps_list.append((inst_fps, avg_fps))
-
-                self.tilldetection_queue.put(
-                    (detection_list, axles, frame, frame_count, fps_list)
-                )
+        tok = time.time()
+        inst_fps = round(len(items) / (tok - tik2), 1)
+
+        results = []
+        for (slot, frame_count, fps_list), m, f in zip(items, moving, forced):
+            detections = None
+            if m:
+                detections = next(batch_detections)
+                if self.motion_gate is not None:
+                    self.motion_gate.audit(len(detections), f)
+
+            avg_fps = round(frame_count / (tok - self._detection_tik), 2)
+            fps_list.append((inst_fps, avg_fps))
+            results.append((slot, detections, frame_count, fps_list))
+
+            if self.motion_gate is not None and frame_count % 1000 == 0:
+                print(self.motion_gate.report())
+
+        return results
+
+    def _close_detector(self):
+        self.detector.stop_recording()
+
+        if self.motion_gate is not None:
+            print(self.motion_gate.report())
+
+    def _do_detection(self):
+        StageWorker(
+            self.preprocessedframes_queue,
+            self._detect_frame if self.batch_size == 1 else self._detect_frames,
+            self.tilldetection_queue,
+            setup=self._init_detector,
+            teardown=self._close_detector,
+            batch_size=self.batch_size,
+        ).run()
 
     def run(self):
         frame_count = 0
-        vidcap_status = Value("i", 1)
 
         process1 = Process(target=self._do_detection)
         process1.start()
 
-        process2 = Process(target=self._postprocess_detections, args=(vidcap_status,))
+        process2 = Process(target=self._postprocess_detections)
         process2.start()
 
         with open(f"pid_{self.camera_id}.txt", "w") as f:
@@ -962,76 +1101,70 @@ class VehicleTracking(object):
 
         tik1 = time.time()
 
-        while self.vidcap.isOpened():
+        while self.vidcap.isOpened() and not self.stop_event.is_set():
             tik2 = time.time()
-            vidcap_status.value, frame = self.vidcap.read()
+            status, frame = self.vidcap.read()
 
-            while not vidcap_status.value:
-                if self.input_path.startswith("rtsp"):
-                    msg = f"RTSP_Error : {datetime.datetime.now()} : Unable to capture frames !"
-                    print(msg)
+            while not status and self.input_path.startswith("rtsp"):
+                msg = f"RTSP_Error : {datetime.datetime.now()} : Unable to capture frames !"
+                print(msg)
 
-                    self.vidcap.release()
-                    time.sleep(1)
+                self.vidcap.release()
+                time.sleep(1)
 
-                    self.vidcap = cv2.VideoCapture(self.input_path)
-                    vidcap_status.value, frame = self.vidcap.read()
-                else:
-                    if not process2.is_alive():
-                        process1.terminate()
+                self.vidcap = cv2.VideoCapture(self.input_path)
+                status, frame = self.vidcap.read()
 
-                    if not process1.is_alive():
-                        self.vidcap.release()
-                        cv2.destroyAllWindows()
-                        sys.exit()
+            if not status:
+                break
 
             frame_count += 1
 
-            frame = cv2.resize(
+            slot = None
+            while slot is None and process2.is_alive():
+                slot = self.frame_ring.acquire(timeout=1)
+
+            if slot is None:
+                break
+
+            cv2.resize(
                 frame,
                 dsize=(self.frame_w, self.frame_h),
+                dst=self.frame_ring[slot],
                 interpolation=cv2.INTER_LINEAR,
             )
 
             if self.input_path.startswith("rtsp"):
                 key = cv2.waitKey(1)
-            else:
+            elif self.inference_type != "replay":
+                # paces a video file at about its frame rate, replay runs flat out
                 key = cv2.waitKey(25)
 
             tok = time.time()
             avg_fps = round(frame_count / (tok - tik1), 2)
             inst_fps = round(1.0 / (tok - tik2), 1)
 
-            self.preprocessedframes_queue.put(
-                (frame, frame_count, [(inst_fps, avg_fps)])
-            )
-
-            if (
-                self.preprocessedframes_queue.qsize() > 1500
-                or self.tilldetection_queue.qsize() > 1500
+            if not put_while_alive(
+                self.preprocessedframes_queue,
+                (slot, frame_count, [(inst_fps, avg_fps)]),
+                process1,
             ):
-                print(
-                    f"queue overflow ! , qsize: {self.preprocessedframes_queue.qsize()}, {self.tilldetection_queue.qsize()}"
-                )
-                process1.terminate()
-                process2.terminate()
-                self.vidcap.release()
-                cv2.destroyAllWindows()
-                print("Now press Ctrl+C to exit...")
-
-            if not vidcap_status.value and process2.is_alive():
-                while process2.is_alive():
-                    continue
+                self.frame_ring.release(slot)
+                break
 
-                process1.terminate()
-                print("Terminated Process-1")
+        # the stop sentinel travels behind the last frame, every stage drains its
+        # queue, forwards it and exits. A detection process which died never sends
+        # it on, so then it goes straight to postprocessing.
+        if not put_while_alive(self.preprocessedframes_queue, StopStage(), process1):
+            print("Detection process died, stopping postprocessing !")
+            put_while_alive(self.tilldetection_queue, StopStage(), process2)
 
-            if not process1.is_alive():
-                break
+        process1.join()
+        process2.join()
 
         self.vidcap.release()
+        self.frame_ring.close(unlink=True)
         cv2.destroyAllWindows()
-        print("Now press Ctrl+C to exit...")
 
 
 if __name__ == "__main__":
@@ -1052,7 +1185,7 @@ if __name__ == "__main__":
         type=str,
         required=False,
         default="trt",
-        choices=["vanilla", "trt"],
+        choices=["vanilla", "trt", "opencv", "replay", "synthetic"],
         help="type pf inference",
     )
 
@@ -1133,8 +1266,133 @@ if __name__ == "__main__":
         help="execution mode, either `debug`, `release`, `pretty`",
     )
 
+    ap.add_argument(
+        "-qs",
+        "--queue_size",
+        type=int,
+        required=False,
+        default=32,
+        help="maximum frames waiting between two stages",
+    )
+
+    ap.add_argument(
+        "-qp",
+        "--queue_policy",
+        type=str,
+        required=False,
+        default="block",
+        choices=QUEUE_POLICIES,
+        help="what to do when a stage queue is full, `drop-oldest` or `latest-only` are preferred for rtsp",
+    )
+
+    ap.add_argument(
+        "-bs",
+        "--batch_size",
+        type=int,
+        required=False,
+        default=1,
+        help="maximum queued frames detected in one forward pass",
+    )
+
+    ap.add_argument(
+        "-nt",
+        "--num_threads",
+        type=int,
+        required=False,
+        default=None,
+        help="cpu threads for `opencv` inference, default is all",
+    )
+
+    ap.add_argument(
+        "-fp16",
+        "--fp16",
+        type=int,
+        required=False,
+        default=0,
+        help="whether `opencv` inference runs in FP16 on cpu, needs opencv >= 4.9",
+    )
+
+    ap.add_argument(
+        "-rec",
+        "--record",
+        type=int,
+        required=False,
+        default=0,
+        help="whether to record raw detections, to rerun the clip later with `-if replay`",
+    )
+
+    ap.add_argument(
+        "-roi",
+        "--lane_roi",
+        type=int,
+        required=False,
+        default=0,
+        help="whether to crop frames to the lanes before detection, more pixels per vehicle",
+    )
+
+    ap.add_argument(
+        "-ff",
+        "--farfield",
+        type=int,
+        required=False,
+        default=0,
+        help="whether to detect the camera's far field again as an extra high resolution tile",
+    )
+
+    ap.add_argument(
+        "-sv",
+        "--synthetic_vehicles",
+        type=int,
+        required=False,
+        default=100,
+        help="vehicles on the road for `synthetic` inference",
+    )
+
+    ap.add_argument(
+        "-sdo",
+        "--synthetic_dropout",
+        type=float,
+        required=False,
+        default=0.0,
+        help="chance a vehicle is missed in a frame for `synthetic` inference",
+    )
+
+    ap.add_argument(
+        "-mg",
+        "--motion_gate",
+        type=int,
+        required=False,
+        default=0,
+        help="whether to skip detection on frames without motion in the lanes",
+    )
+
+    ap.add_argument(
+        "-as",
+        "--association",
+        type=str,
+        required=False,
+        default="global",
+        help="one assignment over all vehicles, or one per lane with a band for lane changers "
+        "(lane is only worth it at very high vehicle counts)",
+        choices=["global", "lane"],
+    )
+
+    ap.add_argument(
+        "-cd",
+        "--candidates",
+        type=str,
+        required=False,
+        default="dense",
+        help="test every vehicle against every detection, or only nearby ones found with a grid "
+        "(kalman tracker only, only pays off in very congested scenes)",
+        choices=["dense", "grid"],
+    )
+
     args = vars(ap.parse_args())
 
+    if args["tracker"] == "centroid" and args["candidates"] != "dense":
+        ap.error("--candidates grid needs the kalman tracker")
+
     vt_obj = VehicleTracking(
         args["input"],
         args["inference"],
@@ -1147,6 +1405,19 @@ if __name__ == "__main__":
         args["max_track_points"],
         args["max_absent"],
         args["mode"],
+        args["queue_size"],
+        args["queue_policy"],
+        args["batch_size"],
+        args["num_threads"],
+        args["fp16"],
+        args["record"],
+        args["lane_roi"],
+        args["farfield"],
+        args["synthetic_vehicles"],
+        args["synthetic_dropout"],
+        args["motion_gate"],
+        args["association"],
+        args["candidates"],
     )
 
     print("\n")
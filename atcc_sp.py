@@ -12,10 +12,11 @@ from collections import deque
 from scipy.spatial import distance
 
 from camera_metadata import CAMERA_METADATA
-from detectors import VanillaYoloDetector
+from detectors import load_detector
 from trackers import CentroidTracker, KalmanTracker
 from utils import init_lane_detector, init_direction_detector
-from utils import init_within_interval, intersection_over_rect
+from utils import init_within_interval, intersection_over_rect_matrix
+from utils import detection_cache_path
 from utils import draw_text_with_backgroud, draw_tracked_objects, draw_axles
 
 
@@ -50,6 +51,15 @@ class VehicleTracking(object):
         max_track_pts,
         max_absent,
         mode,
+        num_threads,
+        fp16,
+        record,
+        lane_roi,
+        farfield,
+        synthetic_vehicles,
+        synthetic_dropout,
+        association,
+        candidates,
     ):
 
         if input_path.startswith("inputs"):
@@ -65,6 +75,15 @@ class VehicleTracking(object):
             raise ValueError("Invalid input !")
 
         self.inference_type = inference_type
+        self.num_threads = num_threads
+        self.fp16 = fp16
+        self.record = record
+        self.lane_roi = lane_roi
+        self.farfield = farfield
+        self.synthetic_vehicles = synthetic_vehicles
+        self.synthetic_dropout = synthetic_dropout
+        self.association = association
+        self.candidates = candidates
 
         self.write_db = write_db
         if self.write_db:
@@ -87,6 +106,11 @@ class VehicleTracking(object):
 
         self.camera_meta = CAMERA_METADATA[self.camera_id]
 
+        if self.farfield and "farfield_roi" not in self.camera_meta:
+            raise ValueError(
+                f"No farfield_roi for camera `{self.camera_id}` in camera_metadata.py, run without -ff !"
+            )
+
         self.resize = resize
         self.detection_thresh = detection_thresh
         self.tracker_type = tracker_type
@@ -156,17 +180,39 @@ class VehicleTracking(object):
 
         self.lane_detector = init_lane_detector(self.camera_meta)
 
-        if self.inference_type == "trt":
-            self.detector = TrtYoloDetector(
-                initial_frame,
-                self.lane_detector,
-                self.detection_thresh,
-            )
+        if self.inference_type == "replay":
+            backend_kwargs = {
+                "cache_path": detection_cache_path(self.camera_id, self.input_path),
+                "source": self.input_path,
+            }
+        elif self.inference_type == "synthetic":
+            backend_kwargs = {
+                "camera_meta": self.camera_meta,
+                "num_vehicles": self.synthetic_vehicles,
+                "dropout": self.synthetic_dropout,
+                "jitter": 1.5,
+            }
         else:
-            self.detector = VanillaYoloDetector(
-                initial_frame,
-                self.lane_detector,
-                self.detection_thresh,
+            backend_kwargs = {"lane_roi": self.lane_roi}
+            if self.farfield:
+                backend_kwargs["farfield_roi"] = self.camera_meta["farfield_roi"]
+            if self.inference_type == "opencv":
+                backend_kwargs.update(num_threads=self.num_threads, fp16=self.fp16)
+
+        self.detector = load_detector(
+            self.inference_type,
+            initial_frame,
+            self.lane_detector,
+            self.detection_thresh,
+            **backend_kwargs,
+        )
+
+        if self.farfield and "farfield_roi" in backend_kwargs:
+            print("Per tile cost (ms) :", self.detector.profile_tiles(initial_frame))
+
+        if self.record and self.inference_type != "replay":
+            self.detector.start_recording(
+                detection_cache_path(self.camera_id, self.input_path), self.input_path
             )
 
         self.img_for_text = cv2.imread("right_image.jpg")
@@ -193,6 +239,10 @@ class VehicleTracking(object):
                 lane_angles,
                 velocity_regression,
                 self.max_absent,
+                association=self.association,
+                lane_detector=self.lane_detector,
+                candidates=self.candidates,
+                max_track_pts=self.max_track_pts,
             )
         else:
             self.tracker = KalmanTracker(
@@ -202,6 +252,10 @@ class VehicleTracking(object):
                 lane_angles,
                 velocity_regression,
                 self.max_absent,
+                association=self.association,
+                lane_detector=self.lane_detector,
+                candidates=self.candidates,
+                max_track_pts=self.max_track_pts,
             )
 
     def _count_vehicles(self, tracked_objs):
@@ -269,39 +323,41 @@ class VehicleTracking(object):
 
         return axleconfig
 
-    def _axle_assignments(self, tracked_objs, axles):
-        _axles = axles.copy()
-
-        for obj in tracked_objs.values():
-            if obj.obj_class[0] in ["2t", "3t", "4t", "5t", "6t", "bus", "lgv"]:
-                obj_ax = []
-
-                temp = []
-                for ax in _axles:
-                    if intersection_over_rect(obj.rect, ax) > 0.9:
-                        obj_ax.append(ax)
-                    else:
-                        temp.append(ax)
-
-                if len(obj_ax) > 0:
-                    obj.axle_track.append(
-                        sorted(obj_ax, key=lambda x: x[0])[-1][2:]
-                    )  # adding last axle
+    def _axle_assignments(self, tracked_objs, detections):
+        objs = [
+            obj
+            for obj in tracked_objs.values()
+            if obj.obj_class[0] in ["2t", "3t", "4t", "5t", "6t", "bus", "lgv"]
+        ]
+
+        if len(objs) == 0 or len(detections.axles) == 0:
+            return
+
+        # every axle goes to the first object which contains it
+        obj_rects = [obj.rect for obj in objs]
+        contains = intersection_over_rect_matrix(obj_rects, detections.axles) > 0.9
+        owners = np.where(contains.any(axis=0), contains.argmax(axis=0), -1)
+        axles = detections.axle_list()
+
+        for row, obj in enumerate(objs):
+            obj_ax = sorted(
+                [axles[idx] for idx in np.flatnonzero(owners == row)],
+                key=lambda x: x[0],
+            )
 
-                if obj.obj_class[0] in ["3t", "4t", "5t", "6t"]:
+            if len(obj_ax) > 0:
+                obj.axle_track.append(obj_ax[-1][2:])  # adding last axle
 
-                    if len(obj_ax) > len(obj.axles):
-                        obj.axles = sorted(obj_ax, key=lambda x: x[0])
+            if obj.obj_class[0] in ["3t", "4t", "5t", "6t"]:
 
-                    if (
-                        len(obj.axles) == int(obj.obj_class[0][0])
-                        and obj.axle_config is None
-                    ):
-                        obj.axle_config = self._get_axleconfig(obj.axles)
+                if len(obj_ax) > len(obj.axles):
+                    obj.axles = obj_ax
 
-                _axles = temp
-                if len(_axles) == 0:
-                    break
+                if (
+                    len(obj.axles) == int(obj.obj_class[0][0])
+                    and obj.axle_config is None
+                ):
+                    obj.axle_config = self._get_axleconfig(obj.axles)
 
     def _log(self, tracked_objs):
         for obj in tracked_objs.values():
@@ -694,11 +750,11 @@ class VehicleTracking(object):
                 interpolation=cv2.INTER_LINEAR,
             )
 
-            detection_list, axles = self.detector.detect(frame)
-            tracked_objects = self.tracker.update(detection_list)
+            detections = self.detector.detect(frame, frame_id=frame_count)
+            tracked_objects = self.tracker.update(detections)
 
             self._count_vehicles(tracked_objects)
-            self._axle_assignments(tracked_objects, axles)
+            self._axle_assignments(tracked_objects, detections)
 
             self._log(tracked_objects)
 
@@ -738,12 +794,16 @@ class VehicleTracking(object):
                 cv2.line(frame, (pt[0], frame.shape[0]), (pt[0], 0), (255, 0, 0), 2)
                 cv2.line(frame, (pt[1], frame.shape[0]), (pt[1], 0), (255, 0, 0), 2)
 
-                draw_axles(frame, axles)
+                draw_axles(frame, detections.axle_list())
 
             if self.mode == "debug":
                 det_text = "Vanilla Yolov4"
                 if self.inference_type == "trt":
                     det_text = "Yolov4 on Tensorrt"
+                elif self.inference_type == "opencv":
+                    det_text = "Yolov4 on OpenCV CPU"
+                elif self.inference_type == "synthetic":
+                    det_text = "Synthetic vehicles"
 
                 draw_text_with_backgroud(
                     self.img_for_log,
@@ -940,7 +1000,7 @@ if __name__ == "__main__":
         type=str,
         required=False,
         default="trt",
-        choices=["vanilla", "trt"],
+        choices=["vanilla", "trt", "opencv", "replay", "synthetic"],
         help="type pf inference",
     )
 
@@ -1013,10 +1073,95 @@ if __name__ == "__main__":
         help="execution mode, either `debug`, `release`, `pretty`",
     )
 
+    ap.add_argument(
+        "-nt",
+        "--num_threads",
+        type=int,
+        required=False,
+        default=None,
+        help="cpu threads for `opencv` inference, default is all",
+    )
+
+    ap.add_argument(
+        "-fp16",
+        "--fp16",
+        type=int,
+        required=False,
+        default=0,
+        help="whether `opencv` inference runs in FP16 on cpu, needs opencv >= 4.9",
+    )
+
+    ap.add_argument(
+        "-rec",
+        "--record",
+        type=int,
+        required=False,
+        default=0,
+        help="whether to record raw detections, to rerun the clip later with `-if replay`",
+    )
+
+    ap.add_argument(
+        "-roi",
+        "--lane_roi",
+        type=int,
+        required=False,
+        default=0,
+        help="whether to crop frames to the lanes before detection, more pixels per vehicle",
+    )
+
+    ap.add_argument(
+        "-ff",
+        "--farfield",
+        type=int,
+        required=False,
+        default=0,
+        help="whether to detect the camera's far field again as an extra high resolution tile",
+    )
+
+    ap.add_argument(
+        "-sv",
+        "--synthetic_vehicles",
+        type=int,
+        required=False,
+        default=100,
+        help="vehicles on the road for `synthetic` inference",
+    )
+
+    ap.add_argument(
+        "-sdo",
+        "--synthetic_dropout",
+        type=float,
+        required=False,
+        default=0.0,
+        help="chance a vehicle is missed in a frame for `synthetic` inference",
+    )
+
+    ap.add_argument(
+        "-as",
+        "--association",
+        type=str,
+        required=False,
+        default="global",
+        help="one assignment over all vehicles, or one per lane with a band for lane changers "
+        "(lane is only worth it at very high vehicle counts)",
+        choices=["global", "lane"],
+    )
+
+    ap.add_argument(
+        "-cd",
+        "--candidates",
+        type=str,
+        required=False,
+        default="dense",
+        help="test every vehicle against every detection, or only nearby ones found with a grid "
+        "(kalman tracker only, only pays off in very congested scenes)",
+        choices=["dense", "grid"],
+    )
+
     args = vars(ap.parse_args())
 
-    if args["inference"] == "trt":
-        from detectors.trt_detector import TrtYoloDetector
+    if args["tracker"] == "centroid" and args["candidates"] != "dense":
+        ap.error("--candidates grid needs the kalman tracker")
 
     vt_obj = VehicleTracking(
         args["input"],
@@ -1029,6 +1174,15 @@ if __name__ == "__main__":
         args["max_track_points"],
         args["max_absent"],
         args["mode"],
+        args["num_threads"],
+        args["fp16"],
+        args["record"],
+        args["lane_roi"],
+        args["farfield"],
+        args["synthetic_vehicles"],
+        args["synthetic_dropout"],
+        args["association"],
+        args["candidates"],
     )
 
     print("\n\n")
@@ -0,0 +1,544 @@
+import os
+import cv2
+import time
+import argparse
+import tempfile
+import numpy as np
+
+from utils import nonmax_suppression, intersection_over_union, FramePreprocessor
+
+
+def timeit(func, repeat):
+    func()  # warmup
+
+    tik = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    tok = time.perf_counter()
+
+    return (tok - tik) / repeat * 1000
+
+
+def random_rects(num_rects, rng, frame_w=960, frame_h=540):
+    # boxes clustered like congested traffic so that nms has work to do
+    centres = rng.uniform((0, 0), (frame_w, frame_h), size=(max(num_rects // 3, 1), 2))
+    centres = centres[rng.integers(0, len(centres), num_rects)]
+    centres += rng.normal(0, 8, size=centres.shape)
+
+    sizes = rng.uniform(20, 150, size=(num_rects, 2))
+    rects = np.hstack((centres - sizes / 2, centres + sizes / 2)).astype(np.int32)
+    scores = rng.uniform(0.5, 1.0, num_rects)
+    class_ids = rng.integers(0, 13, num_rects)
+
+    return rects, scores, class_ids
+
+
+def dictlist_nonmax_suppression(detection_list: list, iou_thresh: float) -> list:
+    # the list of dicts implementation nonmax_suppression replaced, kept for comparison
+    nms_detection_list = []
+
+    detection_list = sorted(
+        detection_list, key=lambda x: x["obj_class"][1], reverse=True
+    )
+
+    while detection_list:
+        detection = detection_list.pop(0)
+        parent_rect = detection["rect"]
+
+        keep = []
+        for det in detection_list:
+            rect = det["rect"]
+
+            if intersection_over_union(parent_rect, rect) < iou_thresh:
+                keep.append(det)
+
+        detection_list = keep
+        nms_detection_list.append(detection)
+
+    return nms_detection_list
+
+
+def bench_nms(repeat):
+    rng = np.random.default_rng(0)
+
+    print(f"{'boxes':>6} {'dict-list (ms)':>15} {'numpy (ms)':>11} {'class-aware (ms)':>17} {'speedup':>8}")
+    # up to raw detector output, the opencv backend and the tile merge nms all of it
+    for num_rects in [10, 50, 200, 1000, 3000]:
+        rects, scores, class_ids = random_rects(num_rects, rng)
+        detection_list = [
+            {"rect": tuple(r), "obj_class": ["car", s], "idx": i}
+            for i, (r, s) in enumerate(zip(rects.tolist(), scores.tolist()))
+        ]
+
+        kept = [d["idx"] for d in dictlist_nonmax_suppression(detection_list, 0.6)]
+        if kept != nonmax_suppression(rects, scores, 0.6).tolist():
+            raise RuntimeError("numpy nms doesn't match the dict-list nms !")
+
+        t_dict = timeit(
+            lambda: dictlist_nonmax_suppression(detection_list, 0.6),
+            repeat if num_rects <= 200 else max(repeat // 10, 1),
+        )
+        t_numpy = timeit(lambda: nonmax_suppression(rects, scores, 0.6), repeat)
+        t_classaware = timeit(
+            lambda: nonmax_suppression(rects, scores, 0.6, class_ids), repeat
+        )
+
+        print(
+            f"{num_rects:>6} {t_dict:>15.3f} {t_numpy:>11.3f} {t_classaware:>17.3f} {t_dict / t_numpy:>7.1f}x"
+        )
+
+
+def allocating_trt_preprocess(frame, width, height):
+    # trt preprocessing before FramePreprocessor, kept for comparison
+    frame = cv2.cvtColor(frame, code=cv2.COLOR_BGR2RGB)
+    frame = cv2.resize(frame, (width, height), interpolation=cv2.INTER_LINEAR)
+    frame = np.transpose(frame, (2, 0, 1)).astype(np.float32)
+    frame = np.expand_dims(frame, axis=0)
+    frame /= 255.0
+    return np.ascontiguousarray(frame)
+
+
+def allocating_darknet_preprocess(frame, width, height):
+    # darknet preprocessing before FramePreprocessor, kept for comparison
+    frame = cv2.cvtColor(frame, code=cv2.COLOR_BGR2RGB)
+    frame = cv2.resize(frame, (width, height), interpolation=cv2.INTER_LINEAR)
+    return frame.tobytes()
+
+
+def bench_preprocess(repeat):
+    rng = np.random.default_rng(0)
+    frame = rng.integers(0, 256, (1080, 1920, 3), dtype=np.uint8)
+    width, height = 608, 608
+
+    nchw = FramePreprocessor(width, height)
+
+    # small rounding differences come from resizing before the colour swap
+    diff = np.abs(nchw(frame) - allocating_trt_preprocess(frame, width, height))
+    if diff.max() > 1.0 / 255 + 1e-6:
+        raise RuntimeError("preallocated preprocessing doesn't match the old one !")
+
+    rows = [
+        ("trt allocating", lambda: allocating_trt_preprocess(frame, width, height)),
+        ("trt preallocated", lambda: nchw(frame)),
+        ("trt background thread", lambda: nchw.submit(frame).result()),
+        ("darknet allocating", lambda: allocating_darknet_preprocess(frame, width, height)),
+        ("darknet planar", lambda: nchw(frame)),
+    ]
+
+    print(f"{'path':>22} {'ms / frame':>11}")
+    for name, func in rows:
+        print(f"{name:>22} {timeit(func, repeat):>11.3f}")
+
+    nchw.close()
+
+
+def loop_darknet_decode(dets, num, classes):
+    # darknet.detect_image's record loop before detections_to_arrays, kept for comparison
+    res = []
+    for j in range(num):
+        for i in range(classes):
+            if dets[j].prob[i] > 0:
+                b = dets[j].bbox
+                res.append((i, dets[j].prob[i], (b.x, b.y, b.w, b.h)))
+    return res
+
+
+def per_class_nms_cpu(boxes, confs, nms_thresh=0.5):
+    # TrtYoloDetector._nms_cpu before nonmax_suppression, kept for comparison
+    x1, y1, x2, y2 = boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]
+
+    areas = (x2 - x1) * (y2 - y1)
+    order = confs.argsort()[::-1]
+
+    keep = []
+    while order.size > 0:
+        idx_self = order[0]
+        idx_other = order[1:]
+
+        keep.append(idx_self)
+
+        xx1 = np.maximum(x1[idx_self], x1[idx_other])
+        yy1 = np.maximum(y1[idx_self], y1[idx_other])
+        xx2 = np.minimum(x2[idx_self], x2[idx_other])
+        yy2 = np.minimum(y2[idx_self], y2[idx_other])
+
+        w = np.maximum(0.0, xx2 - xx1)
+        h = np.maximum(0.0, yy2 - yy1)
+        inter = w * h
+
+        with np.errstate(invalid="ignore"):
+            over = inter / (areas[order[0]] + areas[order[1:]] - inter)
+
+        inds = np.where(over <= nms_thresh)[0]
+        order = order[inds + 1]
+
+    return np.array(keep, dtype=np.int64)
+
+
+def per_class_trt_decode(trt_outputs, num_classes, detection_thresh):
+    # TrtYoloDetector's decode with one _nms_cpu call per class, kept for comparison
+    box_array = trt_outputs[0].reshape(-1, 4)
+    confs = trt_outputs[1].reshape(-1, num_classes)
+
+    max_conf = np.max(confs, axis=1)
+    max_id = np.argmax(confs, axis=1)
+
+    argwhere = max_conf > detection_thresh
+    l_box_array = box_array[argwhere]
+    l_max_conf = max_conf[argwhere]
+    l_max_id = max_id[argwhere]
+
+    kept = []
+    for j in range(num_classes):
+        cls_argwhere = np.flatnonzero(l_max_id == j)
+        keep = per_class_nms_cpu(l_box_array[cls_argwhere], l_max_conf[cls_argwhere])
+        kept.append(cls_argwhere[keep])
+
+    kept = np.concatenate(kept)
+    return l_box_array[kept], l_max_conf[kept], l_max_id[kept]
+
+
+def bench_decode(repeat):
+    # trt and darknet decode + post processing on cpu, through the backend stand-ins
+    from camera_metadata import CAMERA_METADATA
+    from detectors import get_detector_class
+    from pytest import MonkeyPatch
+    from tests.support.backend_standins import install_fake_trt, install_fake_darknet
+    from tests.support.backend_standins import synthetic_source, write_fake_engine
+    from utils import init_lane_detector
+
+    frame = np.zeros((540, 960, 3), dtype=np.uint8)
+    camera_meta = CAMERA_METADATA["datlcam1"]
+    lane_detector = init_lane_detector(camera_meta)
+
+    # the stand-ins only need the files to exist, the fake engine holds its shapes
+    engine_path = os.path.join(tempfile.mkdtemp(), "fake.engine")
+    write_fake_engine(engine_path)
+
+    print(
+        f"{'vehicles':>8} {'cands':>6} {'dets':>5} {'trt per class':>14} "
+        f"{'trt decode':>11} {'trt detect':>11} {'dn loop':>8} {'dn numpy':>9} "
+        f"{'dn detect':>10}   (ms)"
+    )
+    # the stand-ins are in sys.modules for the run only
+    with MonkeyPatch.context() as monkeypatch:
+        # raw head output grows to thousands of candidates in congested scenes
+        for num_vehicles in [20, 100, 300]:
+            source = synthetic_source(frame, camera_meta, num_vehicles=num_vehicles)
+
+            install_fake_trt(monkeypatch, source)
+            trt_detector = get_detector_class("trt")(
+                frame, lane_detector, 0.5, engine_path=engine_path
+            )
+            trt_detector._preprocess(frame, 0)
+            trt_outputs = trt_detector._forward(0)
+
+            num_classes, thresh = trt_detector.num_classes, trt_detector.detection_thresh
+            # boxes clipped to zero area are suppressed by the per class decode's 0 / 0
+            # iou, they aren't compared
+            kept = [
+                sorted(
+                    (class_id, score)
+                    for box, score, class_id in zip(*[a.tolist() for a in decoded])
+                    if box[2] > box[0] and box[3] > box[1]
+                )
+                for decoded in (
+                    per_class_trt_decode(trt_outputs, num_classes, thresh),
+                    trt_detector._decode(list(trt_outputs)),
+                )
+            ]
+            if kept[0] != kept[1]:
+                raise RuntimeError("trt decode doesn't match the per class decode !")
+
+            num_candidates = int(
+                (trt_outputs[1].reshape(-1, num_classes).max(axis=1) > thresh).sum()
+            )
+
+            t_per_class = timeit(
+                lambda: per_class_trt_decode(trt_outputs, num_classes, thresh), repeat
+            )
+            t_trt_decode = timeit(
+                lambda: trt_detector._decode(list(trt_outputs)), repeat
+            )
+            t_trt_detect = timeit(lambda: trt_detector.detect(frame), repeat)
+
+            lib = install_fake_darknet(monkeypatch, source)
+            darknet_detector = get_detector_class("vanilla")(
+                frame, lane_detector, 0.5, weight_path=engine_path
+            )
+            dets, num = lib._make_detections(source(), 608, 608, 0.5)
+            lib.do_nms_sort(dets, num, darknet_detector.meta_main.classes, 0.45)
+            classes = darknet_detector.meta_main.classes
+
+            bboxes, scores, class_ids = lib.darknet.detections_to_arrays(dets, num, classes)
+            records = loop_darknet_decode(dets, num, classes)
+            if sorted(zip(class_ids.tolist(), scores.tolist())) != sorted(
+                (i, p) for i, p, _ in records
+            ):
+                raise RuntimeError("numpy darknet decode doesn't match the record loop !")
+
+            t_loop = timeit(lambda: loop_darknet_decode(dets, num, classes), repeat)
+            t_numpy = timeit(
+                lambda: lib.darknet.detections_to_arrays(dets, num, classes), repeat
+            )
+            t_darknet_detect = timeit(lambda: darknet_detector.detect(frame), repeat)
+            lib.free_detections(dets, num)
+
+            num_dets = len(trt_detector.detect(frame))
+            print(
+                f"{num_vehicles:>8} {num_candidates:>6} {num_dets:>5} {t_per_class:>14.3f} "
+                f"{t_trt_decode:>11.3f} {t_trt_detect:>11.3f} {t_loop:>8.3f} {t_numpy:>9.3f} "
+                f"{t_darknet_detect:>10.3f}"
+            )
+
+
+def per_object_kf(states, covariances, measurements):
+    # KalmanTracker's np.matrix predict + update per object before BatchedKalmanFilter,
+    # kept for comparison
+    from trackers.kalman_filter import F, H, R, Q, I
+
+    F, H, R = np.matrix(F), np.matrix(H), np.matrix(R)
+    for idx in range(len(states)):
+        x = F * np.matrix(states[idx]).T
+        P = F * np.matrix(covariances[idx]) * F.T + Q
+
+        e = np.matrix(measurements[idx]).T - H * x
+        PHT = P * H.T
+        K = PHT * np.linalg.inv(H * PHT + R)
+        x += K * e
+        IKH = I - K * H
+
+        covariances[idx] = (IKH * P * IKH.T) + (K * R * K.T)
+        states[idx] = np.trunc(x).ravel()
+
+
+def synthetic_tracking_run(camera_meta, num_vehicles, num_frames, **tracker_kwargs):
+    """KalmanTracker and `num_frames` of synthetic detections for it"""
+    import io
+    from detectors import get_detector_class
+    from trackers import KalmanTracker
+    from utils import init_lane_detector, init_direction_detector, init_within_interval
+
+    frame = np.zeros((540, 960, 3), dtype=np.uint8)
+    lane_detector = init_lane_detector(camera_meta)
+    detector = get_detector_class("synthetic")(
+        frame,
+        lane_detector,
+        0.5,
+        camera_meta=camera_meta,
+        num_vehicles=num_vehicles,
+        dropout=0.1,
+        jitter=1.0,
+    )
+
+    # the clips' velocity regressions aren't shipped, lost tracks just coast
+    lanes = ["1", "2", "3"]
+    velocity_regression = {
+        lane: {name: [[0.0, 0.0], [0.0, 0.0]] for name in detector.class_names}
+        for lane in lanes
+    }
+    lane_angles = camera_meta.get("lane_angles", {})
+    lane_angles = {lane: lane_angles.get(lane, 2.7) for lane in lanes}
+
+    tracker = KalmanTracker(
+        init_direction_detector(camera_meta),
+        camera_meta["initial_maxdistances"],
+        init_within_interval(camera_meta),
+        lane_angles,
+        velocity_regression,
+        5,
+        lane_detector=lane_detector,
+        **tracker_kwargs,
+    )
+    tracker.trackpath_filewriter = io.StringIO()
+
+    return tracker, [detector.detect(frame) for _ in range(num_frames)]
+
+
+def bench_tracker(repeat):
+    from camera_metadata import CAMERA_METADATA
+    from trackers.kalman_filter import BatchedKalmanFilter
+
+    camera_meta = CAMERA_METADATA["datlcam1"]
+    rng = np.random.default_rng(0)
+
+    print(
+        f"{'vehicles':>8} {'tracks':>7} {'kf per object':>14} {'kf batched':>11} "
+        f"{'update / frame':>15}   (ms)"
+    )
+    for num_vehicles in [20, 100, 300, 1000]:
+        tracker, frames = synthetic_tracking_run(camera_meta, num_vehicles, 60)
+
+        # the first frames only register, time the steady state
+        for detections in frames[:20]:
+            tracker.update(detections)
+
+        tik = time.perf_counter()
+        for detections in frames[20:]:
+            tracker.update(detections)
+        t_update = (time.perf_counter() - tik) / len(frames[20:]) * 1000
+
+        num_tracks = len(tracker.objects)
+        states = rng.uniform(0, 500, (num_tracks, 4))
+        covariances = np.tile(np.identity(4) * 10, (num_tracks, 1, 1))
+        measurements = states[:, [0, 2]] + rng.normal(0, 2, (num_tracks, 2))
+
+        kf = BatchedKalmanFilter()
+        for obj_id in range(num_tracks):
+            kf.add(obj_id)
+        rows = kf.rows(range(num_tracks))
+
+        def batched_kf():
+            kf.predict(rows)
+            kf.update(rows, measurements)
+
+        t_per_object = timeit(
+            lambda: per_object_kf(states.copy(), covariances.copy(), measurements),
+            max(repeat // 10, 1),
+        )
+        t_batched = timeit(batched_kf, repeat)
+
+        print(
+            f"{num_vehicles:>8} {num_tracks:>7} {t_per_object:>14.3f} {t_batched:>11.3f} "
+            f"{t_update:>15.3f}"
+        )
+
+
+def association_problem(camera_meta, num_vehicles, **tracker_kwargs):
+    """a KalmanTracker in its steady state and the detections of its next frame"""
+    tracker, frames = synthetic_tracking_run(
+        camera_meta, num_vehicles, 30, **tracker_kwargs
+    )
+    for detections in frames[:-1]:
+        tracker.update(detections)
+
+    obj_ids = list(tracker.objects.keys())
+    obj_bottoms = np.array(
+        [(tracker.objects[i].state[0], tracker.objects[i].state[2]) for i in obj_ids],
+        dtype=np.float64,
+    ).reshape(-1, 2)
+
+    return tracker, obj_ids, obj_bottoms, frames[-1]
+
+
+def bench_association(repeat):
+    from scipy.spatial import distance
+    from camera_metadata import CAMERA_METADATA
+    from trackers.association import gated_assignment
+
+    camera_meta = CAMERA_METADATA["datlcam1"]
+
+    print(
+        f"{'vehicles':>8} {'tracks':>7} {'global':>8} {'lane':>8} {'lane x3':>8} "
+        f"{'same matches':>13}   (ms)"
+    )
+    for num_vehicles in [20, 100, 300, 1000]:
+        tracker, obj_ids, obj_bottoms, detections = association_problem(
+            camera_meta, num_vehicles, association="lane", num_workers=3
+        )
+        D = distance.cdist(obj_bottoms, detections.bottoms)
+        gate = tracker._eos_gate(obj_ids, detections.bottoms)
+        pair_rows, pair_cols = np.nonzero(gate)
+
+        executor = tracker.executor
+
+        def lane(workers):
+            tracker.executor = workers
+            return tracker._associate(
+                pair_rows, pair_cols, D[gate], obj_bottoms, detections.bottoms
+            )
+
+        t_global = timeit(lambda: gated_assignment(D, gate), repeat)
+        t_lane = timeit(lambda: lane(None), repeat)
+        t_lane_threads = timeit(lambda: lane(executor), repeat)
+
+        global_matches = set(zip(*[a.tolist() for a in gated_assignment(D, gate)]))
+        lane_matches = set(zip(*[a.tolist() for a in lane(executor)]))
+        same = len(global_matches & lane_matches) / max(len(global_matches), 1)
+
+        print(
+            f"{num_vehicles:>8} {len(obj_ids):>7} {t_global:>8.3f} {t_lane:>8.3f} "
+            f"{t_lane_threads:>8.3f} {same:>13.1%}"
+        )
+
+
+def bench_grid_index(repeat):
+    from scipy.spatial import distance
+    from camera_metadata import CAMERA_METADATA
+    from trackers.association import gated_assignment, pair_assignment
+
+    camera_meta = CAMERA_METADATA["datlcam1"]
+
+    print(
+        f"{'vehicles':>8} {'tracks':>7} {'pairs dense':>12} {'pairs grid':>11} "
+        f"{'dense':>8} {'grid':>8}   (ms per frame)"
+    )
+    for num_vehicles in [20, 100, 300, 1000, 3000]:
+        tracker, obj_ids, obj_bottoms, detections = association_problem(
+            camera_meta, num_vehicles, candidates="grid"
+        )
+
+        def dense():
+            D = distance.cdist(obj_bottoms, detections.bottoms)
+            gate = tracker._eos_gate(obj_ids, detections.bottoms)
+            return gated_assignment(D, gate)
+
+        def grid():
+            pair_rows, pair_cols = tracker._eos_pairs(obj_ids, detections.bottoms)
+            d = obj_bottoms[pair_rows] - detections.bottoms[pair_cols]
+            return pair_assignment(
+                pair_rows,
+                pair_cols,
+                np.sqrt((d * d).sum(axis=1)),
+                (len(obj_ids), len(detections)),
+            )
+
+        for a, b in zip(dense(), grid()):
+            assert np.array_equal(a, b)
+
+        num_pairs = len(tracker._eos_pairs(obj_ids, detections.bottoms)[0])
+
+        print(
+            f"{num_vehicles:>8} {len(obj_ids):>7} {len(obj_ids) * len(detections):>12} "
+            f"{num_pairs:>11} {timeit(dense, repeat):>8.3f} {timeit(grid, repeat):>8.3f}"
+        )
+
+
+BENCHMARKS = {
+    "nms": bench_nms,
+    "preprocess": bench_preprocess,
+    "decode": bench_decode,
+    "tracker": bench_tracker,
+    "association": bench_association,
+    "grid": bench_grid_index,
+}
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+
+    ap.add_argument(
+        "-b",
+        "--bench",
+        type=str,
+        nargs="+",
+        required=False,
+        default=list(BENCHMARKS.keys()),
+        choices=list(BENCHMARKS.keys()),
+        help="benchmarks to run, default is all",
+    )
+
+    ap.add_argument(
+        "-r",
+        "--repeat",
+        type=int,
+        required=False,
+        default=200,
+        help="number of timed runs per measurement",
+    )
+
+    args = vars(ap.parse_args())
+
+    for name in args["bench"]:
+        print(f"\n----- {name} -----")
+        BENCHMARKS[name](args["repeat"])
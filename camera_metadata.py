@@ -16,6 +16,8 @@ CAMERA_METADATA = {
         "middlelane_ref": (878, 533),
         "rightlane_ref": (924, 467),
         "mid_ref": 250,
+        # region around the vanishing point, detected again at a higher resolution
+        "farfield_roi": (0, 90, 360, 290),
         "adaptive_countintervals": {
             "3t,4t,5t,6t,lgv,tractr,2t,bus,mb": [300, 675],
             "ml,car,auto": [275, 650],
@@ -59,6 +61,8 @@ CAMERA_METADATA = {
         "middlelane_ref": (4, 417),
         "rightlane_ref": (5, 535),
         "mid_ref": 250,
+        # region around the vanishing point, detected again at a higher resolution
+        "farfield_roi": (480, 70, 960, 250),
         "adaptive_countintervals": {
             "3t,4t,5t,6t,lgv,tractr,2t,bus,mb": [300, 675],
             "ml,car,auto": [275, 650],
@@ -31,6 +31,7 @@ from ctypes import *
 import math
 import random
 import os
+import numpy as np
 
 
 def sample(probs):
@@ -366,6 +367,66 @@ def detect_image(net, meta, im, thresh=0.5, hier_thresh=0.5, nms=0.45, debug=Fal
     return res
 
 
+# the DETECTION fields the numpy decode reads, viewed in place in darknet's array
+DETECTION_DTYPE = np.dtype(
+    {
+        "names": ["bbox", "prob"],
+        "formats": [(np.float32, 4), np.uintp],
+        "offsets": [DETECTION.bbox.offset, DETECTION.prob.offset],
+        "itemsize": sizeof(DETECTION),
+    }
+)
+
+
+def detections_to_arrays(dets, num, classes):
+    """
+    Numpy version of the record loop of detect_image. Views the DETECTION array
+    in place and gathers the class probabilities with one memmove per detection,
+    darknet allocates every prob array on its own. Returns (bboxes, scores,
+    class_ids) of every positive (detection, class) pair, bboxes as centre x, y,
+    w, h in network pixels and class_ids as indices into meta.names.
+    """
+    if num == 0:
+        return (
+            np.zeros((0, 4), dtype=np.float32),
+            np.zeros(0, dtype=np.float32),
+            np.zeros(0, dtype=np.int32),
+        )
+
+    raw = np.ctypeslib.as_array(
+        cast(dets, POINTER(c_uint8)), (num * sizeof(DETECTION),)
+    ).view(DETECTION_DTYPE)
+
+    probs = np.empty((num, classes), dtype=np.float32)
+    row_bytes = classes * sizeof(c_float)
+    base = probs.ctypes.data
+    for row, address in enumerate(raw["prob"].tolist()):
+        memmove(base + row * row_bytes, address, row_bytes)
+
+    det_idx, class_ids = np.nonzero(probs > 0)
+    return (
+        raw["bbox"][det_idx],
+        probs[det_idx, class_ids],
+        class_ids.astype(np.int32),
+    )
+
+
+def detect_image_arrays(net, meta, im, thresh=0.5, hier_thresh=0.5, nms=0.45):
+    """detect_image returning the arrays of detections_to_arrays, unsorted"""
+    num = c_int(0)
+    pnum = pointer(num)
+    predict_image(net, im)
+    dets = get_network_boxes(net, im.w, im.h, thresh, hier_thresh, None, 0, pnum, 0)
+    num = pnum[0]
+    if nms:
+        do_nms_sort(dets, num, meta.classes, nms)
+
+    try:
+        return detections_to_arrays(dets, num, meta.classes)
+    finally:
+        free_detections(dets, num)
+
+
 netMain = None
 metaMain = None
 altNames = None
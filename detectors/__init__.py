@@ -1,2 +1,3 @@
 from .base_detector import BaseDetector
-from .yolo_detector import VanillaYoloDetector
+from .registry import DETECTOR_BACKENDS, get_detector_class, load_detector
+from .detector_service import CameraStream, DetectorService
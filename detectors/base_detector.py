@@ -1,25 +1,43 @@
 import os
-import re
+import time
+import queue
+import numpy as np
 from typing import Callable
+from concurrent.futures import ThreadPoolExecutor
 
-import darknet
-import tensorrt as trt
-from utils import nonmax_suppression, intersection_over_rect
+from utils import Detections, DetectionRecorder
+from utils import nonmax_suppression, intersection_over_rect_matrix
 
 
 class BaseDetector(object):
+    # boxes are truncated to whole pixels like the trt backend always did, backends
+    # whose boxes were rounded before (darknet's) set this
+    round_boxes = False
+
     def __init__(
         self,
         initial_frame,
         lane_detector: Callable,
         detection_thresh: float,
-        bottom_type="bottom-right"
+        bottom_type="bottom-right",
+        batch_size=1,
+        lane_roi=False,
+        farfield_roi=None,
     ) -> None:
 
         self.frame_h, self.frame_w = initial_frame.shape[:2]
         self.lane_detector = lane_detector
         self.detection_thresh = detection_thresh
         self.bottom_type = bottom_type
+        self.batch_size = batch_size
+        self.lane_roi = lane_roi
+        self.farfield_roi = farfield_roi
+        self.recorder = None
+
+        # input buffers of backends split into _preprocess / _forward / _decode,
+        # two let detect_async preprocess a frame while the previous one infers
+        self.num_input_slots = 2
+        self._pipeline = None
 
         self.class_names = [
             "tw",
@@ -38,6 +56,7 @@ class BaseDetector(object):
             "axle",
         ]
         self.num_classes = len(self.class_names)
+        self.axle_id = self.class_names.index("axle")
         self.path_to_yoloweights = "yolo_stuff/"
         self.path_to_trtengine = "yolo_stuff/yolov4_1_3_608_608_fp16_static.engine"
 
@@ -61,149 +80,364 @@ class BaseDetector(object):
             else:
                 break
 
-        if self.__class__.__name__ == "TrtYoloDetector":
-            self._warmup_trt()
-        else:
-            self._warmup_yolo()
-
-    def _warmup_yolo(self):
-        weight_path = self.pathconfig_path = self.path_to_yoloweights + "yolov4.weights"
-        if not os.path.exists(weight_path):
-            raise ValueError(
-                "Invalid weight path `" + os.path.abspath(weight_path) + "`"
-            )
+        self._warmup()
 
-        meta_path = self.pathconfig_path = self.path_to_yoloweights + "obj.data"
-        if not os.path.exists(meta_path):
-            raise ValueError(
-                "Invalid data file path `" + os.path.abspath(meta_path) + "`"
-            )
-
-        self.net_main = darknet.load_net_custom(
-            self.config_path.encode("ascii"), weight_path.encode("ascii"), 0, 1
+    def _warmup(self):
+        """loads the model, called at the end of __init__"""
+        raise NotImplementedError(
+            f"_warmup function of {self.__class__.__name__} is not implemented"
         )
 
-        self.meta_main = darknet.load_meta(meta_path.encode("ascii"))
-
-        try:
-            with open(self.meta_main) as metaFH:
-                meta_contents = metaFH.read()
-
-                match = re.search(
-                    "names *= *(.*)$", meta_contents, re.IGNORECASE | re.MULTILINE
-                )
-
-                if match:
-                    result = match.group(1)
-                else:
-                    result = None
-                try:
-                    if os.path.exists(result):
-                        with open(result) as namesFH:
-                            names_list = namesFH.read().strip().split("\n")
-                            self.alt_names = [x.strip() for x in names_list]
-                except TypeError:
-                    pass
-        except Exception:
-            pass
-
-        self.darknet_image = darknet.make_image(
-            darknet.network_width(self.net_main),
-            darknet.network_height(self.net_main),
-            3,
+    def _preprocess(self, curr_frame, slot: int) -> None:
+        """writes the network input of a frame into input buffer `slot`"""
+        raise NotImplementedError(
+            f"_preprocess function of {self.__class__.__name__} is not implemented"
         )
 
-    def _warmup_trt(self):
-        TRT_LOGGER = trt.Logger(trt.Logger.Severity.ERROR)
-        print("Reading engine from file {}".format(self.path_to_trtengine))
-        with open(self.path_to_trtengine, "rb") as f, trt.Runtime(
-            TRT_LOGGER
-        ) as runtime:
-            self.engine = runtime.deserialize_cuda_engine(f.read())
-            self.context = self.engine.create_execution_context()
-
-        self.buffers = self._allocate_buffers(self.engine, 1)
-        self.context.set_binding_shape(0, (1, 3, self.yolo_height, self.yolo_width))
+    def _forward(self, slot: int):
+        """runs the network on input buffer `slot` and returns its raw outputs"""
+        raise NotImplementedError(
+            f"_forward function of {self.__class__.__name__} is not implemented"
+        )
 
-    def detect(self, curr_frame) -> list:
+    def _decode(self, outputs) -> tuple:
+        """raw network outputs -> (boxes, scores, class_ids) as returned by `_infer`"""
         raise NotImplementedError(
-            f"detect function of {self.__class__.__name__} is not implemented"
+            f"_decode function of {self.__class__.__name__} is not implemented"
         )
 
-    def _postpreprocessing(self, detections):
-        detection_list = []
-        axles = []
+    def _infer(self, curr_frame) -> tuple:
+        """
+        runs the network on a frame and returns raw (boxes, scores, class_ids) arrays,
+        boxes are normalized x1 y1 x2 y2 with respect to the frame
+        """
+        self._preprocess(curr_frame, 0)
+        return self._decode(self._forward(0))
+
+    def _infer_batch(self, frames) -> list:
+        """
+        same as `_infer` for a list of frames, backends which can't batch fall back
+        to one forward pass per frame
+        """
+        return [self._infer(frame) for frame in frames]
+
+    def _uncrop(self, raw_dets, roi, frame_shape) -> tuple:
+        # boxes normalized to the crop -> normalized to the whole frame
+        boxes, scores, class_ids = raw_dets
+        x1, y1, x2, y2 = roi
+        frame_h, frame_w = frame_shape[:2]
+
+        scale = np.array([x2 - x1, y2 - y1] * 2, dtype=np.float32)
+        offset = np.array([x1, y1] * 2, dtype=np.float32)
+        size = np.array([frame_w, frame_h] * 2, dtype=np.float32)
+
+        return (np.asarray(boxes) * scale + offset) / size, scores, class_ids
+
+    def _merge_tiles(self, tile_dets, tiles, frame_shape) -> tuple:
+        """
+        Maps detections of every tile back to the frame and merges them with one
+        class aware nms. Extra tiles drop boxes cut by their border, those vehicles
+        are big enough for the first tile.
+        """
+        boxes, scores, class_ids = [], [], []
+        for idx, (tile, (tile_boxes, tile_scores, tile_ids)) in enumerate(
+            zip(tiles, tile_dets)
+        ):
+            tile_boxes = np.asarray(tile_boxes, dtype=np.float32).reshape(-1, 4)
+
+            if idx > 0:
+                x1, y1, x2, y2 = tile
+                frame_h, frame_w = frame_shape[:2]
+                eps = np.array([2 / (x2 - x1), 2 / (y2 - y1)] * 2)
+                cut = np.array([x1 > 0, y1 > 0, x2 < frame_w, y2 < frame_h]) & (
+                    np.hstack((tile_boxes[:, :2], 1 - tile_boxes[:, 2:])) < eps
+                )
+                keep = ~cut.any(axis=1)
+                tile_boxes = tile_boxes[keep]
+                tile_scores = np.asarray(tile_scores)[keep]
+                tile_ids = np.asarray(tile_ids)[keep]
+
+            if tile is not None:
+                tile_boxes, tile_scores, tile_ids = self._uncrop(
+                    (tile_boxes, tile_scores, tile_ids), tile, frame_shape
+                )
 
-        for obj_class, obj_prob, obj_bbox in detections:
+            boxes.append(tile_boxes)
+            scores.append(np.asarray(tile_scores, dtype=np.float32))
+            class_ids.append(np.asarray(tile_ids, dtype=np.int32))
 
-            if self.__class__.__name__ == "TrtYoloDetector":
+        boxes = np.concatenate(boxes)
+        scores = np.concatenate(scores)
+        class_ids = np.concatenate(class_ids)
 
-                x1 = int(obj_bbox[0] * self.frame_w)
-                y1 = int(obj_bbox[1] * self.frame_h)
-                x2 = int(obj_bbox[2] * self.frame_w)
-                y2 = int(obj_bbox[3] * self.frame_h)
+        if len(tiles) == 1:
+            return boxes, scores, class_ids
 
-            else:
-                obj_class = str(obj_class.decode())
+        keep = nonmax_suppression(boxes, scores, 0.5, class_ids=class_ids)
+        return boxes[keep], scores[keep], class_ids[keep]
 
-                x = obj_bbox[0] * self.frame_w / self.yolo_width
-                y = obj_bbox[1] * self.frame_h / self.yolo_height
-                w = obj_bbox[2] * self.frame_w / self.yolo_width
-                h = obj_bbox[3] * self.frame_h / self.yolo_height
+    def _raw_detections(self, frames, frame_ids, tiles) -> list:
+        crops = [
+            frame if tile is None else frame[tile[1] : tile[3], tile[0] : tile[2]]
+            for frame, frame_tiles in zip(frames, tiles)
+            for tile in frame_tiles
+        ]
 
-                x1 = int(round(x - (w / 2)))
-                x2 = int(round(x + (w / 2)))
-                y1 = int(round(y - (h / 2)))
-                y2 = int(round(y + (h / 2)))
+        if len(crops) == 1:
+            crop_dets = [self._infer(crops[0])]
+        else:
+            crop_dets = self._infer_batch(crops)
+
+        raw_dets, start = [], 0
+        for frame, frame_tiles in zip(frames, tiles):
+            end = start + len(frame_tiles)
+            raw_dets.append(
+                self._merge_tiles(crop_dets[start:end], frame_tiles, frame.shape)
+            )
+            start = end
+
+        if self.recorder is not None:
+            for frame_id, frame_dets in zip(frame_ids, raw_dets):
+                self.recorder.write(frame_id, *frame_dets)
+
+        return raw_dets
+
+    def start_recording(self, path: str, source="") -> None:
+        """
+        from now on raw detections of every frame are written to `path` keyed by
+        the frame_id passed to detect, to be served back by the replay backend,
+        along with the `source` they were detected on
+        """
+        self.recorder = DetectionRecorder(path, source)
+
+    def stop_recording(self) -> None:
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+
+    def _tiles(self, frame, lane_detector) -> list:
+        """
+        regions of the frame going through the network, None for the whole frame,
+        only the part covered by the lanes with `lane_roi` and the far field again
+        at a higher resolution if `farfield_roi` is set
+        """
+        tiles = [lane_detector.roi(frame.shape) if self.lane_roi else None]
+        if self.farfield_roi is not None:
+            tiles.append(tuple(self.farfield_roi))
+        return tiles
+
+    def profile_tiles(self, frame, repeat=3) -> dict:
+        """milliseconds one forward pass of every tile of `frame` takes"""
+        costs = {}
+        for idx, tile in enumerate(self._tiles(frame, self.lane_detector)):
+            crop = frame if tile is None else frame[tile[1] : tile[3], tile[0] : tile[2]]
+            self._infer(crop)
+
+            tik = time.time()
+            for _ in range(repeat):
+                self._infer(crop)
+            costs[f"tile-{idx} {tile or 'frame'}"] = round(
+                (time.time() - tik) / repeat * 1000, 2
+            )
 
-            obj_rect = (x1, y1, x2, y2)
+        return costs
 
-            if obj_class == "axle":
-                axles.append(obj_rect)
-                continue
+    def detect(self, curr_frame, frame_id=None) -> Detections:
+        tiles = self._tiles(curr_frame, self.lane_detector)
+        return self._postpreprocessing(
+            *self._raw_detections([curr_frame], [frame_id], [tiles])[0]
+        )
 
-            if self.bottom_type == "bottom-left":
-                obj_bottom = (obj_rect[0], obj_rect[3])
-            else:
-                obj_bottom = (obj_rect[2], obj_rect[3])
-            lane = self.lane_detector(obj_bottom)
-
-            if lane is None:
-                continue
-
-            detection_list.append(
-                {
-                    "rect": obj_rect,
-                    "obj_bottom": obj_bottom,
-                    "obj_class": [obj_class, round(obj_prob, 4)],
-                    "lane": lane,
-                    "axles": [],
-                }
-            )
+    def _is_split(self) -> bool:
+        return type(self)._preprocess is not BaseDetector._preprocess
 
-        detection_list = nonmax_suppression(detection_list, 0.6)
+    def _async_preprocess(self, crop):
+        if not self._is_split():
+            return crop
 
-        _axles = axles.copy()
+        slot = self._free_slots.get()
+        self._preprocess(crop, slot)
+        return slot
 
-        for det in detection_list:
-            if det["obj_class"][0] == "tw":
-                continue
-            
-            rect1 = det["rect"]
-            obj_ax = []
-            temp = []
+    def _async_forward(self, preprocess_future):
+        if not self._is_split():
+            # backend can't be split, the whole inference runs on this stage
+            return self._infer(preprocess_future.result())
 
-            for ax in _axles:
-                if intersection_over_rect(rect1, ax) > 0.9:
-                    obj_ax.append(ax)
-                else:
-                    temp.append(ax)
+        slot = preprocess_future.result()
+        try:
+            return self._forward(slot)
+        finally:
+            self._free_slots.put(slot)
+
+    def _async_finish(self, curr_frame, frame_id, tiles, forward_futures):
+        crop_dets = [future.result() for future in forward_futures]
+        if self._is_split():
+            crop_dets = [self._decode(outputs) for outputs in crop_dets]
+
+        raw_dets = self._merge_tiles(crop_dets, tiles, curr_frame.shape)
+        if self.recorder is not None:
+            self.recorder.write(frame_id, *raw_dets)
+
+        return self._postpreprocessing(*raw_dets)
+
+    def detect_async(self, curr_frame, frame_id=None):
+        """
+        Same as `detect` but returns a Future of the Detections. Preprocessing,
+        inference and decoding each run on their own thread, so the next frame is
+        preprocessed and the previous one decoded while a frame infers. Every stage
+        takes frames in submission order, so results complete in order. The frame
+        must stay untouched until its future is done, and `detect` must not be
+        called while async detections are in flight.
+
+        Library only, none of the atcc entry points call it, atcc_mp overlaps the
+        stages with processes instead. Backends whose forward pass needs a thread
+        bound context (the cuda context of trt) make it current in `_async_forward`.
+        """
+        if self._pipeline is None:
+            self._free_slots = queue.Queue()
+            for slot in range(self.num_input_slots):
+                self._free_slots.put(slot)
+            self._pipeline = [ThreadPoolExecutor(max_workers=1) for _ in range(3)]
+
+        preprocess_stage, forward_stage, finish_stage = self._pipeline
+
+        if type(self)._raw_detections is not BaseDetector._raw_detections:
+            # backends without a network, e.g. replay, have nothing to overlap
+            return finish_stage.submit(self.detect, curr_frame, frame_id)
+
+        tiles = self._tiles(curr_frame, self.lane_detector)
+        forward_futures = []
+        for tile in tiles:
+            crop = curr_frame
+            if tile is not None:
+                crop = curr_frame[tile[1] : tile[3], tile[0] : tile[2]]
+
+            preprocess_future = preprocess_stage.submit(self._async_preprocess, crop)
+            forward_futures.append(
+                forward_stage.submit(self._async_forward, preprocess_future)
+            )
 
-            if len(obj_ax) > 0:
-                det["axles"] = sorted(obj_ax, key=lambda x: x[0])
+        return finish_stage.submit(
+            self._async_finish, curr_frame, frame_id, tiles, forward_futures
+        )
 
-            _axles = temp
-            if len(_axles) == 0:
-                break
+    def close(self) -> None:
+        """waits for async detections in flight and stops the pipeline threads"""
+        if self._pipeline is not None:
+            for stage in self._pipeline:
+                stage.shutdown()
+            self._pipeline = None
+
+        self.stop_recording()
+
+    def detect_batch(
+        self, frames, lane_detectors=None, bottom_types=None, frame_ids=None
+    ) -> list:
+        """
+        Detects on a list of frames, in as few forward passes as the backend allows.
+        Frames may come from different cameras, then pass the lane detector and
+        bottom type of every frame, by default the detector's own are used.
+        """
+        if frame_ids is None:
+            frame_ids = [None] * len(frames)
+        if lane_detectors is None:
+            lane_detectors = [self.lane_detector] * len(frames)
+        if bottom_types is None:
+            bottom_types = [self.bottom_type] * len(frames)
+
+        return [
+            self._postpreprocessing(
+                *raw_dets,
+                frame_shape=frame.shape,
+                lane_detector=lane_detector,
+                bottom_type=bottom_type,
+            )
+            for frame, raw_dets, lane_detector, bottom_type in zip(
+                frames,
+                self._raw_detections(
+                    frames,
+                    frame_ids,
+                    [self._tiles(f, ld) for f, ld in zip(frames, lane_detectors)],
+                ),
+                lane_detectors,
+                bottom_types,
+            )
+        ]
 
-        return detection_list
+    def _postpreprocessing(
+        self,
+        boxes,
+        scores,
+        class_ids,
+        frame_shape=None,
+        lane_detector=None,
+        bottom_type=None,
+    ) -> Detections:
+        if len(scores) == 0:
+            return Detections.empty(self.class_names)
+
+        frame_h, frame_w = (
+            frame_shape[:2] if frame_shape is not None else (self.frame_h, self.frame_w)
+        )
+        lane_detector = lane_detector or self.lane_detector
+        bottom_type = bottom_type or self.bottom_type
+
+        scale = np.array([frame_w, frame_h, frame_w, frame_h], dtype=np.float32)
+        rects = np.asarray(boxes, dtype=np.float32) * scale
+        if self.round_boxes:
+            rects = np.rint(rects)
+        rects = rects.astype(np.int32)
+        scores = np.asarray(scores, dtype=np.float32)
+        class_ids = np.asarray(class_ids, dtype=np.int32)
+
+        is_axle = class_ids == self.axle_id
+        axles = rects[is_axle]
+        rects, scores, class_ids = rects[~is_axle], scores[~is_axle], class_ids[~is_axle]
+
+        if bottom_type == "bottom-left":
+            bottoms = rects[:, [0, 3]]
+        else:
+            bottoms = rects[:, [2, 3]]
+
+        lanes = lane_detector.lanes(bottoms)
+
+        in_lane = lanes > 0
+        rects, bottoms, scores = rects[in_lane], bottoms[in_lane], scores[in_lane]
+        class_ids, lanes = class_ids[in_lane], lanes[in_lane]
+
+        keep = nonmax_suppression(rects, scores, 0.6)
+        rects, bottoms, scores = rects[keep], bottoms[keep], scores[keep]
+        class_ids, lanes = class_ids[keep], lanes[keep]
+
+        # every axle goes to the highest scoring vehicle (except two wheelers)
+        # which contains it, then axles are grouped by vehicle, left to right
+        num_dets = len(scores)
+        contains = intersection_over_rect_matrix(rects, axles) > 0.9
+        contains[class_ids == self.class_names.index("tw")] = False
+
+        owners = np.full(len(axles), num_dets)
+        if num_dets > 0:
+            owners = np.where(contains.any(axis=0), contains.argmax(axis=0), num_dets)
+        order = np.lexsort((axles[:, 0], owners))
+        axles, owners = axles[order], owners[order]
+
+        det_ids = np.arange(num_dets)
+        axle_ranges = np.stack(
+            (
+                np.searchsorted(owners, det_ids, side="left"),
+                np.searchsorted(owners, det_ids, side="right"),
+            ),
+            axis=1,
+        ).astype(np.int32)
+
+        return Detections(
+            rects,
+            bottoms,
+            scores,
+            class_ids,
+            lanes,
+            axles,
+            axle_ranges,
+            self.class_names,
+        )
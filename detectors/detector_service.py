@@ -0,0 +1,121 @@
+import time
+import queue
+from typing import Callable
+
+from utils import StopStage
+
+
+class CameraStream(object):
+    """
+    One camera pipeline served by a `DetectorService`, where its frames live and
+    how its detections are post processed and where they go.
+    """
+
+    def __init__(
+        self, frame_ring, lane_detector: Callable, bottom_type: str, out_queue
+    ) -> None:
+        self.frame_ring = frame_ring
+        self.lane_detector = lane_detector
+        self.bottom_type = bottom_type
+        self.out_queue = out_queue
+
+
+class DetectorService(object):
+    """
+    One detector (one model in memory) serving any number of cameras. Every camera
+    puts `(camera_idx, slot, *rest)` on the shared `request_queue` and one StopStage
+    when it is done. Requests are batched as they come, up to `max_batch` frames
+    and waiting at most `max_wait` seconds after the first one, so an idle camera
+    never delays a busy one. Detections go back to the camera's own out queue as
+    `on_result(camera_idx, detections, request)`, by default `(detections, slot, *rest)`,
+    in the order the camera sent its frames.
+    """
+
+    def __init__(
+        self,
+        detector,
+        request_queue,
+        cameras: list,
+        max_batch=4,
+        max_wait=0.005,
+        timeout=1.0,
+        on_result: Callable = None,
+    ) -> None:
+
+        self.detector = detector
+        self.request_queue = request_queue
+        self.cameras = cameras
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.timeout = timeout
+        self.on_result = on_result
+
+        self.num_batches = 0
+        self.num_frames = 0
+
+        # cameras which sent their StopStage so far, a batch stops waiting for more
+        # requests once all of them did
+        self.num_stops = 0
+
+    def _fill_batch(self, request) -> list:
+        requests = [request]
+        deadline = time.time() + self.max_wait
+
+        while len(requests) < self.max_batch:
+            try:
+                request = self.request_queue.get(
+                    timeout=max(deadline - time.time(), 0)
+                )
+            except queue.Empty:
+                break
+
+            if isinstance(request, StopStage):
+                self.num_stops += 1
+                if self.num_stops == len(self.cameras):
+                    break
+                continue
+            requests.append(request)
+
+        return requests
+
+    def _serve(self, requests) -> None:
+        cameras = [self.cameras[request[0]] for request in requests]
+
+        detections = self.detector.detect_batch(
+            [camera.frame_ring[request[1]] for camera, request in zip(cameras, requests)],
+            lane_detectors=[camera.lane_detector for camera in cameras],
+            bottom_types=[camera.bottom_type for camera in cameras],
+        )
+
+        self.num_batches += 1
+        self.num_frames += len(requests)
+
+        for camera, request, frame_detections in zip(cameras, requests, detections):
+            if self.on_result is not None:
+                result = self.on_result(request[0], frame_detections, request)
+            else:
+                result = (frame_detections,) + tuple(request[1:])
+            camera.out_queue.put(result)
+
+    @property
+    def avg_batch(self) -> float:
+        return self.num_frames / max(self.num_batches, 1)
+
+    def run(self) -> None:
+        """serves requests until every camera sent its StopStage, then forwards it"""
+        try:
+            self.num_stops = 0
+            while self.num_stops < len(self.cameras):
+                try:
+                    request = self.request_queue.get(timeout=self.timeout)
+                except queue.Empty:
+                    continue
+
+                if isinstance(request, StopStage):
+                    self.num_stops += 1
+                    continue
+
+                self._serve(self._fill_batch(request))
+        finally:
+            for camera in self.cameras:
+                camera.out_queue.put(StopStage())
@@ -0,0 +1,103 @@
+import os
+import cv2
+import numpy as np
+from typing import Callable
+
+from detectors import BaseDetector
+from utils import FramePreprocessor, nonmax_suppression
+
+
+class OpencvYoloDetector(BaseDetector):
+    """
+    Runs the darknet yolov4 cfg and weights on CPU with OpenCV's dnn module, no
+    darknet library, cuda or tensorrt needed.
+    """
+
+    def __init__(
+        self,
+        initial_frame,
+        lane_detector: Callable,
+        detection_thresh: float,
+        bottom_type="bottom-right",
+        batch_size=1,
+        lane_roi=False,
+        farfield_roi=None,
+        num_threads=None,
+        fp16=False,
+    ) -> None:
+
+        self.num_threads = num_threads
+        self.fp16 = fp16
+
+        super().__init__(
+            initial_frame,
+            lane_detector,
+            detection_thresh,
+            bottom_type=bottom_type,
+            batch_size=batch_size,
+            lane_roi=lane_roi,
+            farfield_roi=farfield_roi,
+        )
+
+    def _warmup(self):
+        weight_path = self.path_to_yoloweights + "yolov4.weights"
+        if not os.path.exists(weight_path):
+            raise ValueError(
+                "Invalid weight path `" + os.path.abspath(weight_path) + "`"
+            )
+
+        if not hasattr(cv2.dnn, "readNetFromDarknet"):
+            raise RuntimeError(
+                f"opencv {cv2.__version__} has no darknet importer, use opencv 4.x"
+            )
+
+        if self.num_threads is not None:
+            cv2.setNumThreads(self.num_threads)
+
+        self.net_main = cv2.dnn.readNetFromDarknet(self.config_path, weight_path)
+        self.net_main.setPreferableBackend(cv2.dnn.DNN_BACKEND_OPENCV)
+
+        target = cv2.dnn.DNN_TARGET_CPU
+        if self.fp16:
+            if hasattr(cv2.dnn, "DNN_TARGET_CPU_FP16"):
+                target = cv2.dnn.DNN_TARGET_CPU_FP16
+            else:
+                print(f"FP16 on CPU needs opencv >= 4.9, got {cv2.__version__}, using FP32")
+        self.net_main.setPreferableTarget(target)
+
+        self.output_names = self.net_main.getUnconnectedOutLayersNames()
+
+        self.preprocessors = [
+            FramePreprocessor(self.yolo_width, self.yolo_height)
+            for _ in range(self.num_input_slots)
+        ]
+
+        # first forward pass allocates all the layer buffers
+        self._forward(0)
+
+    def _preprocess(self, curr_frame, slot: int) -> None:
+        self.preprocessors[slot](curr_frame)
+
+    def _forward(self, slot: int):
+        self.net_main.setInput(self.preprocessors[slot].out)
+        return self.net_main.forward(self.output_names)
+
+    def _decode(self, outputs) -> tuple:
+        # rows are centre x, y, w, h, objectness and the class probabilities already
+        # multiplied by objectness, all normalized
+        outputs = np.concatenate([out.reshape(-1, out.shape[-1]) for out in outputs])
+
+        # like darknet, a box is reported once for every class above the threshold
+        rows, class_ids = np.nonzero(outputs[:, 5:] > self.detection_thresh)
+        if len(rows) == 0:
+            return np.zeros((0, 4)), np.zeros(0), np.zeros(0)
+
+        scores = outputs[rows, 5 + class_ids]
+        bboxes = outputs[rows, :4]
+        boxes = np.hstack(
+            (bboxes[:, :2] - bboxes[:, 2:] / 2, bboxes[:, :2] + bboxes[:, 2:] / 2)
+        )
+
+        keep = nonmax_suppression(boxes, scores, 0.45, class_ids=class_ids)
+
+        return boxes[keep], scores[keep], class_ids[keep]
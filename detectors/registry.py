@@ -0,0 +1,40 @@
+import time
+import importlib
+
+
+# backend name -> (module, class). A backend module, and with it darknet, tensorrt
+# or cuda, is only imported once that backend is selected.
+DETECTOR_BACKENDS = {
+    "vanilla": ("detectors.yolo_detector", "VanillaYoloDetector"),
+    "trt": ("detectors.trt_detector", "TrtYoloDetector"),
+    "opencv": ("detectors.opencv_detector", "OpencvYoloDetector"),
+    "replay": ("detectors.replay_detector", "ReplayDetector"),
+    "synthetic": ("detectors.synthetic_detector", "SyntheticDetector"),
+}
+
+
+def get_detector_class(backend: str):
+    if backend not in DETECTOR_BACKENDS:
+        raise ValueError(f"Invalid inference backend `{backend}` !")
+
+    module_name, class_name = DETECTOR_BACKENDS[backend]
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+def load_detector(backend: str, *args, **kwargs):
+    """
+    Imports the backend and builds its detector, printing how long the import and
+    the model load took so cold starts can be watched.
+    """
+    tik = time.time()
+    detector_class = get_detector_class(backend)
+    tok1 = time.time()
+    detector = detector_class(*args, **kwargs)
+    tok2 = time.time()
+
+    print(
+        f"Detector `{backend}` ready in {round(tok2 - tik, 2)}s "
+        f"(import {round(tok1 - tik, 2)}s, model load {round(tok2 - tok1, 2)}s)"
+    )
+
+    return detector
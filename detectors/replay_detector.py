@@ -0,0 +1,72 @@
+import numpy as np
+from typing import Callable
+
+from detectors import BaseDetector
+from utils import DetectionCache
+
+
+class ReplayDetector(BaseDetector):
+    """
+    Serves detections recorded by `BaseDetector.start_recording` back by frame id,
+    no inference at all. Meant for re-running tracking and counting on a clip.
+    """
+
+    def __init__(
+        self,
+        initial_frame,
+        lane_detector: Callable,
+        detection_thresh: float,
+        bottom_type="bottom-right",
+        batch_size=1,
+        cache_path=None,
+        source=None,
+    ) -> None:
+
+        if cache_path is None:
+            raise ValueError("ReplayDetector needs the `cache_path` of a recording !")
+
+        # the video or stream the recording must have been made from, if given
+        self.cache_path = cache_path
+        self.source = source
+
+        super().__init__(
+            initial_frame,
+            lane_detector,
+            detection_thresh,
+            bottom_type=bottom_type,
+            batch_size=batch_size,
+        )
+
+    def _warmup(self):
+        self.cache = DetectionCache(self.cache_path, self.source)
+        self.num_missing = 0
+
+    def _cached(self, frame_id) -> tuple:
+        # frames dropped by a queue policy or skipped by the motion gate while
+        # recording have no entry, they replay without detections
+        if frame_id in self.cache:
+            return self.cache[frame_id]
+
+        if self.num_missing == 0:
+            print(
+                f"Frame {frame_id} was not recorded in `{self.cache_path}`, "
+                "frames missing from the recording are replayed without detections"
+            )
+        self.num_missing += 1
+
+        return (
+            np.zeros((0, 4), dtype=np.float32),
+            np.zeros(0, dtype=np.float32),
+            np.zeros(0, dtype=np.int32),
+        )
+
+    def _raw_detections(self, frames, frame_ids, tiles) -> list:
+        raw_dets = []
+        for frame_id in frame_ids:
+            boxes, scores, class_ids = self._cached(frame_id)
+
+            # a recording made at a low threshold can be replayed at any higher one
+            keep = scores > self.detection_thresh
+            raw_dets.append((boxes[keep], scores[keep], class_ids[keep]))
+
+        return raw_dets
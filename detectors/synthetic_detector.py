@@ -0,0 +1,179 @@
+import numpy as np
+from typing import Callable
+
+from detectors import BaseDetector
+
+
+# vehicle size in pixels at the near end of a lane and its number of axles
+VEHICLE_SHAPES = {
+    "tw": (40, 70, 0),
+    "car": (110, 90, 2),
+    "lgv": (130, 110, 2),
+    "2t": (160, 150, 2),
+    "3t": (190, 160, 3),
+    "4t": (220, 170, 4),
+    "5t": (250, 170, 5),
+    "6t": (280, 170, 6),
+    "bus": (230, 190, 2),
+    "ml": (120, 100, 2),
+    "auto": (80, 90, 0),
+    "mb": (150, 130, 2),
+    "tractr": (170, 150, 2),
+}
+
+DEFAULT_CLASS_MIX = {
+    "car": 0.45,
+    "tw": 0.15,
+    "auto": 0.05,
+    "lgv": 0.1,
+    "2t": 0.05,
+    "3t": 0.05,
+    "4t": 0.03,
+    "6t": 0.02,
+    "bus": 0.05,
+    "mb": 0.05,
+}
+
+
+class SyntheticDetector(BaseDetector):
+    """
+    Generates deterministic vehicles driving along the lanes of `camera_meta`, no
+    model and no frame content needed, to load test tracking and counting.
+
+    Every lane gets an equal share of `num_vehicles`, evenly spaced and driving
+    towards the lane's ref point at the lane's own speed, a vehicle leaving the lane
+    comes back at its start as a new vehicle. `dropout` is the chance a vehicle is
+    missed in a frame and `jitter` the std of box noise in pixels. Very dense lanes
+    overlap so much that nms merges some vehicles, as it would on real footage.
+    """
+
+    def __init__(
+        self,
+        initial_frame,
+        lane_detector: Callable,
+        detection_thresh: float,
+        bottom_type="bottom-right",
+        batch_size=1,
+        camera_meta=None,
+        num_vehicles=100,
+        class_mix=None,
+        dropout=0.0,
+        jitter=0.0,
+        seed=0,
+    ) -> None:
+
+        if camera_meta is None:
+            raise ValueError("SyntheticDetector needs the `camera_meta` to drive in !")
+
+        self.camera_meta = camera_meta
+        self.num_vehicles = num_vehicles
+        self.class_mix = class_mix or DEFAULT_CLASS_MIX
+        self.dropout = dropout
+        self.jitter = jitter
+        self.seed = seed
+
+        super().__init__(
+            initial_frame,
+            lane_detector,
+            detection_thresh,
+            bottom_type=bottom_type,
+            batch_size=batch_size,
+        )
+
+    def _lane_path(self, lane_coords, lane_ref) -> tuple:
+        # from the middle of the two polygon corners farthest from the ref point to
+        # the middle of the two closest ones
+        corners = lane_coords.reshape(-1, 2).astype(np.float32)
+        order = np.argsort(np.linalg.norm(corners - np.array(lane_ref), axis=1))
+        return corners[order[-2:]].mean(axis=0), corners[order[:2]].mean(axis=0)
+
+    def _warmup(self):
+        rng = np.random.default_rng(self.seed)
+
+        lanes = [("rightlane_coords", "rightlane_ref")]
+        if "middlelane_coords" in self.camera_meta:
+            lanes.append(("middlelane_coords", "middlelane_ref"))
+        lanes.append(("leftlane_coords", "leftlane_ref"))
+
+        names = list(self.class_mix.keys())
+        probs = np.array([self.class_mix[n] for n in names], dtype=np.float64)
+        class_names = rng.choice(names, size=self.num_vehicles, p=probs / probs.sum())
+
+        paths = np.array(
+            [
+                self._lane_path(self.camera_meta[coords_key], self.camera_meta[ref_key])
+                for coords_key, ref_key in lanes
+            ]
+        )
+        lane_speeds = rng.uniform(0.004, 0.01, len(lanes)).astype(np.float32)
+
+        # vehicles are dealt to the lanes round robin and evenly spaced in a lane
+        vehicle_lanes = np.arange(self.num_vehicles) % len(lanes)
+        lane_counts = np.bincount(vehicle_lanes, minlength=len(lanes))
+
+        self._starts = paths[vehicle_lanes, 0]
+        self._ends = paths[vehicle_lanes, 1]
+        self._phases = (np.arange(self.num_vehicles) // len(lanes)) / lane_counts[
+            vehicle_lanes
+        ]
+        self._speeds = lane_speeds[vehicle_lanes]
+
+        self._class_ids = np.array([self.class_names.index(n) for n in class_names])
+        shapes = np.array([VEHICLE_SHAPES[n] for n in class_names], dtype=np.float32)
+        self._sizes = shapes[:, :2]
+        self._num_axles = shapes[:, 2].astype(np.int32)
+
+        self._frame_idx = 0
+
+    def _infer(self, curr_frame) -> tuple:
+        self._frame_idx += 1
+        rng = np.random.default_rng([self.seed, self._frame_idx])
+
+        progress = (self._phases + self._speeds * self._frame_idx) % 1.0
+        bottoms = self._starts + (self._ends - self._starts) * progress[:, None]
+
+        # far away vehicles look smaller
+        sizes = self._sizes * (0.3 + 0.7 * progress)[:, None]
+
+        if self.bottom_type == "bottom-left":
+            rects = np.hstack((bottoms - [0, 1] * sizes, bottoms + [1, 0] * sizes))
+        else:
+            rects = np.hstack((bottoms - sizes, bottoms))
+
+        if self.jitter > 0:
+            rects += rng.normal(0, self.jitter, rects.shape)
+
+        visible = rng.random(len(rects)) >= self.dropout
+        rects, sizes = rects[visible], sizes[visible]
+        class_ids, num_axles = self._class_ids[visible], self._num_axles[visible]
+        scores = rng.uniform(max(self.detection_thresh, 0.6), 1.0, len(rects))
+
+        # square axles spread along the bottom edge, well inside their vehicle
+        owners = np.repeat(np.arange(len(rects)), num_axles)
+        nth_axle = np.arange(len(owners)) - np.repeat(
+            np.cumsum(num_axles) - num_axles, num_axles
+        )
+        spread = 0.1 + 0.8 * (nth_axle + 0.5) / np.maximum(num_axles[owners], 1)
+
+        axle_size = sizes[owners, 1] * 0.15
+        axle_cx = rects[owners, 0] + (rects[owners, 2] - rects[owners, 0]) * spread
+        axle_y2 = rects[owners, 3] - 2
+        axles = np.stack(
+            (
+                axle_cx - axle_size / 2,
+                axle_y2 - axle_size,
+                axle_cx + axle_size / 2,
+                axle_y2,
+            ),
+            axis=1,
+        )
+
+        boxes = np.vstack((rects, axles)) / np.array(
+            [self.frame_w, self.frame_h, self.frame_w, self.frame_h], dtype=np.float32
+        )
+        scores = np.concatenate((scores, rng.uniform(0.6, 1.0, len(axles))))
+        class_ids = np.concatenate(
+            (class_ids, np.full(len(axles), self.axle_id, dtype=class_ids.dtype))
+        )
+
+        return boxes, scores, class_ids
@@ -1,10 +1,12 @@
-import cv2
 import numpy as np
+from typing import Callable
+
 import tensorrt as trt
 import pycuda.autoinit
 import pycuda.driver as cuda
 
 from detectors import BaseDetector
+from utils import FramePreprocessor, nonmax_suppression
 
 
 TRT_LOGGER = trt.Logger(trt.Logger.Severity.ERROR)
@@ -23,6 +25,61 @@ class HostDeviceMem(object):
 
 
 class TrtYoloDetector(BaseDetector):
+    def __init__(
+        self,
+        initial_frame,
+        lane_detector: Callable,
+        detection_thresh: float,
+        bottom_type="bottom-right",
+        batch_size=1,
+        lane_roi=False,
+        farfield_roi=None,
+        engine_path=None,
+    ) -> None:
+
+        # None keeps the default engine in yolo_stuff/
+        self.engine_path = engine_path
+
+        super().__init__(
+            initial_frame,
+            lane_detector,
+            detection_thresh,
+            bottom_type=bottom_type,
+            batch_size=batch_size,
+            lane_roi=lane_roi,
+            farfield_roi=farfield_roi,
+        )
+
+    def _warmup(self):
+        if self.engine_path is not None:
+            self.path_to_trtengine = self.engine_path
+
+        # made current on the importing thread by pycuda.autoinit, other threads
+        # have to push it before touching the engine or its buffers
+        self.cuda_ctx = pycuda.autoinit.context
+
+        print("Reading engine from file {}".format(self.path_to_trtengine))
+        with open(self.path_to_trtengine, "rb") as f, trt.Runtime(
+            TRT_LOGGER
+        ) as runtime:
+            self.engine = runtime.deserialize_cuda_engine(f.read())
+            self.context = self.engine.create_execution_context()
+
+        self.buffers = self._allocate_buffers(self.engine, 1)
+        self.context.set_binding_shape(0, (1, 3, self.yolo_height, self.yolo_width))
+
+        # preprocessing writes straight into page-locked input buffers, one per slot
+        # so the next frame is written while the engine reads the current one
+        input_host = self.buffers[0][0].host
+        self.input_slots = [input_host] + [
+            cuda.pagelocked_empty(input_host.shape, input_host.dtype)
+            for _ in range(self.num_input_slots - 1)
+        ]
+        self.preprocessors = [
+            FramePreprocessor(self.yolo_width, self.yolo_height, out=host)
+            for host in self.input_slots
+        ]
+
     def _allocate_buffers(self, engine, batch_size):
         # Allocates all buffers required for an engine, i.e. host/device inputs/outputs.
         inputs = []
@@ -73,65 +130,29 @@ class TrtYoloDetector(BaseDetector):
         # Return only the host outputs.
         return [out.host for out in outputs]
 
-    def _nms_cpu(self, boxes, confs, nms_thresh, min_mode=False):
-        # print(boxes.shape)
-        x1 = boxes[:, 0]
-        y1 = boxes[:, 1]
-        x2 = boxes[:, 2]
-        y2 = boxes[:, 3]
-
-        areas = (x2 - x1) * (y2 - y1)
-        order = confs.argsort()[::-1]
-
-        keep = []
-        while order.size > 0:
-            idx_self = order[0]
-            idx_other = order[1:]
-
-            keep.append(idx_self)
-
-            xx1 = np.maximum(x1[idx_self], x1[idx_other])
-            yy1 = np.maximum(y1[idx_self], y1[idx_other])
-            xx2 = np.minimum(x2[idx_self], x2[idx_other])
-            yy2 = np.minimum(y2[idx_self], y2[idx_other])
-
-            w = np.maximum(0.0, xx2 - xx1)
-            h = np.maximum(0.0, yy2 - yy1)
-            inter = w * h
-
-            if min_mode:
-                over = inter / np.minimum(areas[order[0]], areas[order[1:]])
-            else:
-                over = inter / (areas[order[0]] + areas[order[1:]] - inter)
-
-            inds = np.where(over <= nms_thresh)[0]
-            order = order[inds + 1]
-
-        return np.array(keep)
-
-    def detect(self, curr_frame) -> list:
-        curr_frame = cv2.cvtColor(curr_frame, code=cv2.COLOR_BGR2RGB)
-
-        curr_frame = cv2.resize(
-            curr_frame,
-            (
-                self.yolo_width,
-                self.yolo_height,
-            ),
-            interpolation=cv2.INTER_LINEAR,
-        )
-
-        curr_frame = np.transpose(curr_frame, (2, 0, 1)).astype(np.float32)
-        curr_frame = np.expand_dims(curr_frame, axis=0)
-        curr_frame /= 255.0
-        curr_frame = np.ascontiguousarray(curr_frame)
+    def _preprocess(self, curr_frame, slot: int) -> None:
+        self.preprocessors[slot](curr_frame)
 
+    def _forward(self, slot: int):
         inputs, outputs, bindings, stream = self.buffers
-        inputs[0].host = curr_frame
+        inputs[0].host = self.input_slots[slot]
 
         trt_outputs = self._do_inference(
             bindings=bindings, inputs=inputs, outputs=outputs, stream=stream
         )
+
+        # the output buffers are overwritten by the next forward pass
+        return [out.copy() for out in trt_outputs]
+
+    def _async_forward(self, preprocess_future):
+        # detect_async runs the forward stage on its own thread
+        self.cuda_ctx.push()
+        try:
+            return super()._async_forward(preprocess_future)
+        finally:
+            self.cuda_ctx.pop()
+
+    def _decode(self, trt_outputs) -> tuple:
         trt_outputs[0] = trt_outputs[0].reshape(1, -1, 1, 4)
         trt_outputs[1] = trt_outputs[1].reshape(1, -1, self.num_classes)
 
@@ -157,34 +178,7 @@ class TrtYoloDetector(BaseDetector):
         l_max_conf = max_conf[0, argwhere]
         l_max_id = max_id[0, argwhere]
 
-        trt_detections = []
-        # nms for each class
-        for j in range(self.num_classes):
-
-            cls_argwhere = l_max_id == j
-            ll_box_array = l_box_array[cls_argwhere, :]
-            ll_max_conf = l_max_conf[cls_argwhere]
-            ll_max_id = l_max_id[cls_argwhere]
-
-            keep = self._nms_cpu(ll_box_array, ll_max_conf, nms_thresh=0.5)
-
-            if keep.size > 0:
-                ll_box_array = ll_box_array[keep, :]
-                ll_max_conf = ll_max_conf[keep]
-                ll_max_id = ll_max_id[keep]
-
-                for k in range(ll_box_array.shape[0]):
-                    trt_detections.append(
-                        (
-                            self.class_names[ll_max_id[k]],
-                            ll_max_conf[k],
-                            (
-                                ll_box_array[k, 0],
-                                ll_box_array[k, 1],
-                                ll_box_array[k, 2],
-                                ll_box_array[k, 3],
-                            ),
-                        )
-                    )
-
-        return self._postpreprocessing(trt_detections)
+        # one nms pass over all classes, boxes only suppress boxes of their own class
+        keep = nonmax_suppression(l_box_array, l_max_conf, 0.5, class_ids=l_max_id)
+
+        return l_box_array[keep], l_max_conf[keep], l_max_id[keep]
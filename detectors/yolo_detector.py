@@ -1,29 +1,190 @@
-import cv2
+import os
+import re
+import numpy as np
+from typing import Callable
+from ctypes import POINTER, c_float
 
 import darknet
 from detectors import BaseDetector
+from utils import FramePreprocessor
 
 
 class VanillaYoloDetector(BaseDetector):
-    def detect(self, curr_frame) -> list:
-        curr_frame = cv2.cvtColor(curr_frame, code=cv2.COLOR_BGR2RGB)
-
-        curr_frame = cv2.resize(
-            curr_frame,
-            (
-                darknet.network_width(self.net_main),
-                darknet.network_height(self.net_main),
-            ),
-            interpolation=cv2.INTER_LINEAR,
+    round_boxes = True
+
+    def __init__(
+        self,
+        initial_frame,
+        lane_detector: Callable,
+        detection_thresh: float,
+        bottom_type="bottom-right",
+        batch_size=1,
+        lane_roi=False,
+        farfield_roi=None,
+        weight_path=None,
+    ) -> None:
+
+        # None keeps the default weights in yolo_stuff/
+        self.weight_path = weight_path
+
+        super().__init__(
+            initial_frame,
+            lane_detector,
+            detection_thresh,
+            bottom_type=bottom_type,
+            batch_size=batch_size,
+            lane_roi=lane_roi,
+            farfield_roi=farfield_roi,
+        )
+
+    def _warmup(self):
+        weight_path = self.pathconfig_path = self.path_to_yoloweights + "yolov4.weights"
+        if self.weight_path is not None:
+            weight_path = self.weight_path
+        if not os.path.exists(weight_path):
+            raise ValueError(
+                "Invalid weight path `" + os.path.abspath(weight_path) + "`"
+            )
+
+        meta_path = self.pathconfig_path = self.path_to_yoloweights + "obj.data"
+        if not os.path.exists(meta_path):
+            raise ValueError(
+                "Invalid data file path `" + os.path.abspath(meta_path) + "`"
+            )
+
+        self.net_main = darknet.load_net_custom(
+            self.config_path.encode("ascii"),
+            weight_path.encode("ascii"),
+            0,
+            self.batch_size,
         )
 
-        darknet.copy_image_from_bytes(self.darknet_image, curr_frame.tobytes())
+        self.meta_main = darknet.load_meta(meta_path.encode("ascii"))
+
+        try:
+            with open(self.meta_main) as metaFH:
+                meta_contents = metaFH.read()
+
+                match = re.search(
+                    "names *= *(.*)$", meta_contents, re.IGNORECASE | re.MULTILINE
+                )
+
+                if match:
+                    result = match.group(1)
+                else:
+                    result = None
+                try:
+                    if os.path.exists(result):
+                        with open(result) as namesFH:
+                            names_list = namesFH.read().strip().split("\n")
+                            self.alt_names = [x.strip() for x in names_list]
+                except TypeError:
+                    pass
+        except Exception:
+            pass
+
+        # meta.names index -> class_names index, decoded once instead of per box
+        self.meta_class_ids = np.array(
+            [
+                self.class_names.index(self.meta_main.names[i].decode())
+                for i in range(self.meta_main.classes)
+            ],
+            dtype=np.int32,
+        )
+
+        net_w = darknet.network_width(self.net_main)
+        net_h = darknet.network_height(self.net_main)
+
+        # darknet reads planar float RGB in [0, 1], the preprocessors write it straight
+        # into buffers backing the IMAGE of each slot, no bytes copy in between
+        self.slot_inputs = np.zeros(
+            (self.num_input_slots, 3, net_h, net_w), dtype=np.float32
+        )
+        self.slot_images = [
+            darknet.IMAGE(net_w, net_h, 3, slot_input.ctypes.data_as(POINTER(c_float)))
+            for slot_input in self.slot_inputs
+        ]
+        self.preprocessors = [
+            FramePreprocessor(net_w, net_h, out=slot_input)
+            for slot_input in self.slot_inputs
+        ]
 
-        yolo_detections = darknet.detect_image(
+        if self.batch_size > 1:
+            # planar float input holding a whole batch for network_predict_batch
+            self.batch_input = np.zeros(
+                (self.batch_size, 3, net_h, net_w), dtype=np.float32
+            )
+            self.batch_image = darknet.IMAGE(
+                net_w, net_h, 3, self.batch_input.ctypes.data_as(POINTER(c_float))
+            )
+            self.batch_preprocessors = [
+                FramePreprocessor(net_w, net_h, out=self.batch_input[b])
+                for b in range(self.batch_size)
+            ]
+
+    def _decode(self, yolo_detections) -> tuple:
+        bboxes, scores, meta_ids = yolo_detections
+
+        # darknet boxes are centre x, y, w, h in network pixels
+        bboxes = bboxes / np.array(
+            [self.yolo_width, self.yolo_height, self.yolo_width, self.yolo_height],
+            dtype=np.float32,
+        )
+        boxes = np.hstack(
+            (bboxes[:, :2] - bboxes[:, 2:] / 2, bboxes[:, :2] + bboxes[:, 2:] / 2)
+        )
+
+        return boxes, scores, self.meta_class_ids[meta_ids]
+
+    def _preprocess(self, curr_frame, slot: int) -> None:
+        self.preprocessors[slot](curr_frame)
+
+    def _forward(self, slot: int):
+        return darknet.detect_image_arrays(
             self.net_main,
             self.meta_main,
-            self.darknet_image,
+            self.slot_images[slot],
             thresh=self.detection_thresh,
         )
 
-        return self._postpreprocessing(yolo_detections)
+    def _infer_batch(self, frames) -> list:
+        if self.batch_size == 1:
+            return super()._infer_batch(frames)
+
+        raw_dets = []
+        for start in range(0, len(frames), self.batch_size):
+            chunk = frames[start : start + self.batch_size]
+
+            # slots after the chunk keep stale frames, their detections are not read
+            for preprocessor, frame in zip(self.batch_preprocessors, chunk):
+                preprocessor(frame)
+
+            batch_dets = darknet.network_predict_batch(
+                self.net_main,
+                self.batch_image,
+                len(chunk),
+                self.batch_image.w,
+                self.batch_image.h,
+                self.detection_thresh,
+                0.5,
+                None,
+                0,
+                0,
+            )
+
+            for b in range(len(chunk)):
+                num = batch_dets[b].num
+                dets = batch_dets[b].dets
+                darknet.do_nms_sort(dets, num, self.meta_main.classes, 0.45)
+
+                raw_dets.append(
+                    self._decode(
+                        darknet.detections_to_arrays(
+                            dets, num, self.meta_main.classes
+                        )
+                    )
+                )
+
+            darknet.free_batch_detections(batch_dets, len(chunk))
+
+        return raw_dets
@@ -0,0 +1,27 @@
+import os
+import sys
+
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from tests.support.backend_standins import install_fake_darknet, install_fake_trt
+
+
+@pytest.fixture(autouse=True)
+def in_repo_root(monkeypatch):
+    # detectors read yolo_stuff/ relative to the working directory
+    monkeypatch.chdir(REPO_ROOT)
+
+
+@pytest.fixture
+def fake_trt(monkeypatch):
+    """installs the trt stand-ins for a source, removed again after the test"""
+    return lambda source, seed=0: install_fake_trt(monkeypatch, source, seed)
+
+
+@pytest.fixture
+def fake_darknet(monkeypatch):
+    """installs the darknet stand-in for a source, removed again after the test"""
+    return lambda source, seed=0: install_fake_darknet(monkeypatch, source, seed=seed)
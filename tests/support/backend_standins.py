@@ -0,0 +1,434 @@
+import sys
+import json
+import types
+import ctypes
+import threading
+import importlib
+import numpy as np
+from ctypes import POINTER, c_float, c_void_p, cast
+
+from utils import DetectionCache, nonmax_suppression
+
+
+# Stand-ins for tensorrt + pycuda and for libdarknet.so, so TrtYoloDetector and
+# VanillaYoloDetector run unchanged on a CPU only machine, for the tests and the
+# decode benchmark. They are put in sys.modules through a pytest `monkeypatch`,
+# so they are gone again once the test (or `MonkeyPatch.context()`) ends. The network is replaced
+# by a `source`, a callable returning one frame's (boxes, scores, class_ids) with
+# boxes normalized x1 y1 x2 y2, which `yolo_candidates` spreads into the many
+# overlapping candidates a real yolo head puts out, so the decode, thresholding
+# and nms of both backends have the same work to do as on the real outputs.
+
+
+def recorded_source(cache_path: str):
+    """replays the frames of a `DetectionRecorder` recording in order, then loops"""
+    cache = DetectionCache(cache_path)
+    frame_ids = cache.frame_ids()
+    state = {"idx": 0}
+
+    def source():
+        frame_id = frame_ids[state["idx"] % len(frame_ids)]
+        state["idx"] += 1
+        return cache[frame_id]
+
+    return source
+
+
+def synthetic_source(initial_frame, camera_meta: dict, **kwargs):
+    """vehicles of a `SyntheticDetector` driving along the lanes of `camera_meta`"""
+    from utils import init_lane_detector
+    from detectors.synthetic_detector import SyntheticDetector
+
+    detector = SyntheticDetector(
+        initial_frame,
+        init_lane_detector(camera_meta),
+        0.0,
+        camera_meta=camera_meta,
+        **kwargs,
+    )
+    return lambda: detector._infer(None)
+
+
+def yolo_candidates(
+    boxes, scores, class_ids, num_classes, rng, duplicates=4, num_background=300
+) -> tuple:
+    """
+    Raw yolo head output around the given detections. Every detection comes back
+    `duplicates` times with jittered boxes and lower objectness, as from
+    neighbouring anchors and cells, with most class probability on its own class
+    and some on a random other one. `num_background` small low objectness boxes
+    are scattered over the frame. Returns (boxes, objectness, class_probs).
+    """
+    boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+    scores = np.asarray(scores, dtype=np.float32)
+    class_ids = np.asarray(class_ids, dtype=np.int64)
+
+    copies = np.repeat(np.arange(len(boxes)), duplicates)
+    sizes = np.tile(boxes[copies, 2:] - boxes[copies, :2], 2)
+    cand_boxes = boxes[copies] + rng.normal(0, 0.04, sizes.shape) * sizes
+    cand_boxes[::duplicates] = boxes
+
+    objectness = scores[copies] * rng.uniform(0.6, 1.0, len(copies))
+    objectness[::duplicates] = scores
+
+    class_probs = np.zeros((len(copies), num_classes), dtype=np.float32)
+    own = rng.uniform(0.85, 1.0, len(copies))
+    class_probs[np.arange(len(copies)), class_ids[copies]] = own
+    confusion = rng.integers(0, num_classes, len(copies))
+    class_probs[np.arange(len(copies)), confusion] += (1 - own) * (
+        confusion != class_ids[copies]
+    )
+
+    centres = rng.uniform(0, 1, (num_background, 2))
+    half_sizes = rng.uniform(0.005, 0.03, (num_background, 2))
+    bg_boxes = np.hstack((centres - half_sizes, centres + half_sizes))
+    bg_probs = rng.dirichlet(np.ones(num_classes), num_background)
+
+    return (
+        np.clip(np.vstack((cand_boxes, bg_boxes)), 0, 1).astype(np.float32),
+        np.concatenate((objectness, rng.uniform(0, 0.3, num_background))).astype(
+            np.float32
+        ),
+        np.vstack((class_probs, bg_probs)).astype(np.float32),
+    )
+
+
+# ----------------------------------------------------------------- tensorrt ----
+
+
+def write_fake_engine(path: str, width=608, height=608, num_classes=14) -> None:
+    """
+    An engine file for the fake runtime, just the binding shapes of the yolov4
+    engine in yolo_stuff/ (one candidate per anchor of the three heads).
+    """
+    num_candidates = 3 * sum((width // s) * (height // s) for s in [8, 16, 32])
+    bindings = [
+        ["input", [1, 3, height, width], True],
+        ["boxes", [1, num_candidates, 1, 4], False],
+        ["confs", [1, num_candidates, num_classes], False],
+    ]
+    with open(path, "w") as f:
+        json.dump({"bindings": bindings}, f)
+
+
+class FakeDeviceAllocation(object):
+    """pycuda device memory, host memory in a registry keyed by its fake address"""
+
+    registry = {}
+
+    def __init__(self, nbytes: int) -> None:
+        self.data = np.zeros(nbytes, dtype=np.uint8)
+        self.address = self.data.ctypes.data
+        FakeDeviceAllocation.registry[self.address] = self
+
+    def __int__(self) -> int:
+        return self.address
+
+
+class FakeStream(object):
+    handle = 0
+
+    def synchronize(self) -> None:
+        pass
+
+
+class FakeCudaContext(object):
+    """pycuda context, only current on the threads it was pushed on"""
+
+    stacks = threading.local()
+
+    @classmethod
+    def _stack(cls) -> list:
+        if not hasattr(cls.stacks, "contexts"):
+            cls.stacks.contexts = []
+        return cls.stacks.contexts
+
+    def push(self) -> None:
+        self._stack().append(self)
+
+    def pop(self) -> None:
+        self._stack().pop()
+
+    @classmethod
+    def check_current(cls) -> None:
+        if len(cls._stack()) == 0:
+            raise RuntimeError("cuMemcpyHtoDAsync failed: invalid device context")
+
+
+def _memcpy_htod_async(device, host, stream=None) -> None:
+    FakeCudaContext.check_current()
+    device.data[:] = np.ascontiguousarray(host).view(np.uint8).reshape(-1)
+
+
+def _memcpy_dtoh_async(host, device, stream=None) -> None:
+    host.view(np.uint8).reshape(-1)[:] = device.data
+
+
+class FakeExecutionContext(object):
+    def __init__(self, engine) -> None:
+        self.engine = engine
+
+    def set_binding_shape(self, idx: int, shape) -> None:
+        if tuple(shape) != tuple(self.engine.shapes[idx]):
+            raise ValueError(f"Fake engine has no profile for shape {tuple(shape)} !")
+
+    def execute_async(self, bindings, stream_handle=None) -> bool:
+        boxes, objectness, class_probs = yolo_candidates(
+            *self.engine.source(), self.engine.num_classes, self.engine.rng
+        )
+
+        num_candidates = self.engine.shapes[1][1]
+        out_boxes = np.zeros((num_candidates, 4), dtype=np.float32)
+        out_confs = np.zeros((num_candidates, self.engine.num_classes), dtype=np.float32)
+
+        # real candidates are spread over the anchors, not packed at the start
+        rows = self.engine.rng.choice(
+            num_candidates, min(len(boxes), num_candidates), replace=False
+        )
+        out_boxes[rows] = boxes[: len(rows)]
+        out_confs[rows] = (objectness[:, None] * class_probs)[: len(rows)]
+
+        for address, out in zip(bindings[1:], [out_boxes, out_confs]):
+            FakeDeviceAllocation.registry[address].data[:] = out.view(np.uint8).reshape(-1)
+
+        return True
+
+
+class FakeCudaEngine(object):
+    def __init__(self, spec: dict, source, seed=0) -> None:
+        self.names = [name for name, _, _ in spec["bindings"]]
+        self.shapes = [tuple(shape) for _, shape, _ in spec["bindings"]]
+        self.is_input = [is_input for _, _, is_input in spec["bindings"]]
+        self.num_classes = self.shapes[2][-1]
+        self.source = source
+        self.rng = np.random.default_rng(seed)
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def get_binding_shape(self, binding):
+        return self.shapes[self.names.index(binding)]
+
+    def get_binding_dtype(self, binding):
+        return np.float32
+
+    def binding_is_input(self, binding) -> bool:
+        return self.is_input[self.names.index(binding)]
+
+    def create_execution_context(self):
+        return FakeExecutionContext(self)
+
+
+def install_fake_trt(monkeypatch, source, seed=0) -> None:
+    """
+    Puts fake `tensorrt`, `pycuda.autoinit` and `pycuda.driver` modules in place
+    until `monkeypatch` is undone, build TrtYoloDetector afterwards with
+    `engine_path` of a `write_fake_engine` file. Every forward pass outputs
+    candidates around one frame of `source`.
+    """
+    trt = types.ModuleType("tensorrt")
+
+    class Logger(object):
+        class Severity(object):
+            ERROR = 1
+
+        def __init__(self, severity=None) -> None:
+            self.severity = severity
+
+    class Runtime(object):
+        def __init__(self, logger) -> None:
+            pass
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc) -> None:
+            pass
+
+        def deserialize_cuda_engine(self, data):
+            return FakeCudaEngine(json.loads(data), source, seed)
+
+    trt.Logger = Logger
+    trt.Runtime = Runtime
+    trt.volume = lambda shape: int(np.prod(shape))
+    trt.nptype = np.dtype
+
+    pycuda = types.ModuleType("pycuda")
+    autoinit = types.ModuleType("pycuda.autoinit")
+    driver = types.ModuleType("pycuda.driver")
+    driver.Stream = FakeStream
+    driver.mem_alloc = FakeDeviceAllocation
+    driver.pagelocked_empty = lambda shape, dtype: np.empty(shape, dtype=dtype)
+    driver.memcpy_htod_async = _memcpy_htod_async
+    driver.memcpy_dtoh_async = _memcpy_dtoh_async
+    # like the real autoinit, the context is current on the installing thread, the
+    # contexts pushed so far go with the stand-ins
+    monkeypatch.setattr(FakeCudaContext, "stacks", threading.local())
+    autoinit.context = FakeCudaContext()
+    autoinit.context.push()
+    pycuda.autoinit, pycuda.driver = autoinit, driver
+
+    for name, module in [
+        ("tensorrt", trt),
+        ("pycuda", pycuda),
+        ("pycuda.autoinit", autoinit),
+        ("pycuda.driver", driver),
+    ]:
+        monkeypatch.setitem(sys.modules, name, module)
+
+    # the backend is imported again on top of the stand-ins, and dropped with them
+    monkeypatch.delitem(sys.modules, "detectors.trt_detector", raising=False)
+
+
+# ------------------------------------------------------------------ darknet ----
+
+
+class FakeFunction(object):
+    """a foreign function of the fake lib, darknet.py sets argtypes / restype on it"""
+
+    def __init__(self, name: str, impl=None) -> None:
+        self.name = name
+        self.impl = impl
+        self.argtypes = None
+        self.restype = None
+
+    def __call__(self, *args):
+        if self.impl is None:
+            raise NotImplementedError(f"`{self.name}` has no darknet stand-in !")
+        return self.impl(*args)
+
+
+class FakeDarknetLib(object):
+    """
+    libdarknet.so with the calls the darknet backend makes. Detections are real
+    ctypes DETECTION arrays, their prob rows point into numpy arrays kept alive
+    until freed, so darknet.detections_to_arrays reads them like darknet's own.
+    """
+
+    def __init__(self, source, width=608, height=608, seed=0) -> None:
+        self.source = source
+        self.width = width
+        self.height = height
+        self.rng = np.random.default_rng(seed)
+        self.darknet = None
+
+        self._functions = {}
+        self._allocations = {}
+        self._pending = None
+
+    def __getattr__(self, name: str):
+        if name.startswith("_"):
+            raise AttributeError(name)
+
+        functions = self.__dict__["_functions"]
+        if name not in functions:
+            functions[name] = FakeFunction(name, getattr(self, "_fn_" + name, None))
+        return functions[name]
+
+    def _fn_network_width(self, net) -> int:
+        return self.width
+
+    def _fn_network_height(self, net) -> int:
+        return self.height
+
+    def _fn_load_network_custom(self, cfg, weights, clear, batch) -> int:
+        return 1
+
+    def _fn_get_metadata(self, path: bytes):
+        meta = dict(
+            line.split("=", 1) for line in open(path.decode()).read().splitlines() if "=" in line
+        )
+        meta = {key.strip(): value.strip() for key, value in meta.items()}
+        names = open(meta["names"]).read().split()
+
+        self._names = (ctypes.c_char_p * len(names))(*[n.encode() for n in names])
+        return self.darknet.METADATA(len(names), self._names)
+
+    def _fn_network_predict_image(self, net, im) -> None:
+        self._pending = self.source()
+
+    def _make_detections(self, raw_dets, w: int, h: int, thresh: float):
+        boxes, objectness, class_probs = yolo_candidates(
+            *raw_dets, len(self._names), self.rng
+        )
+        keep = objectness > thresh
+        boxes, objectness = boxes[keep], objectness[keep]
+
+        probs = objectness[:, None] * class_probs[keep]
+        probs[probs <= thresh] = 0
+        probs = np.ascontiguousarray(probs, dtype=np.float32)
+
+        size = np.array([w, h], dtype=np.float32)
+        centres = (boxes[:, :2] + boxes[:, 2:]) / 2 * size
+        sizes = (boxes[:, 2:] - boxes[:, :2]) * size
+
+        dets = (self.darknet.DETECTION * max(len(probs), 1))()
+        for idx in range(len(probs)):
+            det = dets[idx]
+            det.bbox = self.darknet.BOX(*centres[idx], *sizes[idx])
+            det.classes = probs.shape[1]
+            det.prob = probs[idx].ctypes.data_as(POINTER(c_float))
+            det.objectness = objectness[idx]
+
+        pointer = cast(dets, POINTER(self.darknet.DETECTION))
+        self._allocations[cast(pointer, c_void_p).value] = (dets, probs, boxes)
+        return pointer, len(probs)
+
+    def _fn_get_network_boxes(
+        self, net, w, h, thresh, hier_thresh, map, relative, pnum, letter_box
+    ):
+        pointer, num = self._make_detections(self._pending, w, h, thresh)
+        pnum[0] = num
+        return pointer
+
+    def _fn_network_predict_batch(
+        self, net, im, batch_size, w, h, thresh, hier, map, relative, letter
+    ):
+        pairs = (self.darknet.DETNUMPAIR * batch_size)()
+        for pair in pairs:
+            pair.dets, pair.num = self._make_detections(self.source(), w, h, thresh)
+        return cast(pairs, POINTER(self.darknet.DETNUMPAIR))
+
+    def _fn_do_nms_sort(self, dets, num, classes, nms) -> None:
+        # darknet zeroes a box's probability of a class if a better box of that
+        # class overlaps it, the box itself stays
+        _, probs, boxes = self._allocations[cast(dets, c_void_p).value]
+        for class_id in range(classes):
+            candidates = np.flatnonzero(probs[:, class_id] > 0)
+            keep = nonmax_suppression(
+                boxes[candidates], probs[candidates, class_id], nms
+            )
+            suppressed = np.setdiff1d(candidates, candidates[keep])
+            probs[suppressed, class_id] = 0
+
+    def _fn_free_detections(self, dets, num) -> None:
+        self._allocations.pop(cast(dets, c_void_p).value, None)
+
+    def _fn_free_batch_detections(self, pairs, batch_size) -> None:
+        for b in range(batch_size):
+            self._fn_free_detections(pairs[b].dets, pairs[b].num)
+
+
+def install_fake_darknet(monkeypatch, source, width=608, height=608, seed=0):
+    """
+    Imports darknet.py on top of a FakeDarknetLib instead of libdarknet.so, so its
+    real wrappers and decode run, until `monkeypatch` is undone. Build
+    VanillaYoloDetector afterwards, every forward pass detects one frame of
+    `source`. Returns the fake lib.
+    """
+    lib = FakeDarknetLib(source, width, height, seed)
+
+    # darknet.py and the backend are imported again on top of the fake lib, and
+    # dropped with it
+    monkeypatch.delitem(sys.modules, "darknet", raising=False)
+    monkeypatch.delitem(sys.modules, "detectors.yolo_detector", raising=False)
+
+    # darknet.py binds CDLL with `from ctypes import *` when it is imported
+    cdll = ctypes.CDLL
+    ctypes.CDLL = lambda *args, **kwargs: lib
+    try:
+        lib.darknet = importlib.import_module("darknet")
+    finally:
+        ctypes.CDLL = cdll
+
+    return lib
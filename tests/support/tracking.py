@@ -0,0 +1,33 @@
+import io
+
+from trackers import KalmanTracker
+from utils import init_direction_detector, init_within_interval
+
+LANES = ["1", "2", "3"]
+
+
+def make_kalman_tracker(camera_meta, class_names, rng, max_absent=4):
+    """KalmanTracker for a camera, writing its trackpaths to a StringIO"""
+    # regressions the lost vehicles' velocities and turns come from
+    velocity_regression = {
+        lane: {
+            name: [
+                [rng.uniform(-0.02, 0.02), rng.uniform(-4, 4)],
+                [rng.uniform(-0.02, 0.02), rng.uniform(-4, 4)],
+            ]
+            for name in class_names
+        }
+        for lane in LANES
+    }
+    lane_angles = {lane: rng.uniform(1.5, 3.0) for lane in LANES}
+
+    tracker = KalmanTracker(
+        init_direction_detector(camera_meta),
+        camera_meta["initial_maxdistances"],
+        init_within_interval(camera_meta),
+        lane_angles,
+        velocity_regression,
+        max_absent,
+    )
+    tracker.trackpath_filewriter = io.StringIO()
+    return tracker
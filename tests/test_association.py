@@ -0,0 +1,77 @@
+import numpy as np
+
+from trackers.association import gated_assignment, lane_partitioned_assignment
+
+
+def random_problem(seed, cross_lane):
+    rng = np.random.default_rng(seed)
+    num_tracks, num_dets = rng.integers(1, 30, 2)
+
+    track_lanes = rng.integers(1, 4, num_tracks)
+    det_lanes = rng.integers(1, 4, num_dets)
+    cost = rng.uniform(0, 100, (num_tracks, num_dets))
+
+    gate = rng.uniform(size=cost.shape) < 0.4
+    if not cross_lane:
+        gate &= track_lanes[:, None] == det_lanes[None, :]
+
+    return cost, gate, track_lanes, det_lanes
+
+
+def lane_assignment(cost, gate, track_lanes, det_lanes):
+    no_boundary = np.zeros(len(track_lanes), bool), np.zeros(len(det_lanes), bool)
+    return lane_partitioned_assignment(cost, gate, track_lanes, det_lanes, *no_boundary)
+
+
+def crosses_lanes(rows, cols, track_lanes, det_lanes):
+    return bool((track_lanes[rows] != det_lanes[cols]).any())
+
+
+def test_lane_matches_global_within_lanes():
+    for seed in range(200):
+        problem = random_problem(seed, cross_lane=False)
+
+        rows, cols = gated_assignment(*problem[:2])
+        lane_rows, lane_cols = lane_assignment(*problem)
+
+        assert np.array_equal(rows, lane_rows)
+        assert np.array_equal(cols, lane_cols)
+
+
+def test_lane_matches_global_unless_global_crosses_lanes():
+    num_crossing = 0
+    for seed in range(200):
+        cost, gate, track_lanes, det_lanes = problem = random_problem(seed, True)
+
+        rows, cols = gated_assignment(cost, gate)
+        lane_rows, lane_cols = lane_assignment(*problem)
+
+        if crosses_lanes(rows, cols, track_lanes, det_lanes):
+            num_crossing += 1
+            continue
+
+        assert np.array_equal(rows, lane_rows)
+        assert np.array_equal(cols, lane_cols)
+
+    assert num_crossing > 0
+
+
+def test_lane_keeps_inner_vehicles_in_their_lane():
+    # two vehicles right next to each other's detection across a lane edge
+    cost = np.array([[10.0, 1.0], [1.0, 10.0]])
+    gate = np.ones(cost.shape, bool)
+    track_lanes = det_lanes = np.array([1, 2])
+
+    rows, cols = gated_assignment(cost, gate)
+    assert cols.tolist() == [1, 0]
+
+    # well inside their lanes they are matched within them
+    rows, cols = lane_assignment(cost, gate, track_lanes, det_lanes)
+    assert cols.tolist() == [0, 1]
+
+    # on the boundary they go into the last problem, which is the global one here
+    boundary = np.ones(2, bool)
+    rows, cols = lane_partitioned_assignment(
+        cost, gate, track_lanes, det_lanes, boundary, boundary
+    )
+    assert cols.tolist() == [1, 0]
@@ -0,0 +1,164 @@
+import sys
+import numpy as np
+import pytest
+
+from camera_metadata import CAMERA_METADATA
+from detectors import get_detector_class
+from utils import init_lane_detector
+from tests.support.backend_standins import (
+    install_fake_darknet,
+    install_fake_trt,
+    write_fake_engine,
+)
+
+FRAME_W, FRAME_H = 960, 540
+
+# one vehicle in the middle of every lane of datlcam1, (x1, y1, x2, y2) in pixels
+VEHICLE_RECTS = np.array(
+    [
+        (290, 390, 350, 450),  # left lane
+        (520, 320, 610, 400),  # middle lane
+        (640, 250, 700, 300),  # right lane
+    ],
+    dtype=np.float32,
+)
+VEHICLE_SCORES = np.array([0.95, 0.9, 0.85], dtype=np.float32)
+VEHICLE_CLASSES = np.array([1, 3, 0], dtype=np.int32)  # car, 2t, tw
+
+
+def source():
+    scale = np.array([FRAME_W, FRAME_H, FRAME_W, FRAME_H], dtype=np.float32)
+    return VEHICLE_RECTS / scale, VEHICLE_SCORES, VEHICLE_CLASSES
+
+
+@pytest.fixture
+def frame():
+    return np.zeros((FRAME_H, FRAME_W, 3), dtype=np.uint8)
+
+
+@pytest.fixture
+def lane_detector():
+    return init_lane_detector(CAMERA_METADATA["datlcam1"])
+
+
+@pytest.fixture
+def model_path(tmp_path):
+    # the stand-ins only need the file to exist, the fake engine holds its shapes
+    path = str(tmp_path / "fake.engine")
+    write_fake_engine(path)
+    return path
+
+
+def check_detections(detections):
+    # every vehicle comes back once, its duplicates and the background suppressed
+    assert len(detections) == len(VEHICLE_RECTS)
+
+    order = np.argsort(detections.rects[:, 0])
+    rects = detections.rects[order]
+
+    # duplicates are jittered by a few percent, the best of them may win nms
+    sizes = np.tile(VEHICLE_RECTS[:, 2:] - VEHICLE_RECTS[:, :2], 2)
+    assert np.all(np.abs(rects - VEHICLE_RECTS) <= 0.15 * sizes + 1)
+
+    assert detections.class_ids[order].tolist() == VEHICLE_CLASSES.tolist()
+    assert detections.lanes[order].tolist() == [3, 2, 1]
+    assert np.array_equal(detections.bottoms[order], rects[:, [2, 3]])
+
+    # scores are objectness x class probability, never above the vehicle's own
+    scores = detections.scores[order]
+    assert np.all(scores > 0.5)
+    assert np.all(scores <= VEHICLE_SCORES + 1e-6)
+
+
+def test_lanes_of_vehicles(lane_detector):
+    assert lane_detector.lanes(VEHICLE_RECTS[:, [2, 3]]).tolist() == [3, 2, 1]
+
+
+def test_trt_detect(fake_trt, frame, lane_detector, model_path):
+    fake_trt(source)
+    detector = get_detector_class("trt")(
+        frame, lane_detector, 0.5, engine_path=model_path
+    )
+
+    for _ in range(3):
+        check_detections(detector.detect(frame))
+
+
+def test_trt_decode_keeps_best_candidate_per_class(
+    fake_trt, frame, lane_detector, model_path
+):
+    fake_trt(source)
+    detector = get_detector_class("trt")(
+        frame, lane_detector, 0.5, engine_path=model_path
+    )
+    detector._preprocess(frame, 0)
+    outputs = detector._forward(0)
+
+    boxes, scores, class_ids = detector._decode(list(outputs))
+
+    confs = outputs[1].reshape(-1, detector.num_classes)
+    best = confs.max(axis=1)
+    for class_id in VEHICLE_CLASSES:
+        # the highest scoring candidate of a vehicle's class always survives nms
+        top = np.argmax(np.where(confs.argmax(axis=1) == class_id, best, 0))
+        assert best[top] in scores[class_ids == class_id]
+
+
+def test_vanilla_detect(fake_darknet, frame, lane_detector, model_path):
+    fake_darknet(source)
+    detector = get_detector_class("vanilla")(
+        frame, lane_detector, 0.5, weight_path=model_path
+    )
+
+    for _ in range(3):
+        check_detections(detector.detect(frame))
+
+
+def test_vanilla_detect_batch(fake_darknet, frame, lane_detector, model_path):
+    fake_darknet(source)
+    detector = get_detector_class("vanilla")(
+        frame, lane_detector, 0.5, batch_size=2, weight_path=model_path
+    )
+
+    for detections in detector.detect_batch([frame, frame]):
+        check_detections(detections)
+
+
+def test_standins_are_removed_with_the_monkeypatch(frame, lane_detector, model_path):
+    names = ["tensorrt", "pycuda.driver", "darknet", "detectors.trt_detector"]
+    before = {name: sys.modules.get(name) for name in names}
+
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        install_fake_trt(monkeypatch, source)
+        install_fake_darknet(monkeypatch, source)
+        get_detector_class("trt")(frame, lane_detector, 0.5, engine_path=model_path)
+        trt_backend = sys.modules["detectors.trt_detector"]
+        assert trt_backend is not before["detectors.trt_detector"]
+
+    assert {name: sys.modules.get(name) for name in names} == before
+
+
+def test_trt_truncates_and_darknet_rounds_boxes(
+    fake_trt, fake_darknet, frame, lane_detector, model_path
+):
+    # the car of the middle lane, its corners over half way into the next pixel
+    boxes = np.array([(0.5401, 0.6009, 0.6308, 0.7419)], dtype=np.float32)
+    pixels = (boxes[0] * np.array([FRAME_W, FRAME_H] * 2, dtype=np.float32)).tolist()
+
+    fake_trt(source)
+    trt_detector = get_detector_class("trt")(
+        frame, lane_detector, 0.5, engine_path=model_path
+    )
+    fake_darknet(source)
+    darknet_detector = get_detector_class("vanilla")(
+        frame, lane_detector, 0.5, weight_path=model_path
+    )
+
+    # like int() and round() on every coordinate before the detections were arrays
+    truncated = trt_detector._postpreprocessing(boxes, [0.9], [1])
+    assert truncated.rects[0].tolist() == [int(v) for v in pixels]
+    assert truncated.bottoms[0].tolist() == [int(pixels[2]), int(pixels[3])]
+
+    rounded = darknet_detector._postpreprocessing(boxes, [0.9], [1])
+    assert rounded.rects[0].tolist() == [int(round(v)) for v in pixels]
+    assert rounded.rects[0].tolist() != truncated.rects[0].tolist()
@@ -0,0 +1,128 @@
+import cv2
+import numpy as np
+import pytest
+
+from camera_metadata import CAMERA_METADATA
+from detectors import get_detector_class
+from utils import init_lane_detector
+from tests.support.backend_standins import write_fake_engine
+
+FRAME_W, FRAME_H = 960, 540
+
+# one strided conv and a yolo head, small enough to run on CPU in a few ms
+TINY_YOLO_CFG = """
+[net]
+batch=1
+width=64
+height=64
+channels=3
+
+[convolutional]
+filters=8
+size=3
+stride=2
+pad=1
+activation=leaky
+
+[convolutional]
+filters=57
+size=1
+stride=1
+pad=1
+activation=linear
+
+[yolo]
+mask=0,1,2
+anchors=10,14, 23,27, 37,58
+classes=14
+num=3
+"""
+
+
+def write_tiny_yolo(yolo_dir, seed=0):
+    rng = np.random.default_rng(seed)
+    # biases low enough that only a few boxes clear the detection threshold
+    head_bias = np.tile(np.r_[np.zeros(4), 3.0, np.full(14, -3.0)], 3)
+    weights = np.concatenate(
+        [
+            rng.normal(0, 1, 8),
+            rng.normal(0, 0.5, 8 * 3 * 3 * 3),
+            head_bias,
+            rng.normal(0, 0.5, 57 * 8),
+        ]
+    )
+
+    yolo_dir.mkdir()
+    (yolo_dir / "yolov4.cfg").write_text(TINY_YOLO_CFG)
+    with open(yolo_dir / "yolov4.weights", "wb") as f:
+        # major, minor, revision and images seen
+        np.array([0, 2, 0], dtype=np.int32).tofile(f)
+        np.array([0], dtype=np.int64).tofile(f)
+        weights.astype(np.float32).tofile(f)
+
+
+def source():
+    boxes = np.array([(0.3, 0.72, 0.36, 0.83), (0.54, 0.6, 0.63, 0.74)])
+    return boxes, np.array([0.95, 0.9]), np.array([1, 3])
+
+
+@pytest.fixture
+def frames():
+    rng = np.random.default_rng(0)
+    return [
+        rng.integers(0, 256, (FRAME_H, FRAME_W, 3), dtype=np.uint8) for _ in range(6)
+    ]
+
+
+@pytest.fixture
+def lane_detector():
+    return init_lane_detector(CAMERA_METADATA["datlcam1"])
+
+
+def assert_same_detections(expected, actual):
+    assert len(expected) == len(actual)
+    assert np.array_equal(expected.rects, actual.rects)
+    assert np.array_equal(expected.scores, actual.scores)
+    assert np.array_equal(expected.class_ids, actual.class_ids)
+    assert np.array_equal(expected.lanes, actual.lanes)
+
+
+@pytest.mark.skipif(
+    not hasattr(cv2.dnn, "readNetFromDarknet"), reason="opencv without darknet"
+)
+@pytest.mark.parametrize("farfield_roi", [None, (0, 90, 360, 290)])
+def test_opencv_detect_async(tmp_path, monkeypatch, frames, lane_detector, farfield_roi):
+    write_tiny_yolo(tmp_path / "yolo_stuff")
+    monkeypatch.chdir(tmp_path)
+
+    detector = get_detector_class("opencv")(
+        frames[0], lane_detector, 0.5, farfield_roi=farfield_roi
+    )
+    expected = [detector.detect(frame) for frame in frames]
+    assert sum(len(detections) for detections in expected) > 0
+
+    futures = [detector.detect_async(frame, idx) for idx, frame in enumerate(frames)]
+    for detections, future in zip(expected, futures):
+        assert_same_detections(detections, future.result())
+
+    detector.close()
+
+
+def test_trt_detect_async(fake_trt, tmp_path, frames, lane_detector):
+    engine_path = str(tmp_path / "fake.engine")
+    write_fake_engine(engine_path)
+    fake_trt(source)
+
+    # same seed, so both engines put out the same candidates frame after frame
+    trt_detector = get_detector_class("trt")
+    sync_detector = trt_detector(frames[0], lane_detector, 0.5, engine_path=engine_path)
+    async_detector = trt_detector(frames[0], lane_detector, 0.5, engine_path=engine_path)
+
+    expected = [sync_detector.detect(frame) for frame in frames]
+    assert all(len(detections) == 2 for detections in expected)
+
+    futures = [async_detector.detect_async(frame) for frame in frames]
+    for detections, future in zip(expected, futures):
+        assert_same_detections(detections, future.result())
+
+    async_detector.close()
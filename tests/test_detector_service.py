@@ -0,0 +1,72 @@
+import queue
+import time
+
+from detectors import CameraStream, DetectorService
+from utils import StopStage
+
+
+class CountingDetector(object):
+    def __init__(self) -> None:
+        self.batches = []
+
+    def detect_batch(self, frames, lane_detectors, bottom_types):
+        self.batches.append(list(frames))
+        return [f"detections of {frame}" for frame in frames]
+
+
+def make_service(num_cameras, **kwargs):
+    cameras = [
+        CameraStream(
+            [f"cam{idx} slot{slot}" for slot in range(4)], None, "", queue.Queue()
+        )
+        for idx in range(num_cameras)
+    ]
+    detector = CountingDetector()
+    service = DetectorService(detector, queue.Queue(), cameras, **kwargs)
+    return service, detector
+
+
+def results(camera):
+    items = []
+    while not camera.out_queue.empty():
+        items.append(camera.out_queue.get())
+    return items
+
+
+def run_timed(service, requests):
+    for request in requests:
+        service.request_queue.put(request)
+
+    tik = time.time()
+    service.run()
+    return time.time() - tik
+
+
+def test_batch_stops_waiting_once_every_camera_stopped():
+    service, detector = make_service(2, max_batch=4, max_wait=5.0, timeout=0.01)
+
+    # camera 0 is done before camera 1's last frames come in
+    requests = [StopStage(), (1, 0), (1, 1), StopStage()]
+    assert run_timed(service, requests) < 1.0
+
+    assert detector.batches == [["cam1 slot0", "cam1 slot1"]]
+    assert service.num_stops == 2
+
+    camera0, camera1 = service.cameras
+    [stop] = results(camera0)
+    assert isinstance(stop, StopStage)
+    assert results(camera1)[:-1] == [
+        ("detections of cam1 slot0", 0),
+        ("detections of cam1 slot1", 1),
+    ]
+
+
+def test_stops_are_counted_across_batches():
+    service, detector = make_service(2, max_batch=2, max_wait=5.0, timeout=0.01)
+
+    requests = [(0, 0), StopStage(), (1, 0), (1, 1), StopStage()]
+    assert run_timed(service, requests) < 1.0
+
+    assert detector.batches == [["cam0 slot0", "cam1 slot0"], ["cam1 slot1"]]
+    for camera in service.cameras:
+        assert isinstance(results(camera)[-1], StopStage)
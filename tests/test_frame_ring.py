@@ -0,0 +1,168 @@
+import threading
+import time
+from functools import partial
+from multiprocessing import Process
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from utils import QUEUE_POLICIES, SharedFrameRing, StageQueue, StageWorker, StopStage
+from utils import put_while_alive
+
+FRAME_SHAPE = (8, 8, 3)
+QUEUE_SIZE = 4
+
+
+def test_acquire_release_close():
+    ring = SharedFrameRing(3, FRAME_SHAPE)
+
+    slots = [ring.acquire(timeout=1) for _ in range(3)]
+    assert sorted(slots) == [0, 1, 2]
+    assert ring.acquire(timeout=0.01) is None
+
+    ring[slots[0]][...] = 7
+    assert (ring[slots[0]] == 7).all()
+
+    ring.release(slots[1])
+    assert ring.acquire(timeout=1) == slots[1]
+    assert ring.write(np.zeros(FRAME_SHAPE, dtype=np.uint8), timeout=0.01) is None
+
+    ring.release(slots[2])
+    assert ring.write(np.full(FRAME_SHAPE, 9, dtype=np.uint8), timeout=1) == slots[2]
+    assert (ring[slots[2]] == 9).all()
+
+    ring.close(unlink=True)
+
+
+def fill_slot(ring, slot, value):
+    ring[slot][...] = value
+    ring.release(slot)
+    ring.close()
+
+
+def test_other_processes_share_the_frames():
+    # passed to a Process like atcc_mp's stages get it
+    ring = SharedFrameRing(2, FRAME_SHAPE)
+    slot = ring.acquire(timeout=1)
+
+    process = Process(target=fill_slot, args=(ring, slot, 5))
+    process.start()
+    process.join(timeout=30)
+
+    assert process.exitcode == 0
+    assert (ring[slot] == 5).all()
+    assert sorted(ring.acquire(timeout=1) for _ in range(2)) == [0, 1]
+
+    ring.close(unlink=True)
+
+
+@pytest.fixture
+def vehicle_tracking():
+    # only what _release_dropped_frame touches, the rest of VehicleTracking needs
+    # a camera
+    atcc_mp = pytest.importorskip("atcc_mp", exc_type=ImportError)
+    holder = SimpleNamespace(frame_ring=None)
+    return holder, partial(atcc_mp.VehicleTracking._release_dropped_frame, holder)
+
+
+def test_dropped_frame_releases_its_slot(vehicle_tracking):
+    holder, release_dropped_frame = vehicle_tracking
+    stage_queue = StageQueue(1, "drop-oldest", on_drop=release_dropped_frame)
+    holder.frame_ring = ring = SharedFrameRing(2, FRAME_SHAPE)
+
+    first, second = ring.acquire(timeout=1), ring.acquire(timeout=1)
+    stage_queue.put((first, 1, []))
+    stage_queue.put((second, 2, []))
+
+    assert stage_queue.dropped == 1
+    assert stage_queue.get(timeout=1) == (second, 2, [])
+    assert ring.acquire(timeout=1) == first
+
+    ring.close(unlink=True)
+
+
+def run_pipeline(ring, preprocessed, tilldetection, batch_size, num_frames):
+    # atcc_mp's three stages, capture on this thread, detection and postprocessing
+    # on two others holding on to their frames for a while
+    processed, errors = [], []
+
+    def check(slot, frame_count):
+        if not (ring[slot] == frame_count % 256).all():
+            errors.append(f"frame {frame_count} was overwritten in slot {slot}")
+
+    def detect(items):
+        for slot, frame_count, _ in items:
+            check(slot, frame_count)
+        time.sleep(0.001)
+        return [(slot, None, frame_count, fps) for slot, frame_count, fps in items]
+
+    def postprocess(item):
+        slot, _, frame_count, _ = item
+        check(slot, frame_count)
+        time.sleep(0.002)
+        processed.append(frame_count)
+        ring.release(slot)
+
+    detection = threading.Thread(
+        target=StageWorker(
+            preprocessed,
+            (lambda item: detect([item])[0]) if batch_size == 1 else detect,
+            tilldetection,
+            timeout=0.05,
+            batch_size=batch_size,
+        ).run
+    )
+    postprocessing = threading.Thread(
+        target=StageWorker(tilldetection, postprocess, timeout=0.05).run
+    )
+    detection.start()
+    postprocessing.start()
+
+    for frame_count in range(1, num_frames + 1):
+        slot = None
+        deadline = time.time() + 10
+        while slot is None and time.time() < deadline:
+            slot = ring.acquire(timeout=1)
+        assert slot is not None, f"no free slot for frame {frame_count}"
+
+        ring[slot][...] = frame_count % 256
+        assert put_while_alive(preprocessed, (slot, frame_count, []), detection)
+
+    assert put_while_alive(preprocessed, StopStage(), detection)
+    detection.join(timeout=10)
+    postprocessing.join(timeout=10)
+    assert not detection.is_alive() and not postprocessing.is_alive()
+
+    assert errors == []
+    return processed
+
+
+@pytest.mark.parametrize("batch_size", [1, 4])
+@pytest.mark.parametrize("policy", QUEUE_POLICIES)
+def test_full_queues_leak_no_slots(vehicle_tracking, policy, batch_size):
+    holder, release_dropped_frame = vehicle_tracking
+    preprocessed = StageQueue(QUEUE_SIZE, policy, on_drop=release_dropped_frame)
+    tilldetection = StageQueue(QUEUE_SIZE, policy, on_drop=release_dropped_frame)
+
+    # sized like atcc_mp's
+    num_slots = preprocessed.maxsize + tilldetection.maxsize + batch_size + 3
+    holder.frame_ring = ring = SharedFrameRing(num_slots, FRAME_SHAPE)
+
+    num_frames = 300
+    processed = run_pipeline(ring, preprocessed, tilldetection, batch_size, num_frames)
+
+    assert processed == sorted(processed)
+    num_dropped = preprocessed.dropped + tilldetection.dropped
+    assert len(processed) + num_dropped == num_frames
+    if policy == "block":
+        assert num_dropped == 0
+    else:
+        assert num_dropped > 0
+
+    # every slot is free again
+    slots = [ring.acquire(timeout=1) for _ in range(num_slots)]
+    assert sorted(slots) == list(range(num_slots))
+    assert ring.acquire(timeout=0.01) is None
+
+    ring.close(unlink=True)
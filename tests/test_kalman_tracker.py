@@ -0,0 +1,140 @@
+import math
+
+import numpy as np
+
+from camera_metadata import CAMERA_METADATA
+from detectors import get_detector_class
+from tests.support.tracking import make_kalman_tracker
+from trackers import kalman_filter
+from utils import Detections, init_lane_detector
+
+F, H, R = kalman_filter.F, kalman_filter.H, kalman_filter.R
+Q, I = kalman_filter.Q, kalman_filter.I
+
+
+# the per object filter KalmanTracker ran before BatchedKalmanFilter
+def reference_predict(obj, state, P, lost, tracker):
+    x = F @ np.array([state], dtype=float).T
+    x = tuple(x.astype(int).ravel().tolist())
+
+    if lost:
+        x = list(x)
+
+        (mx, cx), (my, cy) = tracker.velocity_regression[obj.lane][obj.obj_class[0]]
+        x[1] = mx * x[0] + cx
+        x[3] = my * x[2] + cy
+
+        pt1 = [state[0], -state[2]]
+        pt2 = [x[0], -x[2]]
+        angle = tracker.lane_angles[obj.lane] - math.atan2(
+            pt2[1] - pt1[1], pt2[0] - pt1[0]
+        )
+
+        c, s = math.cos(angle), math.sin(angle)
+        pt2[0] -= pt1[0]
+        pt2[1] -= pt1[1]
+
+        x[0] = int(pt1[0] + c * pt2[0] - s * pt2[1])
+        x[2] = -int(pt1[1] + s * pt2[0] + c * pt2[1])
+        x = tuple(x)
+
+    return x, F @ P @ F.T + Q
+
+
+def reference_update(state, P, z):
+    x = np.array([state], dtype=float).T
+    e = np.array(z).reshape(1, 2).T - H @ x
+
+    PHT = P @ H.T
+    K = PHT @ np.linalg.inv(H @ PHT + R)
+    x += K @ e
+
+    IKH = I - K @ H
+    return tuple(x.astype(int).ravel().tolist()), (IKH @ P @ IKH.T) + (K @ R @ K.T)
+
+
+def test_batched_filter_matches_the_per_object_filter():
+    camera_meta = CAMERA_METADATA["datlcam1"]
+    frame = np.zeros((540, 960, 3), dtype=np.uint8)
+    detector = get_detector_class("synthetic")(
+        frame,
+        init_lane_detector(camera_meta),
+        0.5,
+        camera_meta=camera_meta,
+        num_vehicles=30,
+        dropout=0.2,
+        jitter=1.0,
+    )
+
+    rng = np.random.default_rng(0)
+    tracker = make_kalman_tracker(camera_meta, detector.class_names, rng)
+
+    expected = {}  # obj_id -> (state, P, path)
+    num_steps = {"new": 0, "matched": 0, "lost": 0, "coasted": 0, "untouched": 0}
+
+    for frame_idx in range(120):
+        detections = detector.detect(frame)
+        if frame_idx % 11 == 10:
+            detections = Detections.empty(detector.class_names)
+
+        # tracks the assignment leaves unmatched without marking them lost
+        # (more detections than tracks) don't step at all
+        before = {
+            obj_id: (len(obj.path), obj.absent_count)
+            for obj_id, obj in tracker.objects.items()
+        }
+
+        coast = frame_idx % 7 == 6
+        if coast:
+            tracker.predict()
+        else:
+            tracker.update(detections)
+
+        for obj_id, obj in tracker.objects.items():
+            if obj_id not in expected:
+                num_steps["new"] += 1
+                state, P = reference_update(
+                    (0, 0, 0, 0), kalman_filter.P0, obj.path[-1]
+                )
+                expected[obj_id] = state, P, [obj.path[-1]]
+                assert obj.state == state
+                continue
+
+            state, P, path = expected[obj_id]
+            path_len, absent_count = before[obj_id]
+            if coast:
+                num_steps["coasted"] += 1
+                state, P = reference_predict(obj, state, P, False, tracker)
+                assert obj.absent_count == absent_count
+            elif len(obj.path) == path_len:
+                num_steps["untouched"] += 1
+                assert obj.absent_count == absent_count
+            elif obj.absent_count > absent_count:
+                num_steps["lost"] += 1
+                state, P = reference_predict(obj, state, P, True, tracker)
+            else:
+                num_steps["matched"] += 1
+                assert obj.absent_count == 0
+                col = np.flatnonzero((detections.rects == obj.rect).all(axis=1))
+                assert len(col) == 1
+                state, P = reference_predict(obj, state, P, False, tracker)
+                state, P = reference_update(state, P, detections.bottom(col[0]))
+
+            if len(obj.path) != path_len:
+                path.append((state[0], state[2]))
+            expected[obj_id] = state, P, path
+
+            assert obj.state == state
+            np.testing.assert_allclose(
+                tracker.kf.covariances[tracker.kf.row_of[obj_id]], P, rtol=1e-9
+            )
+
+            assert len(obj.path) == len(path)
+            kept = obj.path.last(len(path))
+            assert kept == path[-len(kept) :]
+
+        for obj_id in set(expected).difference(tracker.objects):
+            del expected[obj_id]
+
+    del num_steps["untouched"]
+    assert min(num_steps.values()) > 50, num_steps
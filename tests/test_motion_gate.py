@@ -0,0 +1,124 @@
+import numpy as np
+
+from camera_metadata import CAMERA_METADATA
+from detectors import get_detector_class
+from tests.support.tracking import make_kalman_tracker
+from utils import Detections, MotionGate, init_lane_detector
+
+FRAME_SHAPE = (540, 960, 3)
+
+
+def make_gate(**kwargs):
+    lane_detector = init_lane_detector(CAMERA_METADATA["datlcam1"])
+    lane_mask = lane_detector.lane_mask(FRAME_SHAPE).astype(bool)
+    return MotionGate(lane_detector, FRAME_SHAPE, **kwargs), lane_mask
+
+
+def test_static_moving_and_forced_frames():
+    gate, lane_mask = make_gate(max_skip=3)
+    road = np.full(FRAME_SHAPE, 80, dtype=np.uint8)
+
+    # the first frame has nothing to difference against
+    assert gate(road) and not gate.forced
+
+    # static frame
+    assert not gate(road.copy())
+
+    # moving frame, a vehicle sized blob inside the lanes
+    ys, xs = np.nonzero(lane_mask)
+    y, x = int(np.median(ys)), int(np.median(xs))
+    moving = road.copy()
+    moving[y - 30 : y + 30, x - 40 : x + 40] = 230
+    assert lane_mask[y - 30 : y + 30, x - 40 : x + 40].all()
+    assert gate(moving) and not gate.forced
+
+    # motion outside the lanes doesn't count
+    outside = moving.copy()
+    outside[0:120, 0:160] = 230
+    assert not lane_mask[0:120, 0:160].any()
+    assert not gate(outside)
+
+    # forced after `max_skip` skipped frames in a row
+    assert not gate(outside) and not gate(outside)
+    assert gate(outside) and gate.forced
+    assert not gate(outside) and not gate.forced
+
+    assert gate.num_frames == 8
+    assert gate.num_skipped == 5
+    assert gate.num_forced == 1
+    assert gate.skip_ratio == 5 / 8
+
+
+def test_audit_counts_vehicles_missed_by_the_gate():
+    gate, _ = make_gate()
+
+    # in order, (vehicles detected, forced frame)
+    for num_detections, forced in [
+        (3, False),
+        (3, True),  # nothing new
+        (5, False),  # moved in and seen
+        (2, True),  # left
+        (4, True),  # drove in unnoticed
+        (6, False),
+        (6, True),
+        (7, True),  # drove in unnoticed
+    ]:
+        gate.audit(num_detections, forced)
+
+    assert gate.num_missed_motion == 2
+    assert "2 missed-motion events" in gate.report()
+
+
+def test_coasted_tracks_are_not_absent_and_deregister_once_gone():
+    camera_meta = CAMERA_METADATA["datlcam1"]
+    frame = np.zeros(FRAME_SHAPE, dtype=np.uint8)
+    detector = get_detector_class("synthetic")(
+        frame,
+        init_lane_detector(camera_meta),
+        0.5,
+        camera_meta=camera_meta,
+        num_vehicles=8,
+    )
+    tracker = make_kalman_tracker(
+        camera_meta, detector.class_names, np.random.default_rng(0), max_absent=4
+    )
+
+    for _ in range(5):
+        tracker.update(detector.detect(frame))
+
+    assert len(tracker.objects) > 0
+    before = {
+        obj_id: (len(obj.path), obj.absent_count)
+        for obj_id, obj in tracker.objects.items()
+    }
+    # trucks write their axle track, the synthetic detector has no axles
+    with_trackpath = sorted(
+        obj_id
+        for obj_id, obj in tracker.objects.items()
+        if obj.obj_class[0] not in ["2t", "3t", "4t", "5t", "6t", "bus", "lgv"]
+    )
+    assert len(with_trackpath) > 0
+
+    # skipped frames, far more of them than max_absent
+    num_coasted = 3 * tracker.max_absent
+    for _ in range(num_coasted):
+        tracker.predict()
+
+    assert set(tracker.objects) == set(before)
+    for obj_id, obj in tracker.objects.items():
+        path_len, absent_count = before[obj_id]
+        assert obj.absent_count == absent_count
+        assert len(obj.path) == path_len + num_coasted
+        assert obj.path[-1] == (obj.state[0], obj.state[2])
+
+    # detection resumes and the vehicles are gone
+    empty = Detections.empty(detector.class_names)
+    for _ in range(tracker.max_absent):
+        tracker.update(empty)
+    assert set(tracker.objects) == set(before)
+
+    tracker.update(empty)
+    assert len(tracker.objects) == 0
+
+    written = tracker.trackpath_filewriter.getvalue().splitlines()
+    assert sorted(int(line.split(" : ")[0]) for line in written) == with_trackpath
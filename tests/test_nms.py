@@ -0,0 +1,114 @@
+import numpy as np
+import pytest
+
+from utils import detector_utils
+from utils.detector_utils import intersection_over_union, nonmax_suppression
+
+
+def reference_nms(rects, scores, iou_thresh, class_ids=None):
+    # the textbook greedy nms, one rect pair at a time
+    if class_ids is None:
+        class_ids = [0] * len(rects)
+
+    remaining = sorted(range(len(rects)), key=lambda idx: -scores[idx])
+    keep = []
+    while remaining:
+        idx = remaining.pop(0)
+        keep.append(idx)
+        remaining = [
+            other
+            for other in remaining
+            if class_ids[other] != class_ids[idx]
+            or intersection_over_union(rects[idx], rects[other]) < iou_thresh
+        ]
+
+    return keep
+
+
+def random_detections(rng, num_rects, num_classes):
+    # a few rects around each of a few vehicles, so that most get suppressed
+    centres = rng.uniform(0, 960, size=(max(num_rects // 6, 1), 2))
+    centres = centres[rng.integers(0, len(centres), size=num_rects)]
+    sizes = rng.uniform(20, 120, size=(num_rects, 2))
+    centres += rng.normal(0, 8, size=centres.shape)
+
+    rects = np.hstack([centres - sizes / 2, centres + sizes / 2])
+    # ties in score keep the order of the rects
+    scores = rng.integers(0, num_rects // 2 + 1, size=num_rects) / num_rects
+    class_ids = rng.integers(0, num_classes, size=num_rects)
+
+    return rects, scores, class_ids
+
+
+def record_tiers(monkeypatch):
+    tiers = []
+    for name in ("_nms_loop", "_nms_matrix", "_nms_shrinking"):
+        tier = getattr(detector_utils, name)
+
+        def recorded(*args, _tier=tier, _name=name):
+            tiers.append(_name)
+            return _tier(*args)
+
+        monkeypatch.setattr(detector_utils, name, recorded)
+
+    return tiers
+
+
+@pytest.mark.parametrize(
+    "num_rects, tier",
+    [
+        (1, "_nms_loop"),
+        (16, "_nms_loop"),
+        (17, "_nms_matrix"),
+        (512, "_nms_matrix"),
+        (513, "_nms_shrinking"),
+        (1100, "_nms_shrinking"),
+    ],
+)
+def test_nms_matches_the_reference(monkeypatch, num_rects, tier):
+    rng = np.random.default_rng(num_rects)
+    rects, scores, _ = random_detections(rng, num_rects, 1)
+
+    tiers = record_tiers(monkeypatch)
+    keep = nonmax_suppression(rects, scores, 0.45)
+
+    assert tiers == [tier]
+    assert keep.tolist() == reference_nms(rects.tolist(), scores.tolist(), 0.45)
+    assert len(keep) < num_rects or num_rects == 1
+
+
+@pytest.mark.parametrize(
+    "num_rects, num_classes, tiers",
+    [
+        (16, 3, ["_nms_loop"]),
+        (17, 3, ["_nms_matrix"]),
+        (256, 3, ["_nms_matrix"]),
+        (257, 3, ["_nms_matrix"] * 3),
+        (512, 1, ["_nms_matrix"]),
+        (513, 1, ["_nms_shrinking"]),
+        (1100, 2, ["_nms_shrinking"] * 2),
+    ],
+)
+def test_class_aware_nms_matches_the_reference(
+    monkeypatch, num_rects, num_classes, tiers
+):
+    rng = np.random.default_rng(num_rects)
+    rects, scores, class_ids = random_detections(rng, num_rects, num_classes)
+
+    recorded = record_tiers(monkeypatch)
+    keep = nonmax_suppression(rects, scores, 0.45, class_ids)
+
+    assert recorded == tiers
+    assert keep.tolist() == reference_nms(
+        rects.tolist(), scores.tolist(), 0.45, class_ids.tolist()
+    )
+
+    # rects of another class are never suppressed
+    if num_classes > 1:
+        assert keep.tolist() != reference_nms(
+            rects.tolist(), scores.tolist(), 0.45
+        )
+
+
+def test_nms_of_no_rects():
+    assert nonmax_suppression(np.zeros((0, 4)), np.zeros(0), 0.45).tolist() == []
@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+
+from camera_metadata import CAMERA_METADATA
+from detectors import get_detector_class
+from utils import DetectionCache, DetectionRecorder, init_lane_detector
+from utils import detection_cache_path
+
+
+def test_replay_skips_frames_missing_from_recording(tmp_path, capsys):
+    path = str(tmp_path / "clip.dets")
+    recorder = DetectionRecorder(path, "inputs/datlcam1_clip1.mp4")
+    # a car in the middle lane of datlcam1 on frame 1, nothing recorded for frame 2
+    recorder.write(1, [(0.54, 0.6, 0.63, 0.74)], [0.9], [1])
+    recorder.write(3, np.zeros((0, 4)), [], [])
+    recorder.close()
+
+    frame = np.zeros((540, 960, 3), dtype=np.uint8)
+    detector = get_detector_class("replay")(
+        frame, init_lane_detector(CAMERA_METADATA["datlcam1"]), 0.5, cache_path=path
+    )
+
+    assert len(detector.detect(frame, 1)) == 1
+    assert len(detector.detect(frame, 2)) == 0
+    assert len(detector.detect(frame, 4)) == 0
+    assert len(detector.detect(frame, 3)) == 0
+
+    assert detector.num_missing == 2
+    assert capsys.readouterr().out.count("was not recorded") == 1
+
+
+def test_streams_of_the_same_name_get_their_own_cache():
+    hyderabad = detection_cache_path("hyderabad", "rtsp://admin@192.168.10.65/1")
+    kurnul = detection_cache_path("kurnul", "rtsp://admin@192.168.10.64/1")
+    other_nvr = detection_cache_path("hyderabad", "rtsp://admin@192.168.10.66/1")
+
+    assert len({hyderabad, kurnul, other_nvr}) == 3
+    assert detection_cache_path("datlcam1", "inputs/datlcam1_clip1.mp4").startswith(
+        "detection_cache/datlcam1_datlcam1_clip1_"
+    )
+
+
+def test_replay_rejects_a_recording_of_another_source(tmp_path):
+    path = str(tmp_path / "clip.dets")
+    recorder = DetectionRecorder(path, "rtsp://admin@192.168.10.65/1")
+    recorder.write(1, [(0.54, 0.6, 0.63, 0.74)], [0.9], [1])
+    recorder.close()
+
+    assert DetectionCache(path).source == "rtsp://admin@192.168.10.65/1"
+    assert len(DetectionCache(path, "rtsp://admin@192.168.10.65/1")) == 1
+
+    frame = np.zeros((540, 960, 3), dtype=np.uint8)
+    with pytest.raises(ValueError):
+        get_detector_class("replay")(
+            frame,
+            init_lane_detector(CAMERA_METADATA["datlcam1"]),
+            0.5,
+            cache_path=path,
+            source="rtsp://admin@192.168.10.64/1",
+        )
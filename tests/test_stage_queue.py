@@ -0,0 +1,28 @@
+import queue
+import pytest
+from multiprocessing import Process
+
+from utils import StageQueue, put_while_alive
+
+
+def finished_process():
+    process = Process(target=int)
+    process.start()
+    process.join()
+    return process
+
+
+def test_put_while_alive_gives_up_on_dead_consumer():
+    stage_queue = StageQueue(1)
+    stage_queue.put("frame")
+
+    assert not put_while_alive(stage_queue, "next frame", finished_process(), 0.01)
+    assert stage_queue.get(timeout=1) == "frame"
+
+
+def test_put_without_room_times_out():
+    stage_queue = StageQueue(1)
+    stage_queue.put("frame")
+
+    with pytest.raises(queue.Full):
+        stage_queue.put("next frame", timeout=0.01)
@@ -0,0 +1,114 @@
+import io
+
+import numpy as np
+import pytest
+
+from trackers import CentroidTracker
+from trackers.base_tracker import VehicleObject
+from trackers.track_buffer import TrackBuffer
+
+
+def random_track(rng, length):
+    return [tuple(pt) for pt in rng.integers(0, 1000, size=(length, 2)).tolist()]
+
+
+# what `history` samples: every `stride`-th point for the smallest power of two
+# stride they fit in `history_capacity` at, and the last point
+def reference_history(points, history_capacity):
+    stride = 1
+    while len(points[::stride]) > history_capacity:
+        stride *= 2
+
+    history = points[::stride]
+    if points and history[-1] != points[-1]:
+        history.append(points[-1])
+
+    return history
+
+
+@pytest.mark.parametrize("length", [0, 1, 9, 10, 11, 25, 31, 64, 65, 200])
+def test_ring_wraps_around(length):
+    rng = np.random.default_rng(length)
+    points = random_track(rng, length)
+
+    buffer = TrackBuffer(capacity=10, history_capacity=16)
+    for pt in points:
+        buffer.append(pt)
+
+    assert len(buffer) == length
+    assert buffer.last(10) == points[-10:]
+    assert buffer.last(3) == points[-3:]
+    assert buffer.last(100) == points[-10:]
+
+    for idx in range(max(length - 10, 0), length):
+        assert buffer[idx] == points[idx]
+        assert buffer[idx - length] == points[idx]
+
+    # points pushed out of the ring, and past the end, are not kept
+    with pytest.raises(IndexError):
+        buffer[length]
+    with pytest.raises(IndexError):
+        buffer[-length - 1]
+    if length > 10:
+        with pytest.raises(IndexError):
+            buffer[length - 11]
+
+
+@pytest.mark.parametrize("history_capacity", [4, 7, 16, 64])
+def test_history_is_ordered_and_ends_at_the_last_point(history_capacity):
+    rng = np.random.default_rng(history_capacity)
+    points = random_track(rng, 300)
+
+    buffer = TrackBuffer(capacity=10, history_capacity=history_capacity)
+    for length, pt in enumerate(points, start=1):
+        buffer.append(pt)
+
+        history = buffer.history()
+        assert history == reference_history(points[:length], history_capacity)
+        assert len(history) <= history_capacity + 1
+
+        if length <= history_capacity:
+            assert history == points[:length]
+
+
+def deregistered_line(obj_class, points, history_len=64):
+    tracker = CentroidTracker(None, {}, None, {}, {}, 5, history_len=history_len)
+    tracker.trackpath_filewriter = io.StringIO()
+
+    obj = VehicleObject(
+        7,
+        points[-1],
+        (0, 0, 10, 10),
+        "1",
+        True,
+        TrackBuffer(tracker.max_track_pts, tracker.history_len),
+        0,
+        [obj_class, 0.9],
+        TrackBuffer(tracker.max_track_pts, tracker.history_len),
+    )
+    track = obj.axle_track if obj_class == "3t" else obj.path
+    for pt in points:
+        track.append(pt)
+
+    tracker.objects[7] = obj
+    tracker._deregister_object(7)
+
+    assert 7 not in tracker.objects
+    return tracker.trackpath_filewriter.getvalue()
+
+
+@pytest.mark.parametrize("obj_class", ["car", "3t"])
+@pytest.mark.parametrize("length", [1, 2, 35, 64])
+def test_trackpath_matches_the_list_path(obj_class, length):
+    points = random_track(np.random.default_rng(length), length)
+
+    # the line written before paths were TrackBuffers, from the whole list
+    expected = f"7 : {obj_class} : {points}\n" if length >= 2 else ""
+    assert deregistered_line(obj_class, points) == expected
+
+
+def test_long_trackpath_is_downsampled():
+    points = random_track(np.random.default_rng(0), 500)
+
+    expected = f"7 : car : {reference_history(points, 64)}\n"
+    assert deregistered_line("car", points) == expected
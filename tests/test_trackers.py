@@ -0,0 +1,15 @@
+import pytest
+
+from trackers import CentroidTracker, KalmanTracker
+
+
+def make_tracker(tracker_class, **kwargs):
+    return tracker_class(None, {}, None, {}, {}, 5, **kwargs)
+
+
+def test_grid_candidates_need_an_ellipse_of_search():
+    with pytest.raises(ValueError):
+        make_tracker(CentroidTracker, candidates="grid")
+
+    assert make_tracker(CentroidTracker).candidates == "dense"
+    assert make_tracker(KalmanTracker, candidates="grid").candidates == "grid"
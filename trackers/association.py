@@ -0,0 +1,236 @@
+import numpy as np
+from scipy import sparse
+from scipy.optimize import linear_sum_assignment
+
+try:
+    from scipy.sparse.csgraph import min_weight_full_bipartite_matching
+except ImportError:
+    # scipy < 1.6, every problem is solved dense
+    min_weight_full_bipartite_matching = None
+
+# the sparse matcher beats the dense one once there are this many track x
+# detection pairs and few enough of them are in a gate
+SPARSE_MIN_PAIRS = 1500 * 1500
+SPARSE_MAX_DENSITY = 0.05
+
+
+def in_ellipses(centres, semi_majoraxes, semi_minoraxes, angles, pts) -> np.ndarray:
+    """
+    whether pts[i] lies in the i-th ellipse, arguments broadcast against each other
+    with the coordinates on the last axis of `centres` and `pts`, angles in degrees
+    """
+    centres = np.asarray(centres, dtype=np.float64)
+    pts = np.asarray(pts, dtype=np.float64)
+    angles = np.radians(np.asarray(angles, dtype=np.float64))
+
+    cosa, sina = np.cos(angles), np.sin(angles)
+    dx = pts[..., 0] - centres[..., 0]
+    dy = pts[..., 1] - centres[..., 1]
+
+    a = np.asarray(semi_majoraxes, dtype=np.float64)
+    b = np.asarray(semi_minoraxes, dtype=np.float64)
+
+    return (cosa * dx + sina * dy) ** 2 / (a * a) + (sina * dx - cosa * dy) ** 2 / (
+        b * b
+    ) <= 1
+
+
+def ellipse_gate(centres, semi_majoraxes, semi_minoraxes, angles, pts) -> np.ndarray:
+    """
+    (T, D) bool, whether every point lies in every track's ellipse of search,
+    the ellipses given by the parameters of their EllipseofSearch, angles in degrees
+    """
+    centres = np.asarray(centres, dtype=np.float64).reshape(-1, 1, 2)
+    pts = np.asarray(pts, dtype=np.float64).reshape(1, -1, 2)
+
+    return in_ellipses(
+        centres,
+        np.asarray(semi_majoraxes, dtype=np.float64)[:, None],
+        np.asarray(semi_minoraxes, dtype=np.float64)[:, None],
+        np.asarray(angles, dtype=np.float64)[:, None],
+        pts,
+    )
+
+
+def _masked_assignment(pair_rows, pair_cols, pair_costs, shape) -> tuple:
+    # out of gate pairs cost more than all gated ones together, so the solution
+    # first matches as many gated pairs as it can and never trades one for them
+    infeasible = pair_costs.sum() + 1.0
+
+    cost = np.full(shape, infeasible)
+    cost[pair_rows, pair_cols] = pair_costs
+    gate = np.zeros(shape, dtype=bool)
+    gate[pair_rows, pair_cols] = True
+
+    rows, cols = linear_sum_assignment(cost)
+
+    feasible = gate[rows, cols]
+    return rows[feasible], cols[feasible]
+
+
+def _sparse_assignment(pair_rows, pair_cols, pair_costs, shape) -> tuple:
+    num_rows, num_cols = shape
+
+    # every track gets a dummy detection of its own, so a full matching always
+    # exists and a track left out takes its dummy. Costs are shifted by 1 since a
+    # zero cost edge would count as no edge.
+    weights = pair_costs + 1.0
+    infeasible = weights.sum() + 1.0
+
+    graph = sparse.csr_matrix(
+        (
+            np.concatenate((weights, np.full(num_rows, infeasible))),
+            (
+                np.concatenate((pair_rows, np.arange(num_rows))),
+                np.concatenate((pair_cols, num_cols + np.arange(num_rows))),
+            ),
+        ),
+        shape=(num_rows, num_cols + num_rows),
+    )
+    rows, cols = min_weight_full_bipartite_matching(graph)
+
+    real = cols < num_cols
+    return rows[real], cols[real]
+
+
+def pair_assignment(
+    pair_rows, pair_cols, pair_costs, shape, sparse_min_pairs=SPARSE_MIN_PAIRS
+) -> tuple:
+    """
+    Min cost assignment of tracks (rows) to detections (cols) of a `shape` problem
+    given only its candidate pairs and their costs, returns the matched (rows, cols)
+    sorted by row. As many pairs as possible are matched, at the lowest total cost.
+    Big problems with few pairs go to scipy's sparse matcher (LAPJVsp), which never
+    builds the dense cost matrix.
+    """
+    pair_rows = np.asarray(pair_rows, dtype=np.int64)
+    pair_cols = np.asarray(pair_cols, dtype=np.int64)
+    pair_costs = np.asarray(pair_costs, dtype=np.float64)
+    empty = np.zeros(0, dtype=np.int64)
+
+    if len(pair_rows) == 0:
+        return empty, empty
+
+    num_pairs = shape[0] * shape[1]
+    use_sparse = (
+        min_weight_full_bipartite_matching is not None
+        and num_pairs >= sparse_min_pairs
+        and len(pair_rows) <= SPARSE_MAX_DENSITY * num_pairs
+    )
+    if use_sparse:
+        rows, cols = _sparse_assignment(pair_rows, pair_cols, pair_costs, shape)
+    else:
+        rows, cols = _masked_assignment(pair_rows, pair_cols, pair_costs, shape)
+
+    order = np.argsort(rows, kind="stable")
+    return rows[order], cols[order]
+
+
+def gated_assignment(cost, gate, sparse_min_pairs=SPARSE_MIN_PAIRS) -> tuple:
+    """
+    `pair_assignment` of a dense `cost` matrix using only the pairs in `gate`,
+    returns the matched (rows, cols) sorted by row
+    """
+    cost = np.asarray(cost, dtype=np.float64)
+    gate = np.asarray(gate, dtype=bool)
+
+    pair_rows, pair_cols = np.nonzero(gate)
+    return pair_assignment(
+        pair_rows, pair_cols, cost[gate], gate.shape, sparse_min_pairs=sparse_min_pairs
+    )
+
+
+def lane_partitioned_pair_assignment(
+    pair_rows,
+    pair_cols,
+    pair_costs,
+    shape,
+    track_lanes,
+    det_lanes,
+    track_boundary,
+    det_boundary,
+    executor=None,
+) -> tuple:
+    """
+    `pair_assignment` split by lane. Tracks and detections well inside one lane
+    (lane > 0 and not on a boundary) are matched per lane, each lane an independent
+    problem, run on `executor` if one is given. Boundary tracks and detections, the
+    ones of no lane and the ones left over in their lane then go into one last
+    problem together, so lane changers still find their detection in the next lane.
+    Returns the matched (rows, cols) sorted by row.
+    """
+    pair_rows = np.asarray(pair_rows, dtype=np.int64)
+    pair_cols = np.asarray(pair_cols, dtype=np.int64)
+    pair_costs = np.asarray(pair_costs, dtype=np.float64)
+    track_lanes = np.asarray(track_lanes)
+    det_lanes = np.asarray(det_lanes)
+
+    track_inner = (track_lanes > 0) & ~np.asarray(track_boundary, dtype=bool)
+    det_inner = (det_lanes > 0) & ~np.asarray(det_boundary, dtype=bool)
+
+    def solve(sub_rows, sub_cols):
+        # the problem between tracks `sub_rows` and detections `sub_cols`, both
+        # sorted, with its pairs renumbered into it
+        track_pos = np.full(shape[0], -1, dtype=np.int64)
+        track_pos[sub_rows] = np.arange(len(sub_rows))
+        det_pos = np.full(shape[1], -1, dtype=np.int64)
+        det_pos[sub_cols] = np.arange(len(sub_cols))
+
+        sub_pairs = (track_pos[pair_rows] >= 0) & (det_pos[pair_cols] >= 0)
+        rows, cols = pair_assignment(
+            track_pos[pair_rows[sub_pairs]],
+            det_pos[pair_cols[sub_pairs]],
+            pair_costs[sub_pairs],
+            (len(sub_rows), len(sub_cols)),
+        )
+        return sub_rows[rows], sub_cols[cols]
+
+    problems = []
+    for lane in np.unique(track_lanes[track_inner]):
+        lane_rows = np.flatnonzero(track_inner & (track_lanes == lane))
+        lane_cols = np.flatnonzero(det_inner & (det_lanes == lane))
+        if len(lane_cols) > 0:
+            problems.append((lane_rows, lane_cols))
+
+    if executor is not None and len(problems) > 1:
+        solved = list(executor.map(lambda problem: solve(*problem), problems))
+    else:
+        solved = [solve(*problem) for problem in problems]
+
+    matched_rows = np.zeros(shape[0], dtype=bool)
+    matched_cols = np.zeros(shape[1], dtype=bool)
+    for rows, cols in solved:
+        matched_rows[rows] = True
+        matched_cols[cols] = True
+
+    rest_rows = np.flatnonzero(~matched_rows)
+    rest_cols = np.flatnonzero(~matched_cols)
+    if len(rest_rows) > 0 and len(rest_cols) > 0:
+        solved.append(solve(rest_rows, rest_cols))
+
+    rows = np.concatenate([rows for rows, _ in solved] + [np.zeros(0, np.int64)])
+    cols = np.concatenate([cols for _, cols in solved] + [np.zeros(0, np.int64)])
+
+    order = np.argsort(rows, kind="stable")
+    return rows[order], cols[order]
+
+
+def lane_partitioned_assignment(
+    cost, gate, track_lanes, det_lanes, track_boundary, det_boundary, executor=None
+) -> tuple:
+    """`lane_partitioned_pair_assignment` of a dense `cost` matrix and its `gate`"""
+    cost = np.asarray(cost, dtype=np.float64)
+    gate = np.asarray(gate, dtype=bool)
+
+    pair_rows, pair_cols = np.nonzero(gate)
+    return lane_partitioned_pair_assignment(
+        pair_rows,
+        pair_cols,
+        cost[gate],
+        gate.shape,
+        track_lanes,
+        det_lanes,
+        track_boundary,
+        det_boundary,
+        executor=executor,
+    )
@@ -3,9 +3,21 @@ import numpy as np
 from typing import Callable
 from scipy.spatial import distance
 from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from trackers.spatial_index import GridIndex
+from trackers.track_buffer import TrackBuffer
+from trackers.association import (
+    in_ellipses,
+    ellipse_gate,
+    pair_assignment,
+    lane_partitioned_pair_assignment,
+)
 
 
 class EllipseofSearch(object):
+    __slots__ = ("centre", "semi_majoraxis", "semi_minoraxis", "angle", "last_d")
+
     def __init__(self, centre, semi_majoraxis, semi_minoraxis, angle):
         self.centre = centre
         self.semi_majoraxis = semi_majoraxis
@@ -15,8 +27,37 @@ class EllipseofSearch(object):
 
 
 class VehicleObject(object):
+    # no per object dict, and `path` and `axle_track` are fixed size TrackBuffers,
+    # a track takes the same memory however long it stays in view
+    __slots__ = (
+        "objid",
+        "obj_bottom",
+        "rect",
+        "lane",
+        "direction",
+        "path",
+        "absent_count",
+        "obj_class",
+        "starttime",
+        "endtime",
+        "axles",
+        "axle_config",
+        "axle_track",
+        "state",
+        "eos",
+    )
+
     def __init__(
-        self, objid, obj_bottom, rect, lane, direction, path, absent_count, obj_class
+        self,
+        objid,
+        obj_bottom,
+        rect,
+        lane,
+        direction,
+        path,
+        absent_count,
+        obj_class,
+        axle_track,
     ) -> None:
 
         self.objid = objid
@@ -33,20 +74,13 @@ class VehicleObject(object):
 
         self.axles = []  # only for trucks
         self.axle_config = None
-        self.axle_track = []
+        self.axle_track = axle_track
 
         # self.state_list = []
         self.state = [0] * 4  # this attribute is for kalman tracker only
 
-        # state uncertainity covariance matrix, this attribute is for kalman tracker only
-        self.P = np.matrix(
-            [
-                [1000.0, 0.0, 0.0, 0.0],
-                [0.0, 1000.0, 0.0, 0.0],
-                [0.0, 0.0, 1000.0, 0.0],
-                [0.0, 0.0, 0.0, 1000.0],
-            ]
-        )
+        # its state uncertainity covariance is kept in KalmanTracker.kf, together
+        # with the covariances of all the other objects
 
 
 class BaseTracker(object):
@@ -58,8 +92,24 @@ class BaseTracker(object):
         lane_angles: dict,
         velocity_regression: dict,
         max_absent: int,
+        association="global",
+        lane_detector: Callable = None,
+        boundary_band=20,
+        num_workers=1,
+        candidates="dense",
+        max_track_pts=35,
+        history_len=64,
     ) -> None:
 
+        if association not in ("global", "lane"):
+            raise ValueError(f"unknown association {association}")
+
+        if candidates not in ("dense", "grid"):
+            raise ValueError(f"unknown candidates {candidates}")
+
+        if association == "lane" and lane_detector is None:
+            raise ValueError("lane association needs a lane_detector")
+
         self.direction_detector = direction_detector
         self.initial_maxdistances = initial_maxdistances
         self.within_interval = within_interval
@@ -67,42 +117,68 @@ class BaseTracker(object):
         self.velocity_regression = velocity_regression
         self.max_absent = max_absent
 
+        # "global" solves one assignment over all objects and detections, "lane"
+        # one per lane plus one for everything within `boundary_band` pixels of a
+        # lane edge, on `num_workers` threads
+        self.association = association
+        self.lane_detector = lane_detector
+        self.boundary_band = boundary_band
+        self.executor = None
+        if association == "lane" and num_workers > 1:
+            self.executor = ThreadPoolExecutor(max_workers=num_workers)
+
+        # "dense" tests every object against every detection for the pairs that can
+        # be matched, "grid" only the detections a grid index over them finds near
+        # each object's ellipse of search
+        self.candidates = candidates
+
+        # paths keep their last `max_track_pts` points for drawing, at least the 10
+        # the trackers look back on, and `history_len` samples of the whole path for
+        # the trackpath file
+        self.max_track_pts = max(max_track_pts, 10)
+        self.history_len = history_len
+
         self.next_objid = 0
         self.objects = OrderedDict()
         self.trackpath_filewriter = None
 
-    def _register_object(self, detection):
+    def _register_object(self, detections, idx):
         self.next_objid += 1
 
+        obj_bottom = detections.bottom(idx)
+        obj_class = detections.obj_class(idx)
+        lane = detections.lane(idx)
+
         self.objects[self.next_objid] = VehicleObject(
             self.next_objid,
-            detection["obj_bottom"],
-            detection["rect"],
-            detection["lane"],
+            obj_bottom,
+            detections.rect(idx),
+            lane,
             True,
-            [],
+            TrackBuffer(self.max_track_pts, self.history_len),
             0,
-            detection["obj_class"],
+            obj_class,
+            TrackBuffer(self.max_track_pts, self.history_len),
         )
 
-        self.objects[self.next_objid].path.append(detection["obj_bottom"])
+        self.objects[self.next_objid].path.append(obj_bottom)
 
         for k, v in self.initial_maxdistances.items():
-            if detection["obj_class"][0] in k:
+            if obj_class[0] in k:
                 semi_majoraxis = v
 
-        if detection["lane"] == "2":
+        if lane == "2":
             angle = 18
         else:
             angle = 10
 
-        if detection["obj_class"][0] in "2t,3t,4t,5t,6t,lgv,tractr,bus,mb":
+        if obj_class[0] in "2t,3t,4t,5t,6t,lgv,tractr,bus,mb":
             semi_minoraxis = semi_majoraxis // 2
         else:
             semi_minoraxis = semi_majoraxis // 3
 
         self.objects[self.next_objid].eos = EllipseofSearch(
-            detection["obj_bottom"], semi_majoraxis, semi_minoraxis, angle
+            obj_bottom, semi_majoraxis, semi_minoraxis, angle
         )
 
     def _update_eos(self, obj_id, lost=False) -> None:
@@ -159,24 +235,99 @@ class BaseTracker(object):
                 int((m * pt1[1] + n * pt2[1]) / (m + n + 1e-6)),
             )
 
-    def _within_eos(self, obj_id, pt):
-        a = self.objects[obj_id].eos.semi_majoraxis
-        b = self.objects[obj_id].eos.semi_minoraxis
-        h = self.objects[obj_id].eos.centre[0]
-        k = self.objects[obj_id].eos.centre[1]
-        x, y = pt
-        angle = math.radians(self.objects[obj_id].eos.angle)
-
-        cosa = math.cos(angle)
-        sina = math.sin(angle)
+    def _eos_params(self, obj_ids) -> np.ndarray:
+        """(len(obj_ids), 5) centre x, centre y, semi axes and angle of every eos"""
+        return np.array(
+            [
+                (
+                    *self.objects[obj_id].eos.centre,
+                    self.objects[obj_id].eos.semi_majoraxis,
+                    self.objects[obj_id].eos.semi_minoraxis,
+                    self.objects[obj_id].eos.angle,
+                )
+                for obj_id in obj_ids
+            ],
+            dtype=np.float64,
+        ).reshape(-1, 5)
 
-        n1 = math.pow(cosa * (x - h) + sina * (y - k), 2)
-        n2 = math.pow(sina * (x - h) - cosa * (y - k), 2)
+    def _eos_gate(self, obj_ids, pts) -> np.ndarray:
+        """(len(obj_ids), len(pts)) bool, whether each point is in each object's eos"""
+        eos_params = self._eos_params(obj_ids)
 
-        d1 = a * a
-        d2 = b * b
+        return ellipse_gate(
+            eos_params[:, :2], eos_params[:, 2], eos_params[:, 3], eos_params[:, 4], pts
+        )
 
-        return (n1 / d1) + (n2 / d2) <= 1
+    def _eos_pairs(self, obj_ids, pts) -> tuple:
+        """
+        (rows, cols) of the points in each object's eos, sorted like np.nonzero of
+        `_eos_gate`, found with a grid index over the points in "grid" mode
+        """
+        if self.candidates == "dense":
+            return np.nonzero(self._eos_gate(obj_ids, pts))
+
+        eos_params = self._eos_params(obj_ids)
+        pts = np.asarray(pts, dtype=np.float64).reshape(-1, 2)
+
+        # every eos lies in the circle of its bigger semi axis, the smallest one
+        # makes for cells a query only covers a few rows of
+        radii = eos_params[:, 2:4].max(axis=1)
+        if len(radii) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+        index = GridIndex(pts, max(radii.min(), 1.0))
+        rows, cols = index.query(eos_params[:, :2], radii)
+
+        inside = in_ellipses(
+            eos_params[rows, :2],
+            eos_params[rows, 2],
+            eos_params[rows, 3],
+            eos_params[rows, 4],
+            pts[cols],
+        )
+        return rows[inside], cols[inside]
+
+    def _lanes_and_boundary(self, pts) -> tuple:
+        """
+        lane id of every point, and whether a point `boundary_band` pixels away from
+        it along x or y falls in another lane
+        """
+        pts = np.asarray(pts, dtype=np.int64).reshape(-1, 2)
+        band = self.boundary_band
+        offsets = np.array([[0, 0], [-band, 0], [band, 0], [0, -band], [0, band]])
+
+        probes = self.lane_detector.lanes(
+            (pts[None, :, :] + offsets[:, None, :]).reshape(-1, 2)
+        ).reshape(len(offsets), len(pts))
+
+        return probes[0], (probes != probes[0]).any(axis=0)
+
+    def _associate(self, pair_rows, pair_cols, pair_costs, obj_pts, det_pts) -> tuple:
+        """
+        matched (rows, cols) of objects at `obj_pts` and detections at `det_pts`
+        using only the candidate pairs given, with their costs
+        """
+        shape = (len(obj_pts), len(det_pts))
+
+        if self.association == "global":
+            return pair_assignment(pair_rows, pair_cols, pair_costs, shape)
+
+        # objects are partitioned by the lane they are in now, not the one they
+        # were registered in, so lane changers move with their lane
+        obj_lanes, obj_boundary = self._lanes_and_boundary(obj_pts)
+        det_lanes, det_boundary = self._lanes_and_boundary(det_pts)
+
+        return lane_partitioned_pair_assignment(
+            pair_rows,
+            pair_cols,
+            pair_costs,
+            shape,
+            obj_lanes,
+            det_lanes,
+            obj_boundary,
+            det_boundary,
+            executor=self.executor,
+        )
 
     def _deregister_object(self, obj_id) -> None:
         txt = f"{obj_id} : {self.objects[obj_id].obj_class[0]}"
@@ -191,14 +342,21 @@ class BaseTracker(object):
             "lgv",
         ]:
             if len(self.objects[obj_id].axle_track) >= 2:
-                txt += f" : {self.objects[obj_id].axle_track}"
+                txt += f" : {self.objects[obj_id].axle_track.history()}"
                 self.trackpath_filewriter.write(txt + "\n")
         else:
             if len(self.objects[obj_id].path) >= 2:
-                txt += f" : {self.objects[obj_id].path}"
+                txt += f" : {self.objects[obj_id].path.history()}"
                 self.trackpath_filewriter.write(txt + "\n")
 
         del self.objects[obj_id]
 
-    def update(self, detection_list: list):
+    def update(self, detections):
         raise NotImplementedError("Function `update` is not implemented !")
+
+    def predict(self):
+        """
+        called instead of `update` for frames detection was skipped on, trackers
+        without a motion model keep their objects as they are
+        """
+        return self.objects
@@ -1,13 +1,51 @@
 import numpy as np
+from typing import Callable
 from scipy.spatial import distance
-from scipy.optimize import linear_sum_assignment
 
 from trackers import BaseTracker
 
 
 class CentroidTracker(BaseTracker):
-    def update(self, detection_list: list):
-        if len(detection_list) == 0:
+    def __init__(
+        self,
+        direction_detector: Callable,
+        initial_maxdistances: dict,
+        within_interval: Callable,
+        lane_angles: dict,
+        velocity_regression: dict,
+        max_absent: int,
+        association="global",
+        lane_detector: Callable = None,
+        boundary_band=20,
+        num_workers=1,
+        candidates="dense",
+        max_track_pts=35,
+        history_len=64,
+    ) -> None:
+
+        # pairs are gated by distance after matching, not by an ellipse of search
+        # a grid index could look up
+        if candidates != "dense":
+            raise ValueError(f"centroid tracker has no {candidates} candidates")
+
+        super().__init__(
+            direction_detector,
+            initial_maxdistances,
+            within_interval,
+            lane_angles,
+            velocity_regression,
+            max_absent,
+            association=association,
+            lane_detector=lane_detector,
+            boundary_band=boundary_band,
+            num_workers=num_workers,
+            candidates=candidates,
+            max_track_pts=max_track_pts,
+            history_len=history_len,
+        )
+
+    def update(self, detections):
+        if len(detections) == 0:
             to_deregister = []
 
             for obj_id, obj in self.objects.items():
@@ -25,19 +63,20 @@ class CentroidTracker(BaseTracker):
             return self.objects
 
         if len(self.objects) == 0:
-            for det in detection_list:
-                self._register_object(det)
+            for idx in range(len(detections)):
+                self._register_object(detections, idx)
         else:
             obj_ids = list(self.objects.keys())
             obj_bottoms = [self.objects[obj_id].obj_bottom for obj_id in obj_ids]
 
-            detected_rects = [det["rect"] for det in detection_list]
-            detected_bottoms = [det["obj_bottom"] for det in detection_list]
-            detected_classes = [det["obj_class"] for det in detection_list]
+            obj_bottoms = np.array(obj_bottoms)
+            D = distance.cdist(obj_bottoms, detections.bottoms)
 
-            D = distance.cdist(np.array(obj_bottoms), detected_bottoms)
-
-            rows, cols = linear_sum_assignment(D)
+            # every pair can be matched, the distance is checked per match below
+            pair_rows, pair_cols = np.nonzero(np.ones(D.shape, dtype=bool))
+            rows, cols = self._associate(
+                pair_rows, pair_cols, D.ravel(), obj_bottoms, detections.bottoms
+            )
             rows, cols = rows.tolist(), cols.tolist()
 
             used_rows = set()
@@ -48,18 +87,18 @@ class CentroidTracker(BaseTracker):
                     continue
 
                 if D[row][col] <= self.adaptive_maxdistance(
-                    detected_bottoms[col], detected_classes[col][0]
+                    detections.bottom(col), detections.obj_class(col)[0]
                 ):
 
                     obj_id = obj_ids[row]
-                    self.objects[obj_id].obj_bottom = tuple(detected_bottoms[col])
-                    self.objects[obj_id].rect = detected_rects[col]
+                    self.objects[obj_id].obj_bottom = detections.bottom(col)
+                    self.objects[obj_id].rect = detections.rect(col)
 
                     if self.within_interval(
-                        detected_bottoms[col], self.objects[obj_id].obj_class[0]
+                        detections.bottom(col), self.objects[obj_id].obj_class[0]
                     ):
-                        if self.objects[obj_id].obj_class[1] < detected_classes[col][1]:
-                            self.objects[obj_id].obj_class = detected_classes[col]
+                        if self.objects[obj_id].obj_class[1] < detections.scores[col]:
+                            self.objects[obj_id].obj_class = detections.obj_class(col)
 
                     if len(self.objects[obj_id].path) > 3:
                         self.objects[obj_id].direction = self.direction_detector(
@@ -68,7 +107,7 @@ class CentroidTracker(BaseTracker):
                             self.objects[obj_id].path[-3],
                         )
 
-                    self.objects[obj_id].path.append(detected_bottoms[col])
+                    self.objects[obj_id].path.append(detections.bottom(col))
 
                     if len(self.objects[obj_id].path) > 2:
                         self._update_eos(obj_id)
@@ -99,6 +138,6 @@ class CentroidTracker(BaseTracker):
 
             else:
                 for col in unused_cols:
-                    self._register_object(detection_list[col])
+                    self._register_object(detections, col)
 
         return self.objects
@@ -0,0 +1,116 @@
+import numpy as np
+from scipy.linalg import block_diag
+
+# time interval
+dt = 1.0
+
+# state transition matrix assuming constant velocity model
+# new_pos = old_pos + velocity * dt
+F = np.array(
+    [
+        [1.0, dt, 0.0, 0.0],
+        [0.0, 1.0, 0.0, 0.0],
+        [0.0, 0.0, 1.0, dt],
+        [0.0, 0.0, 0.0, 1.0],
+    ]
+)
+
+# measurement function (maps the states to measurements)
+H = np.array([[1.0, 0.0, 0.0, 0.0], [0.0, 0.0, 1.0, 0.0]])
+
+# measurement noise covariance (measurement is done only for position not velocity)
+R = np.array([[5, 0.0], [0.0, 5]])
+
+# Q is process covariance
+Q_comp_mat = np.array([[dt ** 4 / 4.0, dt ** 3 / 2.0], [dt ** 3 / 2.0, dt ** 2]])
+Q = block_diag(Q_comp_mat, Q_comp_mat)
+
+I = np.identity(4)
+
+# state uncertainity covariance of a new track
+P0 = I * 1000.0
+
+
+class BatchedKalmanFilter(object):
+    """
+    Constant velocity kalman filter over all tracks at once. States (x, vx, y, vy)
+    live in an (N, 4) array and covariances in an (N, 4, 4) array, a track owns
+    one row, looked up by its obj_id. `predict` and `update` take the rows of every
+    track to step and run as one batched matmul each.
+
+    States are truncated to whole pixels after every step like the per object
+    filter did, tracks keep following the same integer paths.
+    """
+
+    def __init__(self, capacity=64) -> None:
+        self.states = np.zeros((capacity, 4))
+        self.covariances = np.zeros((capacity, 4, 4))
+
+        self.row_of = {}
+        self.obj_ids = []
+
+    def __len__(self) -> int:
+        return len(self.obj_ids)
+
+    def add(self, obj_id) -> int:
+        """gives `obj_id` a row with a zero state and a large uncertainity"""
+        if obj_id not in self.row_of:
+            if len(self.obj_ids) == len(self.states):
+                self.states = np.concatenate((self.states, np.zeros_like(self.states)))
+                self.covariances = np.concatenate(
+                    (self.covariances, np.zeros_like(self.covariances))
+                )
+
+            self.row_of[obj_id] = len(self.obj_ids)
+            self.obj_ids.append(obj_id)
+
+        row = self.row_of[obj_id]
+        self.states[row] = 0.0
+        self.covariances[row] = P0
+
+        return row
+
+    def remove(self, obj_id) -> None:
+        # the last row moves into the freed one, rows stay packed
+        row = self.row_of.pop(obj_id)
+        last_id = self.obj_ids.pop()
+
+        if last_id != obj_id:
+            last = len(self.obj_ids)
+            self.states[row] = self.states[last]
+            self.covariances[row] = self.covariances[last]
+            self.row_of[last_id] = row
+            self.obj_ids[row] = last_id
+
+    def rows(self, obj_ids) -> np.ndarray:
+        return np.array([self.row_of[obj_id] for obj_id in obj_ids], dtype=np.int64)
+
+    def predict(self, rows) -> None:
+        """x' = F.x, P' = F.P.F^T + Q for every row"""
+        if len(rows) == 0:
+            return
+
+        self.states[rows] = np.trunc(self.states[rows] @ F.T)
+        self.covariances[rows] = F @ self.covariances[rows] @ F.T + Q
+
+    def update(self, rows, measurements) -> None:
+        """corrects every row with its measured (x, y) position"""
+        if len(rows) == 0:
+            return
+
+        x = self.states[rows]
+        P = self.covariances[rows]
+
+        e = np.asarray(measurements, dtype=np.float64).reshape(-1, 2) - x @ H.T
+
+        PHT = P @ H.T
+        S = H @ PHT + R
+        K = PHT @ np.linalg.inv(S)
+
+        x = x + (K @ e[:, :, None])[:, :, 0]
+
+        IKH = I - K @ H
+        self.covariances[rows] = IKH @ P @ IKH.transpose(0, 2, 1) + K @ R @ K.transpose(
+            0, 2, 1
+        )
+        self.states[rows] = np.trunc(x)
@@ -1,133 +1,168 @@
-import math
 import numpy as np
-from scipy.spatial import distance
-from scipy.linalg import block_diag
-from scipy.optimize import linear_sum_assignment
+from typing import Callable
 
 from trackers import BaseTracker
-
-# time interval
-dt = 1.0
-
-I = np.identity(4)
-
-u = np.zeros((4, 1))
-
-# state transition matrix assuming constant velocity model
-# new_pos = old_pos + velocity * dt
-F = np.matrix(
-    [
-        [1.0, dt, 0.0, 0.0],
-        [0.0, 1.0, 0.0, 0.0],
-        [0.0, 0.0, 1.0, dt],
-        [0.0, 0.0, 0.0, 1.0],
-    ]
-)
-
-# measurement function (maps the states to measurements)
-H = np.matrix([[1.0, 0.0, 0.0, 0.0], [0.0, 0.0, 1.0, 0.0]])
-
-# measurement noise covariance (measurement is done only for position not velocity)
-R = np.matrix([[5, 0.0], [0.0, 5]])
-
-# Q is process covariance
-Q_comp_mat = np.array([[dt ** 4 / 4.0, dt ** 3 / 2.0], [dt ** 3 / 2.0, dt ** 2]])
-Q = block_diag(Q_comp_mat, Q_comp_mat)
+from trackers.kalman_filter import BatchedKalmanFilter
 
 
 class KalmanTracker(BaseTracker):
-    def _apply_kf(self, obj_id, z, lost=False):
-        global dt, u, I, F, H, R, Q
-
-        x = self.objects[obj_id].state
-        x = np.array([x]).T
-        x = x.astype(float)
-
-        if z is None:
-
-            # updating state, x' = x + v.dt + u
-            x = F * x  # + u
-            x = tuple(x.astype(int).ravel().tolist()[0])
-
-            if lost:
-                x = list(x)
-
-                objlane = self.objects[obj_id].lane
-                objcls = self.objects[obj_id].obj_class[0]
-                
-                mx = self.velocity_regression[objlane][objcls][0][0]
-                my = self.velocity_regression[objlane][objcls][1][0]
-                cx = self.velocity_regression[objlane][objcls][0][1]
-                cy = self.velocity_regression[objlane][objcls][1][1]
-                x[1] = mx * x[0] + cx
-                x[3] = my * x[2] + cy
-
-                pt1 = [self.objects[obj_id].state[0], -self.objects[obj_id].state[2]]
-                pt2 = [x[0], -x[2]]
-                angle = math.atan2(pt2[1] - pt1[1], pt2[0] - pt1[0])
-                angle = self.lane_angles[objlane] - angle
-
-                c = math.cos(angle)
-                s = math.sin(angle)
-                pt2[0] -= pt1[0]
-                pt2[1] -= pt1[1]
-
-                x[0] = int(pt1[0] + c * pt2[0] - s * pt2[1])
-                x[2] = -int(pt1[1] + s * pt2[0] + c * pt2[1])
-
-                x = tuple(x)
-
-            self.objects[obj_id].P = F * self.objects[obj_id].P * F.T + Q
-            self.objects[obj_id].state = x
-
-        else:
-            P_ = self.objects[obj_id].P
-
-            z = np.array(z)
-            z = z.reshape(1, 2)
-
-            e = z.T - H * x
-
-            PHT = P_ * H.T
-
-            S = H * PHT + R
-
-            K = PHT * np.linalg.inv(S)
+    def __init__(
+        self,
+        direction_detector: Callable,
+        initial_maxdistances: dict,
+        within_interval: Callable,
+        lane_angles: dict,
+        velocity_regression: dict,
+        max_absent: int,
+        association="global",
+        lane_detector: Callable = None,
+        boundary_band=20,
+        num_workers=1,
+        candidates="dense",
+        max_track_pts=35,
+        history_len=64,
+    ) -> None:
+
+        super().__init__(
+            direction_detector,
+            initial_maxdistances,
+            within_interval,
+            lane_angles,
+            velocity_regression,
+            max_absent,
+            association=association,
+            lane_detector=lane_detector,
+            boundary_band=boundary_band,
+            num_workers=num_workers,
+            candidates=candidates,
+            max_track_pts=max_track_pts,
+            history_len=history_len,
+        )
+
+        # states and covariances of all the objects, one row per object
+        self.kf = BatchedKalmanFilter()
+
+    def _register_object(self, detections, idx):
+        super()._register_object(detections, idx)
+        self.kf.add(self.next_objid)
+
+    def _deregister_object(self, obj_id) -> None:
+        super()._deregister_object(obj_id)
+        self.kf.remove(obj_id)
+
+    def _correct_lost(self, obj_ids, rows, prev_states) -> None:
+        """
+        Lost objects don't keep their last velocity, it comes from the lane's and
+        class's velocity regression on the predicted position, and the step is
+        turned to the lane's angle.
+        """
+        coeffs = np.array(
+            [
+                self.velocity_regression[self.objects[obj_id].lane][
+                    self.objects[obj_id].obj_class[0]
+                ]
+                for obj_id in obj_ids
+            ],
+            dtype=np.float64,
+        ).reshape(-1, 2, 2)
+        lane_angles = np.array(
+            [self.lane_angles[self.objects[obj_id].lane] for obj_id in obj_ids]
+        )
+
+        x = self.kf.states[rows]
+        x[:, 1] = coeffs[:, 0, 0] * x[:, 0] + coeffs[:, 0, 1]
+        x[:, 3] = coeffs[:, 1, 0] * x[:, 2] + coeffs[:, 1, 1]
+
+        # y axis flipped so angles are counter clockwise like the lane angles
+        pt1 = np.stack((prev_states[:, 0], -prev_states[:, 2]), axis=1)
+        step = np.stack((x[:, 0], -x[:, 2]), axis=1) - pt1
+
+        angle = lane_angles - np.arctan2(step[:, 1], step[:, 0])
+        c, s = np.cos(angle), np.sin(angle)
+
+        x[:, 0] = np.trunc(pt1[:, 0] + c * step[:, 0] - s * step[:, 1])
+        x[:, 2] = -np.trunc(pt1[:, 1] + s * step[:, 0] + c * step[:, 1])
+
+        self.kf.states[rows] = x
+
+    def _step_kf(self, matched_ids, measurements, lost_ids) -> None:
+        """
+        One batched predict for the matched and the lost objects, the lost
+        correction and one batched update for the matched ones
+        """
+        matched_rows = self.kf.rows(matched_ids)
+        lost_rows = self.kf.rows(lost_ids)
+        prev_lost = self.kf.states[lost_rows]
+
+        self.kf.predict(np.concatenate((matched_rows, lost_rows)))
+        if len(lost_ids) > 0:
+            self._correct_lost(lost_ids, lost_rows, prev_lost)
+        self.kf.update(matched_rows, measurements)
+
+        self._sync_states(matched_ids, matched_rows)
+        self._sync_states(lost_ids, lost_rows)
+
+    def _init_kf(self, obj_ids, measurements) -> None:
+        # a new object's state is its first measurement corrected from zero
+        rows = self.kf.rows(obj_ids)
+        self.kf.update(rows, measurements)
+        self._sync_states(obj_ids, rows)
+
+    def _sync_states(self, obj_ids, rows) -> None:
+        for obj_id, (x, vx, y, vy) in zip(obj_ids, self.kf.states[rows].tolist()):
+            self.objects[obj_id].state = (int(x), vx, int(y), vy)
+
+    def _mark_lost(self, lost_ids) -> None:
+        to_deregister = []
+
+        for obj_id in lost_ids:
+            self.objects[obj_id].path.append(
+                (self.objects[obj_id].state[0], self.objects[obj_id].state[2])
+            )
 
-            x += K * e
+            self._update_eos(obj_id, lost=True)
 
-            IKH = I - K * H
+            if self.objects[obj_id].absent_count > self.max_absent:
+                to_deregister.append(obj_id)
 
-            self.objects[obj_id].P = (IKH * P_ * IKH.T) + (K * R * K.T)
+        for obj_id in to_deregister:
+            self._deregister_object(obj_id)
 
-            x = tuple(x.astype(int).ravel().tolist())
-            self.objects[obj_id].state = x
+    def predict(self):
+        """
+        Predict-only step for frames detection was skipped on. Nothing moved in the
+        lanes, so tracks coast on their velocity and are not counted as absent.
+        """
+        obj_ids = list(self.objects.keys())
+        rows = self.kf.rows(obj_ids)
+        self.kf.predict(rows)
+        self._sync_states(obj_ids, rows)
 
-    def update(self, detection_list: list):
-        if len(detection_list) == 0:
-            to_deregister = []
+        for obj_id in obj_ids:
+            self.objects[obj_id].path.append(
+                (self.objects[obj_id].state[0], self.objects[obj_id].state[2])
+            )
 
-            for obj_id, obj in self.objects.items():
-                obj.absent_count += 1
-                self._apply_kf(obj_id, None, lost=True)
-                self.objects[obj_id].path.append(
-                    (self.objects[obj_id].state[0], self.objects[obj_id].state[2])
-                )
+            self._update_eos(obj_id, lost=True)
 
-                self._update_eos(obj_id, lost=True)
+        return self.objects
 
-                if obj.absent_count > self.max_absent:
-                    to_deregister.append(obj_id)
+    def update(self, detections):
+        if len(detections) == 0:
+            lost_ids = list(self.objects.keys())
+            for obj_id in lost_ids:
+                self.objects[obj_id].absent_count += 1
 
-            for obj_id in to_deregister:
-                self._deregister_object(obj_id)
+            self._step_kf([], np.zeros((0, 2)), lost_ids)
+            self._mark_lost(lost_ids)
 
             return self.objects
 
         if len(self.objects) == 0:
-            for det in detection_list:
-                self._register_object(det)
-                self._apply_kf(self.next_objid, det["obj_bottom"])
+            for idx in range(len(detections)):
+                self._register_object(detections, idx)
+
+            self._init_kf(list(self.objects.keys()), detections.bottoms)
         else:
             obj_ids = list(self.objects.keys())
             obj_bottoms = [
@@ -135,78 +170,71 @@ class KalmanTracker(BaseTracker):
                 for obj_id in obj_ids
             ]
 
-            detected_rects = [det["rect"] for det in detection_list]
-            detected_bottoms = [det["obj_bottom"] for det in detection_list]
-            detected_classes = [det["obj_class"] for det in detection_list]
-
-            D = distance.cdist(np.array(obj_bottoms), detected_bottoms)
-
-            rows, cols = linear_sum_assignment(D)
-            rows, cols = rows.tolist(), cols.tolist()
+            obj_bottoms = np.array(obj_bottoms, dtype=np.float64)
 
-            used_rows = set()
-            used_cols = set()
+            # only pairs inside the object's ellipse of search can be matched, and
+            # only their distances are computed
+            pair_rows, pair_cols = self._eos_pairs(obj_ids, detections.bottoms)
+            d = obj_bottoms[pair_rows] - detections.bottoms[pair_cols]
+            pair_costs = np.sqrt((d * d).sum(axis=1))
 
-            for (row, col) in zip(rows, cols):
-                if row in used_rows or col in used_cols:
-                    continue
+            rows, cols = self._associate(
+                pair_rows, pair_cols, pair_costs, obj_bottoms, detections.bottoms
+            )
 
-                if self._within_eos(obj_ids[row], detected_bottoms[col]):
+            matches = list(zip(rows.tolist(), cols.tolist()))
+            matched_ids = [obj_ids[row] for row, _ in matches]
+            matched_cols = [col for _, col in matches]
 
-                    obj_id = obj_ids[row]
-                    self._apply_kf(obj_id, None)
-                    self._apply_kf(obj_id, detected_bottoms[col])
-                    self.objects[obj_id].rect = detected_rects[col]
+            used_rows = set(row for row, _ in matches)
+            used_cols = set(matched_cols)
 
-                    if self.within_interval(
-                        detected_bottoms[col], self.objects[obj_id].obj_class[0]
-                    ):
-                        if self.objects[obj_id].obj_class[1] < detected_classes[col][1]:
-                            self.objects[obj_id].obj_class = detected_classes[col]
+            num_objs, num_dets = len(obj_ids), len(detections)
+            unused_rows = set(range(0, num_objs)).difference(used_rows)
+            unused_cols = set(range(0, num_dets)).difference(used_cols)
 
-                    if len(self.objects[obj_id].path) > 10:
-                        self.objects[obj_id].direction = self.direction_detector(
-                            self.objects[obj_id].lane,
-                            self.objects[obj_id].path[-1],
-                            self.objects[obj_id].path[-10],
-                        )
-
-                    self.objects[obj_id].path.append(
-                        (self.objects[obj_id].state[0], self.objects[obj_id].state[2])
-                    )
+            # objects without a detection only coast if there are fewer detections
+            lost_ids = []
+            if num_objs >= num_dets:
+                lost_ids = [obj_ids[row] for row in unused_rows]
 
-                    self._update_eos(obj_id)
+            self._step_kf(matched_ids, detections.bottoms[matched_cols], lost_ids)
 
-                    self.objects[obj_id].absent_count = 0
+            for obj_id, col in zip(matched_ids, matched_cols):
+                self.objects[obj_id].rect = detections.rect(col)
 
-                    used_rows.add(row)
-                    used_cols.add(col)
+                if self.within_interval(
+                    detections.bottom(col), self.objects[obj_id].obj_class[0]
+                ):
+                    if self.objects[obj_id].obj_class[1] < detections.scores[col]:
+                        self.objects[obj_id].obj_class = detections.obj_class(col)
 
-            unused_rows = set(range(0, D.shape[0])).difference(used_rows)
-            unused_cols = set(range(0, D.shape[1])).difference(used_cols)
+                if len(self.objects[obj_id].path) > 10:
+                    self.objects[obj_id].direction = self.direction_detector(
+                        self.objects[obj_id].lane,
+                        self.objects[obj_id].path[-1],
+                        self.objects[obj_id].path[-10],
+                    )
 
-            if D.shape[0] >= D.shape[1]:
-                to_deregister = []
+                self.objects[obj_id].path.append(
+                    (self.objects[obj_id].state[0], self.objects[obj_id].state[2])
+                )
 
-                for row in unused_rows:
-                    obj_id = obj_ids[row]
-                    self.objects[obj_id].absent_count += 1
-                    self._apply_kf(obj_id, None, lost=True)
-                    self.objects[obj_id].path.append(
-                        (self.objects[obj_id].state[0], self.objects[obj_id].state[2])
-                    )
+                self._update_eos(obj_id)
 
-                    self._update_eos(obj_id, lost=True)
+                self.objects[obj_id].absent_count = 0
 
-                    if self.objects[obj_id].absent_count > self.max_absent:
-                        to_deregister.append(obj_id)
+            for obj_id in lost_ids:
+                self.objects[obj_id].absent_count += 1
+            self._mark_lost(lost_ids)
 
-                for obj_id in to_deregister:
-                    self._deregister_object(obj_id)
+            if num_objs < num_dets:
+                new_cols = list(unused_cols)
+                new_ids = []
+                for col in new_cols:
+                    self._register_object(detections, col)
+                    new_ids.append(self.next_objid)
 
-            else:
-                for col in unused_cols:
-                    self._register_object(detection_list[col])
-                    self._apply_kf(self.next_objid, detected_bottoms[col])
+                self._init_kf(new_ids, detections.bottoms[new_cols])
 
         return self.objects
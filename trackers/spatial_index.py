@@ -0,0 +1,83 @@
+import numpy as np
+
+
+class GridIndex(object):
+    """
+    Uniform grid over 2D points, meant to be rebuilt every frame over the
+    detection bottoms. Points are sorted by cell, cells numbered row by row, so
+    the points of a run of cells in one grid row are one slice and a query only
+    needs two binary searches per grid row it covers.
+    """
+
+    def __init__(self, points, cell_size) -> None:
+        self.points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        self.cell_size = float(cell_size)
+
+        if len(self.points) > 0:
+            self.origin = self.points.min(axis=0)
+        else:
+            self.origin = np.zeros(2)
+
+        cells = self._cells(self.points)
+        self.num_cols, self.num_rows = (
+            cells.max(axis=0) + 1 if len(cells) > 0 else (1, 1)
+        )
+
+        keys = cells[:, 1] * self.num_cols + cells[:, 0]
+        self.order = np.argsort(keys, kind="stable")
+        self.keys = keys[self.order]
+
+    def __len__(self) -> int:
+        return len(self.points)
+
+    def _cells(self, pts) -> np.ndarray:
+        return np.floor((pts - self.origin) / self.cell_size).astype(np.int64)
+
+    def query(self, centres, radii) -> tuple:
+        """
+        (query_idx, point_idx) of every point within `radii[i]` of `centres[i]`,
+        sorted by query and then point like np.nonzero of a dense mask
+        """
+        centres = np.asarray(centres, dtype=np.float64).reshape(-1, 2)
+        radii = np.asarray(radii, dtype=np.float64).reshape(-1)
+        empty = np.zeros(0, dtype=np.int64)
+
+        if len(centres) == 0 or len(self.points) == 0:
+            return empty, empty
+
+        lo = self._cells(centres - radii[:, None])
+        hi = self._cells(centres + radii[:, None])
+
+        lo = np.maximum(lo, 0)
+        hi = np.minimum(hi, (self.num_cols - 1, self.num_rows - 1))
+        valid = (lo <= hi).all(axis=1)
+
+        owners, starts, ends = [], [], []
+        for dy in range(int((hi[:, 1] - lo[:, 1])[valid].max(initial=-1)) + 1):
+            row = lo[:, 1] + dy
+            queries = np.flatnonzero(valid & (row <= hi[:, 1]))
+
+            row_keys = row[queries] * self.num_cols
+            owners.append(queries)
+            starts.append(np.searchsorted(self.keys, row_keys + lo[queries, 0], "left"))
+            ends.append(np.searchsorted(self.keys, row_keys + hi[queries, 0], "right"))
+
+        if len(owners) == 0:
+            return empty, empty
+
+        owners = np.concatenate(owners)
+        starts = np.concatenate(starts)
+        counts = np.concatenate(ends) - starts
+
+        # every [start, end) range expanded into the positions it holds
+        total = counts.sum()
+        query_idx = np.repeat(owners, counts)
+        offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+        point_idx = self.order[np.repeat(starts, counts) + offsets]
+
+        d = centres[query_idx] - self.points[point_idx]
+        inside = (d * d).sum(axis=1) <= radii[query_idx] ** 2
+        query_idx, point_idx = query_idx[inside], point_idx[inside]
+
+        order = np.argsort(query_idx * len(self.points) + point_idx, kind="stable")
+        return query_idx[order], point_idx[order]
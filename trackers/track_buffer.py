@@ -0,0 +1,71 @@
+import numpy as np
+
+
+class TrackBuffer(object):
+    """
+    The (x, y) points of a track in constant memory, however long it lives. The
+    last `capacity` points are kept in a ring buffer, for indexing from the end
+    and drawing. The whole track is kept in `history_capacity` evenly spaced
+    samples: every point while they fit, then every 2nd, 4th, ... point, halving
+    the samples whenever they fill up.
+
+    `len` is the number of points ever appended, like the list it replaces.
+    """
+
+    __slots__ = ("capacity", "recent", "samples", "count", "num_samples", "stride")
+
+    def __init__(self, capacity=35, history_capacity=64) -> None:
+        self.capacity = capacity
+        self.recent = np.zeros((capacity, 2), dtype=np.int32)
+        self.samples = np.zeros((history_capacity, 2), dtype=np.int32)
+
+        self.count = 0
+        self.num_samples = 0
+        self.stride = 1
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __getitem__(self, idx: int) -> tuple:
+        if idx < 0:
+            idx += self.count
+
+        if idx < 0 or idx >= self.count or idx < self.count - self.capacity:
+            raise IndexError(f"point {idx} of the track is not kept !")
+
+        # scalar reads, a point is read a few times a frame for every track
+        row = idx % self.capacity
+        return (self.recent.item(row, 0), self.recent.item(row, 1))
+
+    def append(self, pt) -> None:
+        row = self.count % self.capacity
+        self.recent[row, 0], self.recent[row, 1] = pt
+
+        if self.count % self.stride == 0:
+            if self.num_samples == len(self.samples):
+                kept = self.samples[: self.num_samples : 2].copy()
+                self.samples[: len(kept)] = kept
+                self.num_samples = len(kept)
+                self.stride *= 2
+
+            if self.count % self.stride == 0:
+                self.samples[self.num_samples] = pt
+                self.num_samples += 1
+
+        self.count += 1
+
+    def last(self, n: int) -> list:
+        """the last `n` points, as many as are kept, oldest first"""
+        n = min(n, self.count, self.capacity)
+        idx = np.arange(self.count - n, self.count) % self.capacity
+
+        return [tuple(pt) for pt in self.recent[idx].tolist()]
+
+    def history(self) -> list:
+        """samples of the whole track, oldest first and always ending at its last point"""
+        history = [tuple(pt) for pt in self.samples[: self.num_samples].tolist()]
+
+        if self.count > 0 and (self.count - 1) % self.stride != 0:
+            history.append(self[-1])
+
+        return history
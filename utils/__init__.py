@@ -1,3 +1,10 @@
 from .cv_utils import *
 from .tracker_utils import *
 from .detector_utils import *
+from .frame_ring import *
+from .stage_queue import *
+from .stage_worker import *
+from .detections import *
+from .frame_preprocessor import *
+from .detection_cache import *
+from .motion_gate import *
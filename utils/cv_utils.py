@@ -144,10 +144,7 @@ def draw_tracked_objects(self, frame, tracked_objs):
                 background=(0, 0, 255),
             )
 
-        if len(obj.path) <= self.max_track_pts:
-            path = obj.path
-        else:
-            path = obj.path[len(obj.path) - self.max_track_pts :]
+        path = obj.path.last(self.max_track_pts)
 
         prev_point = None
         for pt in path:
@@ -0,0 +1,132 @@
+import os
+import re
+import hashlib
+import numpy as np
+
+__all__ = [
+    "DETECTION_DTYPE",
+    "INDEX_DTYPE",
+    "INDEX_MAGIC",
+    "detection_cache_path",
+    "DetectionRecorder",
+    "DetectionCache",
+]
+
+
+# one raw detection, boxes are normalized x1 y1 x2 y2 like `BaseDetector._infer`
+DETECTION_DTYPE = np.dtype(
+    [("box", np.float32, (4,)), ("score", np.float32), ("class_id", np.uint8)]
+)
+
+# one entry per recorded frame, `start` and `count` are in detections
+INDEX_DTYPE = np.dtype([("frame_id", np.int64), ("start", np.int64), ("count", np.int32)])
+
+# an index file starts with this, the byte length of the recorded source as int32
+# and the source itself in utf-8, then come the entries
+INDEX_MAGIC = b"DETIDX01"
+
+
+def detection_cache_path(camera_id: str, source: str, cache_dir="detection_cache") -> str:
+    """
+    cache file of a camera's video or stream, named after the camera, the source's
+    file name and a hash of the whole source, so two streams ending in the same
+    name (e.g. rtsp://.../1) never share a file
+    """
+    name = os.path.splitext(os.path.basename(source.rstrip("/")))[0]
+    name = re.sub(r"[^A-Za-z0-9_-]+", "_", name)
+    digest = hashlib.sha1(source.encode()).hexdigest()[:10]
+    return os.path.join(cache_dir, f"{camera_id}_{name}_{digest}.dets")
+
+
+class DetectionRecorder(object):
+    """
+    Appends every frame's raw detections to `path` and an index entry to
+    `path.idx`. Both are flushed per frame, so a crashed run keeps what it recorded.
+    The index starts with the `source` (video path or stream url) recorded from.
+    """
+
+    def __init__(self, path: str, source="") -> None:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+        self.path = path
+        self.source = source
+        self._data_file = open(path, "wb")
+        self._index_file = open(path + ".idx", "wb")
+        self._num_detections = 0
+
+        encoded = source.encode()
+        self._index_file.write(INDEX_MAGIC)
+        self._index_file.write(np.int32(len(encoded)).tobytes())
+        self._index_file.write(encoded)
+
+    def write(self, frame_id: int, boxes, scores, class_ids) -> None:
+        records = np.empty(len(scores), dtype=DETECTION_DTYPE)
+        records["box"] = np.asarray(boxes).reshape(-1, 4)
+        records["score"] = scores
+        records["class_id"] = class_ids
+
+        entry = np.array([(frame_id, self._num_detections, len(records))], dtype=INDEX_DTYPE)
+        self._num_detections += len(records)
+
+        self._data_file.write(records.tobytes())
+        self._index_file.write(entry.tobytes())
+        self._data_file.flush()
+        self._index_file.flush()
+
+    def close(self) -> None:
+        self._data_file.close()
+        self._index_file.close()
+
+
+class DetectionCache(object):
+    """
+    Read side of `DetectionRecorder`, raw detections of a recorded frame by id.
+    Given a `source`, a recording made from any other source is rejected.
+    """
+
+    def __init__(self, path: str, source=None) -> None:
+        if not os.path.exists(path) or not os.path.exists(path + ".idx"):
+            raise FileNotFoundError(
+                f"No recorded detections at `{os.path.abspath(path)}`, record them first !"
+            )
+
+        self.path = path
+        self._detections = np.fromfile(path, dtype=DETECTION_DTYPE)
+
+        with open(path + ".idx", "rb") as f:
+            if f.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+                raise ValueError(
+                    f"`{os.path.abspath(path)}.idx` has no recorded source, record it again !"
+                )
+            length = int(np.frombuffer(f.read(4), dtype=np.int32)[0])
+            self.source = f.read(length).decode()
+            index = np.fromfile(f, dtype=INDEX_DTYPE)
+
+        if source is not None and source != self.source:
+            raise ValueError(
+                f"`{os.path.abspath(path)}` was recorded from `{self.source}`, not `{source}` !"
+            )
+
+        self._index = {
+            frame_id: (start, start + count)
+            for frame_id, start, count in index.tolist()
+        }
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def frame_ids(self) -> list:
+        """recorded frame ids in ascending order"""
+        return sorted(self._index)
+
+    def __contains__(self, frame_id: int) -> bool:
+        return frame_id in self._index
+
+    def __getitem__(self, frame_id: int) -> tuple:
+        if frame_id not in self._index:
+            raise KeyError(f"Frame {frame_id} was not recorded in `{self.path}` !")
+
+        start, end = self._index[frame_id]
+        records = self._detections[start:end]
+
+        return records["box"], records["score"], records["class_id"].astype(np.int32)
@@ -0,0 +1,92 @@
+import numpy as np
+
+__all__ = ["Detections"]
+
+
+class Detections(object):
+    """
+    All the vehicles detected in one frame, stored as parallel arrays instead of a
+    dict per box.
+
+    rects       : (N, 4) int32, x1 y1 x2 y2 in frame coordinates
+    bottoms     : (N, 2) int32, point used for lane detection and tracking
+    scores      : (N,) float32
+    class_ids   : (N,) int32, index into `class_names`
+    lanes       : (N,) int8, lane id of the bottom point, 1, 2 or 3
+    axles       : (M, 4) int32, axle boxes grouped by the vehicle they belong to and
+                  sorted left to right, axles of no vehicle are at the end
+    axle_ranges : (N, 2) int32, [start, end) into `axles` for every vehicle
+    """
+
+    def __init__(
+        self,
+        rects,
+        bottoms,
+        scores,
+        class_ids,
+        lanes,
+        axles,
+        axle_ranges,
+        class_names: list,
+    ) -> None:
+
+        self.rects = rects
+        self.bottoms = bottoms
+        self.scores = scores
+        self.class_ids = class_ids
+        self.lanes = lanes
+        self.axles = axles
+        self.axle_ranges = axle_ranges
+        self.class_names = class_names
+
+    @classmethod
+    def empty(cls, class_names: list):
+        return cls(
+            np.zeros((0, 4), dtype=np.int32),
+            np.zeros((0, 2), dtype=np.int32),
+            np.zeros(0, dtype=np.float32),
+            np.zeros(0, dtype=np.int32),
+            np.zeros(0, dtype=np.int8),
+            np.zeros((0, 4), dtype=np.int32),
+            np.zeros((0, 2), dtype=np.int32),
+            class_names,
+        )
+
+    def __len__(self) -> int:
+        return len(self.scores)
+
+    def rect(self, idx: int) -> tuple:
+        return tuple(self.rects[idx].tolist())
+
+    def bottom(self, idx: int) -> tuple:
+        return tuple(self.bottoms[idx].tolist())
+
+    def lane(self, idx: int) -> str:
+        return str(self.lanes[idx])
+
+    def obj_class(self, idx: int) -> list:
+        return [
+            self.class_names[self.class_ids[idx]],
+            round(float(self.scores[idx]), 4),
+        ]
+
+    def axles_of(self, idx: int) -> list:
+        start, end = self.axle_ranges[idx]
+        return [tuple(ax) for ax in self.axles[start:end].tolist()]
+
+    def axle_list(self) -> list:
+        return [tuple(ax) for ax in self.axles.tolist()]
+
+    def __getitem__(self, idx: int) -> dict:
+        # record in the old per-box dict format, only meant for drawing code
+        return {
+            "rect": self.rect(idx),
+            "obj_bottom": self.bottom(idx),
+            "obj_class": self.obj_class(idx),
+            "lane": self.lane(idx),
+            "axles": self.axles_of(idx),
+        }
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
@@ -1,33 +1,108 @@
 import cv2
+import numpy as np
 from typing import Callable
 
 
-def init_lane_detector(camera_meta: dict) -> Callable:
-    leftlane_coords = camera_meta["leftlane_coords"]
-    rightlane_coords = camera_meta["rightlane_coords"]
-    threelane_road = False
-    try:
-        middlelane_coords = camera_meta["middlelane_coords"]
-        threelane_road = True
-    except KeyError:
-        pass
-
-    def lane_detector(pt):
-        if cv2.pointPolygonTest(rightlane_coords, pt, False) == 1:
+class LaneDetector(object):
+    """
+    Callable returning the lane ("1", "2", "3") of a point or None. `lanes` does
+    the same for an array of points at once using a raster of lane ids.
+    """
+
+    def __init__(self, camera_meta: dict) -> None:
+        self.leftlane_coords = camera_meta["leftlane_coords"]
+        self.rightlane_coords = camera_meta["rightlane_coords"]
+        self.middlelane_coords = camera_meta.get("middlelane_coords")
+        self.threelane_road = self.middlelane_coords is not None
+
+        self._lane_map = None
+
+    def __call__(self, pt):
+        if cv2.pointPolygonTest(self.rightlane_coords, pt, False) == 1:
             return "1"
-        elif threelane_road:
-            if cv2.pointPolygonTest(middlelane_coords, pt, False) == 1:
+        elif self.threelane_road:
+            if cv2.pointPolygonTest(self.middlelane_coords, pt, False) == 1:
                 return "2"
-            elif cv2.pointPolygonTest(leftlane_coords, pt, False) == 1:
+            elif cv2.pointPolygonTest(self.leftlane_coords, pt, False) == 1:
                 return "3"
             else:
                 return None
-        elif cv2.pointPolygonTest(leftlane_coords, pt, False) == 1:
+        elif cv2.pointPolygonTest(self.leftlane_coords, pt, False) == 1:
             return "2"
         else:
             return None
 
-    return lane_detector
+    def _lane_polygons(self):
+        # in order of precedence, same as __call__
+        if self.threelane_road:
+            return [
+                (1, self.rightlane_coords),
+                (2, self.middlelane_coords),
+                (3, self.leftlane_coords),
+            ]
+        return [(1, self.rightlane_coords), (2, self.leftlane_coords)]
+
+    @property
+    def lane_map(self) -> np.ndarray:
+        if self._lane_map is None:
+            polygons = self._lane_polygons()
+            max_x, max_y = np.max(
+                np.vstack([coords.reshape(-1, 2) for _, coords in polygons]), axis=0
+            )
+
+            lane_map = np.zeros((max_y + 2, max_x + 2), dtype=np.int8)
+            for lane, coords in reversed(polygons):
+                cv2.fillPoly(lane_map, [coords], lane)
+
+            # rasterized edges are not exact, points close to an edge are marked
+            # with -1 and tested against the polygons one by one
+            cv2.polylines(
+                lane_map, [coords for _, coords in polygons], True, -1, thickness=3
+            )
+            self._lane_map = lane_map
+
+        return self._lane_map
+
+    def lane_mask(self, frame_shape: tuple) -> np.ndarray:
+        """uint8 mask of the frame, 1 inside any lane"""
+        mask = np.zeros(frame_shape[:2], dtype=np.uint8)
+        cv2.fillPoly(mask, [coords for _, coords in self._lane_polygons()], 1)
+        return mask
+
+    def roi(self, frame_shape: tuple, margin=40) -> tuple:
+        """
+        (x1, y1, x2, y2) bounding box of all the lanes grown by `margin` pixels and
+        clipped to the frame, the margin keeps the tops of vehicles at the far end
+        """
+        points = np.vstack([coords.reshape(-1, 2) for _, coords in self._lane_polygons()])
+        frame_h, frame_w = frame_shape[:2]
+
+        x1, y1 = np.maximum(points.min(axis=0) - margin, 0)
+        x2 = min(points[:, 0].max() + margin + 1, frame_w)
+        y2 = min(points[:, 1].max() + margin + 1, frame_h)
+
+        return int(x1), int(y1), int(x2), int(y2)
+
+    def lanes(self, points: np.ndarray) -> np.ndarray:
+        """lane id for every (x, y) point, 0 where the point is in no lane"""
+        lane_map = self.lane_map
+        points = np.asarray(points, dtype=np.int64).reshape(-1, 2)
+        x, y = points[:, 0], points[:, 1]
+
+        inside = (x >= 0) & (y >= 0) & (x < lane_map.shape[1]) & (y < lane_map.shape[0])
+
+        lanes = np.zeros(len(points), dtype=np.int8)
+        lanes[inside] = lane_map[y[inside], x[inside]]
+
+        for idx in np.flatnonzero(lanes < 0):
+            lane = self((int(x[idx]), int(y[idx])))
+            lanes[idx] = 0 if lane is None else int(lane)
+
+        return lanes
+
+
+def init_lane_detector(camera_meta: dict) -> Callable:
+    return LaneDetector(camera_meta)
 
 
 def intersection_over_rect(rect1, rect2):
@@ -80,25 +155,148 @@ def intersection_over_union(rect1: list, rect2: list) -> float:
     return intersection_area / (rect1_area + rect2_area - intersection_area + 1e-6)
 
 
-def nonmax_suppression(detection_list: list, iou_thresh: float) -> list:
-    nms_detection_list = []
+def intersection_over_rect_matrix(rects1: np.ndarray, rects2: np.ndarray) -> np.ndarray:
+    """
+    intersection_over_rect for every pair of rects1 x rects2, i.e. intersection
+    area over the area of the smaller rect of the pair
+    """
+    rects1 = np.asarray(rects1, dtype=np.float64).reshape(-1, 4)
+    rects2 = np.asarray(rects2, dtype=np.float64).reshape(-1, 4)
 
-    detection_list = sorted(
-        detection_list, key=lambda x: x["obj_class"][1], reverse=True
+    w = np.minimum(rects1[:, None, 2], rects2[None, :, 2]) - np.maximum(
+        rects1[:, None, 0], rects2[None, :, 0]
     )
+    h = np.minimum(rects1[:, None, 3], rects2[None, :, 3]) - np.maximum(
+        rects1[:, None, 1], rects2[None, :, 1]
+    )
+    intersection_area = np.maximum(w, 0) * np.maximum(h, 0)
+
+    area1 = (rects1[:, 2] - rects1[:, 0]) * (rects1[:, 3] - rects1[:, 1])
+    area2 = (rects2[:, 2] - rects2[:, 0]) * (rects2[:, 3] - rects2[:, 1])
+    smaller_area = np.minimum(area1[:, None], area2[None, :])
+
+    return intersection_area / np.maximum(smaller_area, 1e-6)
 
-    while detection_list:
-        detection = detection_list.pop(0)
-        parent_rect = detection["rect"]
 
+def intersection_over_union_matrix(rects1: np.ndarray, rects2: np.ndarray) -> np.ndarray:
+    """intersection_over_union for every pair of rects1 x rects2"""
+    rects1 = np.asarray(rects1, dtype=np.float64).reshape(-1, 4)
+    rects2 = np.asarray(rects2, dtype=np.float64).reshape(-1, 4)
+
+    w = np.minimum(rects1[:, None, 2], rects2[None, :, 2]) - np.maximum(
+        rects1[:, None, 0], rects2[None, :, 0]
+    )
+    h = np.minimum(rects1[:, None, 3], rects2[None, :, 3]) - np.maximum(
+        rects1[:, None, 1], rects2[None, :, 1]
+    )
+    intersection_area = np.maximum(w, 0) * np.maximum(h, 0)
+
+    area1 = np.abs((rects1[:, 2] - rects1[:, 0]) * (rects1[:, 3] - rects1[:, 1]))
+    area2 = np.abs((rects2[:, 2] - rects2[:, 0]) * (rects2[:, 3] - rects2[:, 1]))
+
+    return intersection_area / (
+        area1[:, None] + area2[None, :] - intersection_area + 1e-6
+    )
+
+
+# below this many rects nms runs as a plain python loop, up to the next as a
+# loop over an iou matrix, above it only the rects left are compared every step.
+# Class aware nms is split into one problem per class above the last.
+NMS_LOOP_MAX_RECTS = 16
+NMS_MATRIX_MAX_RECTS = 512
+NMS_SPLIT_MIN_RECTS = 256
+
+
+def nonmax_suppression(
+    rects: np.ndarray, scores: np.ndarray, iou_thresh: float, class_ids=None
+) -> np.ndarray:
+    """
+    Greedy nms, the best rect left is kept and the rects left with an iou of
+    `iou_thresh` or more with it are dropped, until no rect is left. Rects only
+    suppress rects of their own class if `class_ids` is given, otherwise any rect.
+    Returns indices of the kept rects, highest score first.
+    """
+    order = np.argsort(-np.asarray(scores), kind="stable")
+    rects = np.asarray(rects, dtype=np.float64).reshape(-1, 4)[order]
+    if class_ids is None:
+        classes = np.zeros(len(order), dtype=np.int64)
+    else:
+        classes = np.asarray(class_ids)[order]
+
+    if len(order) <= NMS_LOOP_MAX_RECTS:
+        keep = _nms_loop(rects.tolist(), classes.tolist(), iou_thresh)
+    elif class_ids is None and len(order) > NMS_MATRIX_MAX_RECTS:
+        keep = _nms_shrinking(rects, iou_thresh)
+    elif class_ids is None or len(order) <= NMS_SPLIT_MIN_RECTS:
+        keep = _nms_matrix(rects, classes, iou_thresh)
+    else:
+        # every class is its own smaller problem
         keep = []
-        for det in detection_list:
-            rect = det["rect"]
+        for class_id in np.unique(classes):
+            positions = np.flatnonzero(classes == class_id)
+            if len(positions) <= NMS_MATRIX_MAX_RECTS:
+                kept = _nms_matrix(rects[positions], classes[positions], iou_thresh)
+            else:
+                kept = _nms_shrinking(rects[positions], iou_thresh)
+            keep.extend(positions[kept].tolist())
+
+    return order[np.sort(np.asarray(keep, dtype=np.int64))]
+
 
-            if intersection_over_union(parent_rect, rect) < iou_thresh:
-                keep.append(det)
+def _nms_loop(rects: list, classes: list, iou_thresh: float) -> list:
+    # plain python, numpy calls cost more than they save on a handful of rects
+    keep = []
+    remaining = list(range(len(rects)))
+    while remaining:
+        idx = remaining.pop(0)
+        keep.append(idx)
 
-        detection_list = keep
-        nms_detection_list.append(detection)
+        left = []
+        for other in remaining:
+            if classes[other] == classes[idx] and (
+                intersection_over_union(rects[idx], rects[other]) >= iou_thresh
+            ):
+                continue
+            left.append(other)
+        remaining = left
+
+    return keep
+
+
+def _nms_matrix(rects: np.ndarray, classes: np.ndarray, iou_thresh: float) -> list:
+    suppresses = intersection_over_union_matrix(rects, rects) >= iou_thresh
+    suppresses &= classes[:, None] == classes[None, :]
+
+    # a rect can only suppress lower scoring rects
+    suppresses = np.triu(suppresses, k=1)
+
+    keep = np.ones(len(rects), dtype=bool)
+    for idx in range(len(rects)):
+        if keep[idx]:
+            keep &= ~suppresses[idx]
+
+    return np.flatnonzero(keep).tolist()
+
+
+def _nms_shrinking(rects: np.ndarray, iou_thresh: float) -> list:
+    # only the rects still left are compared with the one kept every step, no
+    # n x n matrix for raw detector output
+    x1, y1, x2, y2 = rects[:, 0], rects[:, 1], rects[:, 2], rects[:, 3]
+    areas = np.abs((x2 - x1) * (y2 - y1))
+
+    keep = []
+    remaining = np.arange(len(rects))
+    while len(remaining) > 0:
+        idx, remaining = remaining[0], remaining[1:]
+        keep.append(idx)
+
+        w = np.minimum(x2[idx], x2[remaining]) - np.maximum(x1[idx], x1[remaining])
+        h = np.minimum(y2[idx], y2[remaining]) - np.maximum(y1[idx], y1[remaining])
+        intersection_area = np.maximum(w, 0) * np.maximum(h, 0)
+
+        iou = intersection_area / (
+            areas[idx] + areas[remaining] - intersection_area + 1e-6
+        )
+        remaining = remaining[iou < iou_thresh]
 
-    return nms_detection_list
+    return keep
@@ -0,0 +1,65 @@
+import cv2
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+__all__ = ["FramePreprocessor"]
+
+
+class FramePreprocessor(object):
+    """
+    Turns a BGR frame into network input without allocating per frame. The frame
+    is resized into a preallocated buffer and then written into `out`, float32
+    (1, 3, h, w) RGB scaled to [0, 1], e.g. a view of the page-locked trt input
+    buffer or the data of a darknet IMAGE.
+
+    Resizing before the BGR -> RGB swap gives the same result as the other way
+    round and only touches network sized images. `submit` runs the same work on a
+    background thread (cv2 and numpy release the GIL), the caller must not submit
+    the next frame before the previous result is consumed, the buffers are shared.
+    """
+
+    def __init__(self, width: int, height: int, out=None) -> None:
+        self.width = width
+        self.height = height
+
+        self._resized = np.empty((height, width, 3), dtype=np.uint8)
+
+        shape = (1, 3, height, width)
+        if out is None:
+            out = np.empty(shape, dtype=np.float32)
+        self.out = np.asarray(out).reshape(shape)
+
+        if self.out.dtype != np.float32:
+            raise ValueError(f"`out` must be float32, got {self.out.dtype} !")
+
+        self._executor = None
+
+    def __call__(self, frame) -> np.ndarray:
+        cv2.resize(
+            frame,
+            (self.width, self.height),
+            dst=self._resized,
+            interpolation=cv2.INTER_LINEAR,
+        )
+
+        # bgr -> rgb, hwc -> chw, uint8 -> float and scaling in one pass per plane
+        for channel in range(3):
+            np.divide(
+                self._resized[:, :, 2 - channel],
+                np.float32(255.0),
+                out=self.out[0, channel],
+            )
+
+        return self.out
+
+    def submit(self, frame):
+        """runs the preprocessing on a background thread, returns a Future of `out`"""
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1)
+
+        return self._executor.submit(self, frame)
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
@@ -0,0 +1,84 @@
+import queue
+import numpy as np
+from multiprocessing import Queue
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # python < 3.8
+    shared_memory = None
+    from multiprocessing.sharedctypes import RawArray
+
+__all__ = ["SharedFrameRing"]
+
+
+class SharedFrameRing(object):
+    """
+    Fixed number of frame slots living in shared memory. A frame is written once
+    into a free slot by the capture stage and every later stage reads it in place,
+    only the slot index travels through the queues.
+    """
+
+    def __init__(self, num_slots: int, frame_shape: tuple, dtype=np.uint8) -> None:
+        self.num_slots = num_slots
+        self.frame_shape = tuple(frame_shape)
+        self.dtype = np.dtype(dtype)
+
+        nbytes = int(np.prod(self.frame_shape)) * self.dtype.itemsize * num_slots
+
+        if shared_memory is not None:
+            self._shm = shared_memory.SharedMemory(create=True, size=nbytes)
+            self._raw = None
+        else:
+            self._shm = None
+            self._raw = RawArray("B", nbytes)
+
+        self._frames = self._make_view()
+
+        self.free_slots = Queue()
+        for slot in range(num_slots):
+            self.free_slots.put(slot)
+
+    def _make_view(self):
+        buf = self._shm.buf if self._shm is not None else self._raw
+        return np.ndarray(
+            (self.num_slots,) + self.frame_shape, dtype=self.dtype, buffer=buf
+        )
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_frames"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._frames = self._make_view()
+
+    def __getitem__(self, slot: int) -> np.ndarray:
+        return self._frames[slot]
+
+    def acquire(self, timeout=None):
+        # returns None if no slot got free within timeout
+        try:
+            return self.free_slots.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def release(self, slot: int) -> None:
+        self.free_slots.put(slot)
+
+    def write(self, frame: np.ndarray, timeout=None):
+        slot = self.acquire(timeout)
+        if slot is not None:
+            self._frames[slot][...] = frame
+        return slot
+
+    def close(self, unlink=False) -> None:
+        self._frames = None
+        if self._shm is not None:
+            try:
+                self._shm.close()
+            except BufferError:
+                # some caller still holds a view of a slot, memory is released on exit
+                pass
+            if unlink:
+                self._shm.unlink()
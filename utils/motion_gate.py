@@ -0,0 +1,107 @@
+import cv2
+import numpy as np
+
+__all__ = ["MotionGate"]
+
+
+class MotionGate(object):
+    """
+    Cheap check whether anything moves inside the lanes, by differencing
+    downscaled gray frames, so detection can be skipped on empty road.
+
+    A frame is let through when more than `min_motion` of the lane pixels changed
+    by over `diff_thresh` since the previous frame, or when `max_skip` frames in a
+    row were skipped. Those forced frames double as an audit, if they find more
+    vehicles than the last detected frame something drove in unnoticed and it is
+    counted as a missed-motion event.
+    """
+
+    def __init__(
+        self,
+        lane_detector,
+        frame_shape: tuple,
+        diff_thresh=20,
+        min_motion=0.002,
+        max_skip=15,
+        scale=0.25,
+    ) -> None:
+
+        self.diff_thresh = diff_thresh
+        self.min_motion = min_motion
+        self.max_skip = max_skip
+
+        frame_h, frame_w = frame_shape[:2]
+        self.size = (max(int(frame_w * scale), 1), max(int(frame_h * scale), 1))
+
+        self._mask = cv2.resize(
+            lane_detector.lane_mask(frame_shape),
+            self.size,
+            interpolation=cv2.INTER_NEAREST,
+        ).astype(bool)
+        self._num_lane_pixels = max(int(self._mask.sum()), 1)
+
+        self._small = np.empty((self.size[1], self.size[0], 3), dtype=np.uint8)
+        self._gray = np.empty((self.size[1], self.size[0]), dtype=np.uint8)
+        self._prev_gray = None
+
+        self._skip_streak = 0
+        self._last_num_detections = 0
+
+        # whether the last frame let through was only let through by `max_skip`
+        self.forced = False
+
+        self.num_frames = 0
+        self.num_skipped = 0
+        self.num_forced = 0
+        self.num_missed_motion = 0
+
+    def __call__(self, frame) -> bool:
+        """True if the frame has to go through detection"""
+        cv2.resize(frame, self.size, dst=self._small, interpolation=cv2.INTER_AREA)
+        cv2.cvtColor(self._small, cv2.COLOR_BGR2GRAY, dst=self._gray)
+
+        self.num_frames += 1
+        self.forced = False
+
+        if self._prev_gray is None:
+            self._prev_gray = self._gray.copy()
+            return True
+
+        changed = cv2.absdiff(self._gray, self._prev_gray) > self.diff_thresh
+        motion = np.count_nonzero(changed & self._mask) / self._num_lane_pixels
+        self._prev_gray, self._gray = self._gray, self._prev_gray
+
+        if motion > self.min_motion:
+            self._skip_streak = 0
+            return True
+
+        if self._skip_streak >= self.max_skip:
+            self._skip_streak = 0
+            self.forced = True
+            self.num_forced += 1
+            return True
+
+        self._skip_streak += 1
+        self.num_skipped += 1
+        return False
+
+    def audit(self, num_detections: int, forced: bool) -> None:
+        """
+        to be called in order with the number of vehicles of every frame let through
+        and its `forced` flag
+        """
+        if forced and num_detections > self._last_num_detections:
+            self.num_missed_motion += 1
+
+        self._last_num_detections = num_detections
+
+    @property
+    def skip_ratio(self) -> float:
+        return self.num_skipped / max(self.num_frames, 1)
+
+    def report(self) -> str:
+        return (
+            f"Motion gate : skipped {self.num_skipped}/{self.num_frames} frames "
+            f"({round(100 * self.skip_ratio, 1)}%), {self.num_missed_motion} "
+            f"missed-motion events in {self.num_forced} forced checks"
+        )
@@ -0,0 +1,87 @@
+import queue
+from typing import Callable
+from multiprocessing import Queue, Value
+
+__all__ = ["QUEUE_POLICIES", "StageQueue", "put_while_alive"]
+
+
+QUEUE_POLICIES = ["block", "drop-oldest", "latest-only"]
+
+
+class StageQueue(object):
+    """
+    Bounded multiprocessing queue between two pipeline stages.
+
+    policy `block` makes the producer wait for room, `drop-oldest` throws away the
+    oldest queued item to make room and `latest-only` keeps just the newest item.
+    Every thrown away item is passed to `on_drop` (e.g. to free its frame slot) and
+    counted in `dropped`.
+    """
+
+    def __init__(self, maxsize: int, policy="block", on_drop: Callable = None) -> None:
+        if policy not in QUEUE_POLICIES:
+            raise ValueError(f"Invalid queue policy `{policy}` !")
+
+        if policy == "latest-only":
+            maxsize = 1
+
+        self.maxsize = maxsize
+        self.policy = policy
+        self.on_drop = on_drop
+
+        self._queue = Queue(maxsize)
+        self._dropped = Value("i", 0)
+
+    @property
+    def dropped(self) -> int:
+        return self._dropped.value
+
+    def _drop(self, item) -> None:
+        with self._dropped.get_lock():
+            self._dropped.value += 1
+
+        if self.on_drop is not None:
+            self.on_drop(item)
+
+    def put(self, item, timeout=None) -> None:
+        """
+        `timeout` only applies to the `block` policy, which raises queue.Full if no
+        room was made within it, the other policies never wait
+        """
+        if self.policy == "block":
+            self._queue.put(item, timeout=timeout)
+            return
+
+        while True:
+            try:
+                self._queue.put_nowait(item)
+                return
+            except queue.Full:
+                pass
+
+            try:
+                self._drop(self._queue.get_nowait())
+            except queue.Empty:
+                # consumer took it in the meantime, just retry
+                pass
+
+    def get(self, block=True, timeout=None):
+        return self._queue.get(block, timeout)
+
+    def qsize(self) -> int:
+        return self._queue.qsize()
+
+
+def put_while_alive(stage_queue: StageQueue, item, consumer, timeout=1.0) -> bool:
+    """
+    Puts `item` on `stage_queue`, waiting for room only while the `consumer`
+    process is alive. False if it died first, the item then was not put.
+    """
+    while consumer.is_alive():
+        try:
+            stage_queue.put(item, timeout=timeout)
+            return True
+        except queue.Full:
+            pass
+
+    return False
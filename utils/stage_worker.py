@@ -0,0 +1,95 @@
+import queue
+from typing import Callable
+
+__all__ = ["StopStage", "StageWorker"]
+
+
+class StopStage(object):
+    """
+    Sentinel put on a stage queue after the last item. A stage finishes every item
+    queued before it, forwards it downstream and exits.
+    """
+
+
+class StageWorker(object):
+    def __init__(
+        self,
+        in_queue,
+        handler: Callable,
+        out_queue=None,
+        timeout=1.0,
+        setup: Callable = None,
+        on_idle: Callable = None,
+        teardown: Callable = None,
+        batch_size=1,
+    ) -> None:
+
+        self.in_queue = in_queue
+        self.handler = handler
+        self.out_queue = out_queue
+        self.timeout = timeout
+        self.setup = setup
+        self.on_idle = on_idle
+        self.teardown = teardown
+        self.batch_size = batch_size
+
+    def run(self) -> None:
+        """
+        Blocks on the input queue instead of polling it, calls `handler` for every item
+        and puts its result (if not None) on the output queue. `on_idle` is called
+        whenever nothing arrived within `timeout` seconds. The stop sentinel is always
+        forwarded downstream, even if this stage fails, so the pipeline can't hang.
+
+        With `batch_size` > 1 the handler gets a list of whatever is already queued
+        (up to `batch_size` items, never waiting for more) and returns a list.
+        """
+
+        try:
+            if self.setup is not None:
+                self.setup()
+
+            while True:
+                try:
+                    item = self.in_queue.get(timeout=self.timeout)
+                except queue.Empty:
+                    if self.on_idle is not None:
+                        self.on_idle()
+                    continue
+
+                if isinstance(item, StopStage):
+                    break
+
+                if self.batch_size == 1:
+                    self._forward(self.handler(item))
+                    continue
+
+                items, stop = self._fill_batch(item)
+                for result in self.handler(items):
+                    self._forward(result)
+
+                if stop:
+                    break
+
+            if self.teardown is not None:
+                self.teardown()
+        finally:
+            if self.out_queue is not None:
+                self.out_queue.put(StopStage())
+
+    def _fill_batch(self, item) -> tuple:
+        items = [item]
+        while len(items) < self.batch_size:
+            try:
+                item = self.in_queue.get(block=False)
+            except queue.Empty:
+                break
+
+            if isinstance(item, StopStage):
+                return items, True
+            items.append(item)
+
+        return items, False
+
+    def _forward(self, result) -> None:
+        if result is not None and self.out_queue is not None:
+            self.out_queue.put(result)